@@ -0,0 +1,120 @@
+"""
+Load benchmark for the MetaSRA API under mixed search and autocomplete traffic.
+
+Runs a number of concurrent clients for each kind of request against a running
+API (the Flask development server, uWSGI, or the ASGI mode in
+src/metasra_asgi.py) backed by a local mongod, and prints the requests per
+second and latency percentiles for each kind.  Only needs the python standard
+library.
+
+Example, comparing uWSGI with the ASGI mode on the same database:
+$ uwsgi --http :5000 --wsgi-file src/metasra_api.py --callable app --processes 4
+$ python benchmarks/load.py --url http://localhost:5000
+$ (cd src && uvicorn metasra_asgi:app --workers 4 --port 5001)
+$ python benchmarks/load.py --url http://localhost:5001
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from urllib.parse import urlsplit, urlencode
+
+
+# Searches on broad terms, which match a large part of the database.
+SEARCHES = [
+    {'and': 'UBERON:0000467'},                  # anatomical system
+    {'and': 'CL:0000000'},                      # cell
+    {'and': 'UBERON:0000955'},                  # brain
+    {'and': 'CL:0000000', 'sampletype': 'cell line'},
+    {'and': 'UBERON:0000178', 'not': 'DOID:162'},
+]
+
+# Words to type into the autocomplete, one keystroke at a time.
+WORDS = ['brain', 'liver', 'neuron', 'stem cell', 'cancer', 'blood', 'kidney',
+    'embryo', 'lymphocyte', 'breast', 'heart', 'fibroblast', 'tumor', 'lung']
+
+
+
+def search_path(urlstem):
+    return urlstem + '/samples?' + urlencode(dict(random.choice(SEARCHES), skip=0, limit=10))
+
+
+def autocomplete_path(urlstem):
+    word = random.choice(WORDS)
+    return urlstem + '/terms?' + urlencode({'q': word[:random.randint(1, len(word))]})
+
+
+
+async def get(host, port, path):
+    """Make an HTTP GET request, returning the status code after reading the whole response."""
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(('GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host)).encode('latin-1'))
+        await writer.drain()
+        statusline = await reader.readline()
+        await reader.read()
+        return int(statusline.split()[1])
+    finally:
+        writer.close()
+
+
+
+async def client(host, port, urlstem, makepath, deadline, latencies, errors):
+    """Make requests one after another until the deadline."""
+
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            status = await get(host, port, makepath(urlstem))
+        except (OSError, ValueError, IndexError):
+            status = None
+        if status == 200:
+            latencies.append(time.monotonic() - start)
+        else:
+            errors.append(status)
+
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float('nan')
+
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    urlstem = url.path.rstrip('/') + args.urlstem
+    deadline = time.monotonic() + args.duration
+
+    kinds = [
+        ('search', search_path, args.search_clients),
+        ('autocomplete', autocomplete_path, args.autocomplete_clients),
+    ]
+    results = {kind: ([], []) for (kind, makepath, clients) in kinds}
+
+    start = time.monotonic()
+    await asyncio.gather(*(
+        client(host, port, urlstem, makepath, deadline, *results[kind])
+        for (kind, makepath, clients) in kinds
+        for i in range(clients)
+    ))
+    elapsed = time.monotonic() - start
+
+    print('%-14s %8s %8s %10s %10s %10s' % ('', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for kind, (latencies, errors) in results.items():
+        print('%-14s %8d %8d %10.1f %10.1f %10.1f' % (kind, len(latencies), len(errors),
+            len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000', help='base URL of the API server')
+    parser.add_argument('--urlstem', default='/api/v01')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--search-clients', type=int, default=8, help='concurrent clients making searches')
+    parser.add_argument('--autocomplete-clients', type=int, default=200, help='concurrent clients typing into the autocomplete')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,85 @@
+"""
+Benchmark of JSON serialization and response compression for search results.
+
+Fetches search results from a running API (uncompressed), then times encoding
+them with bson.json_util.dumps (how the API used to do it) and with
+src/response_encoding.py, and compares the bytes on the wire and compression
+time for each content encoding available.
+
+Example:
+$ python benchmarks/serialization.py --url http://localhost:5000 \\
+    'and=UBERON:0000955&limit=100' 'and=CL:0000000&limit=1000'
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+from bson import json_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+import response_encoding
+
+
+# Searches on a brain term and the root cell term, one page and a big page.
+DEFAULT_QUERIES = [
+    'and=UBERON:0000955&skip=0&limit=10',
+    'and=UBERON:0000955&skip=0&limit=1000',
+    'and=CL:0000000&skip=0&limit=1000',
+]
+
+
+
+def best_time(function, repeat):
+    """Return the best time in seconds of calling function() 'repeat' times."""
+
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+
+def benchmark(result, repeat):
+    rows = []
+
+    rows.append(('json_util.dumps', best_time(lambda: json_util.dumps(result), repeat), len(json_util.dumps(result))))
+    rows.append(('dumps', best_time(lambda: response_encoding.dumps(result), repeat), len(response_encoding.dumps(result))))
+    if 'studies' in result:
+        stream = lambda: ''.join(response_encoding.stream_json(result, 'studies', 64 * 1024))
+        rows.append(('stream_json', best_time(stream, repeat), len(stream())))
+
+    body = response_encoding.dumps(result).encode('utf-8')
+    for encoding, compressor in response_encoding.COMPRESSORS:
+        compress = lambda: b''.join(response_encoding.compress([body], encoding))
+        rows.append(('+ ' + encoding, best_time(compress, repeat), len(compress())))
+
+    for name, seconds, size in rows:
+        print('  %-18s %10.1f ms %12d bytes' % (name, seconds * 1000, size))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES, help='query strings for /samples')
+    parser.add_argument('--url', default='http://localhost:5000', help='base URL of the API server')
+    parser.add_argument('--urlstem', default='/api/v01')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if response_encoding.orjson is None:
+        print('orjson is not installed, using the standard library json module')
+
+    for query in args.queries:
+        url = args.url.rstrip('/') + args.urlstem + '/samples?' + query
+        request = urllib.request.Request(url, headers={'Accept-Encoding': 'identity'})
+        with urllib.request.urlopen(request) as response:
+            result = json_util.loads(response.read().decode('utf-8'))
+
+        print(query)
+        benchmark(result, args.repeat)
@@ -0,0 +1,127 @@
+"""
+Benchmark of the term histogram for multi-term searches, which aren't served
+from the precomputed 'termstats' collection.
+
+Times term_histogram() in src/metasra_api.py against the aggregation it
+replaced, which pushed the display terms of every matching samplegroup into
+one document per study and reduced them, on a local mongod with a database
+built by build-db.py.  Also checks that both give the same counts.  Run it
+from a machine with the API's requirements installed.
+
+Example:
+$ python benchmarks/term_histogram.py 'and=UBERON:0000955,CL:0000000' 'and=UBERON:0000178&not=DOID:162'
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+import metasra_api
+
+
+# Searches on broad terms, which match a large part of the database with many
+# partly-matching studies.
+DEFAULT_QUERIES = [
+    'and=UBERON:0000955,CL:0000000',
+    'and=UBERON:0000467,EFO:0000322',
+    'and=UBERON:0000178&not=DOID:162',
+]
+
+
+
+def pushed_term_histogram(query):
+    """The previous term histogram aggregation, for comparison."""
+
+    return list(metasra_api.db['samplegroups'].aggregate([
+        {'$match': metasra_api.samplegroup_match(query)},
+        {'$project': {
+            'study.id': True,
+            'dterms': True,
+            'sampleCount': True
+        }},
+        {'$group': {
+            '_id': '$study.id',
+            'sampleCount': {'$sum': '$sampleCount'},
+            'samplegroupCount': {'$sum': 1},
+            'dterms': {'$push': '$dterms'}
+        }},
+        {'$lookup': {
+            'from': 'studies',
+            'localField': '_id',
+            'foreignField': '_id',
+            'as': 'studyinfo'
+        }},
+        {'$unwind': '$studyinfo'},
+        {'$project': {
+            'sampleCount': True,
+            'dterms': {'$cond': {
+                'if': {'$eq': ['$samplegroupCount', '$studyinfo.samplegroupCount']},
+                'then': '$studyinfo.dterms',
+                'else': {'$reduce': {
+                    'input': '$dterms',
+                    'initialValue': [],
+                    'in': {'$setUnion': ['$$value', '$$this']}
+                }}
+            }},
+        }},
+        {'$unwind': '$dterms'},
+        {'$group': {
+            '_id': '$dterms',
+            'sampleCount': {'$sum': '$sampleCount'}
+        }},
+        {'$project': {
+            '_id': False,
+            'dterm': '$_id',
+            'sampleCount': True,
+        }},
+        {'$sort': OrderedDict([
+            ('sampleCount', -1),
+            ('dterm.name', 1)
+        ])}
+    ], allowDiskUse=True))
+
+
+
+def best_time(function, repeat):
+    """Return the best time in seconds of calling function() 'repeat' times, and its last result."""
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+
+def histogram_counts(terms):
+    return {(term['dterm']['name'], tuple(term['dterm']['ids'])): term['sampleCount'] for term in terms}
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('queries', nargs='*', default=DEFAULT_QUERIES,
+        help='search query strings, as for /api/v01/samples')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('%-45s %12s %12s %10s' % ('query', 'pushed (s)', 'current (s)', 'same'))
+    for querystring in args.queries:
+        with metasra_api.app.test_request_context('/?' + querystring):
+            query = metasra_api.samples_query()
+
+        # Call the function under the cache decorator.
+        pushed, expected = best_time(lambda: pushed_term_histogram(query), args.repeat)
+        current, result = best_time(lambda: metasra_api.term_histogram.__wrapped__(query), args.repeat)
+        print('%-45s %12.3f %12.3f %10s' % (querystring, pushed, current,
+            histogram_counts(expected) == histogram_counts(result)))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -10,10 +10,26 @@ INPUT (See config variables below):
         any filters.
 
 OUTPUT:
-+ Creates a new Mongo database called "metaSRA", with these collections: "terms" and "samplegroups".
-+ If there is already a database called "metaSRA", it is renamed to "metaSRA_old".
++ Creates a new Mongo database called "metaSRA_<timestamp>", with these collections: "terms",
+        "samplegroups", "studies", "termstats" (precomputed summaries of single-term searches)
+        and "termprefixes" (precomputed autocomplete results for short prefixes.)
++ Writes the build version to the "buildinfo" collection.  The API uses it to
+        throw away cached search results when the database is rebuilt.
++ Writes a memory-mapped snapshot of the database that the API can serve from
+        instead of Mongo (see SNAPSHOT_LOCATION and src/snapshot.py.)
++ When the build is finished, switches the API over to the new database by
+        updating the pointer document in the "metaSRA" database (see
+        src/databases.py), and drops databases from builds before the previous
+        one.  --rollback switches back to the previous one.
+        With --incremental, the new database starts as a copy of the active
+        one, updated for the samples that changed since it was built (see
+        incremental_update().)
++ Records when each build stage finished, with its time, rows processed and
+        peak memory, in the "buildstages" collection, and prints a report of
+        them.  Run with --help for options to run only some stages, resume after
+        the last completed stage, or do a dry run (see build_stages.py.)
 + Connects to a Mongo database on localhost using the default port.  If you need
-        to change the connection, see the new_output_db() function.
+        to change the connection, see the build_database() function.
 
 REQUIRES:
 + python 3.x
@@ -30,6 +46,16 @@ SRA_SUBSET_SQLITE_LOCATION = '/home/matt/projects/MetaSRA/mb-database-code/SRAme
 METASRA_PIPELINE_OUTPUT_SQLITE_LOCATION = '/home/matt/projects/MetaSRA/mb-database-code/metasra.v1-2.sqlite'
 RECOUNT_STUDIES_CSV_LOCATION = '/home/matt/projects/MetaSRA/mb-database-code/recount_selection_2017-11-06 03_32_29.csv'
 
+# Where to write the memory-mapped snapshot of the database for the API, or None
+# to skip it.  Each build writes its own file, SNAPSHOT_LOCATION.<version>, and
+# records its name with the database pointer (see src/databases.py), so the API
+# and rollbacks always switch the database and the snapshot together.
+SNAPSHOT_LOCATION = '/home/matt/projects/MetaSRA/mb-database-code/metaSRA.snapshot'
+
+# Where to keep the precomputed transitive closure of the ontology.  It's reused
+# by later builds until the ontology changes.
+ONTOLOGY_CLOSURE_LOCATION = '/home/matt/projects/MetaSRA/mb-database-code/ontology-closure.pickle'
+
 # Attributes to remove so they don't interfere when samples are grouped by like
 # attributes.  These should be sample-level ID's that don't contain meaningful
 # information.  (Sometimes tricky because different studies use these labels
@@ -83,6 +109,33 @@ def shorten_sampletype(sampletype):
 RELATED_TERM_SHRINKAGE_THRESHOLD = 50
 
 
+# Number of documents to write to Mongo at once in bulk inserts and updates.
+BULK_WRITE_BATCH_SIZE = 1000
+
+# Number of worker processes for CPU-bound build steps, or None for one per CPU core.
+BUILD_PROCESSES = None
+
+# With scipy installed, ancestral terms and most-specific terms, and the term
+# stats, are computed for this many samplegroups at a time with sparse matrix
+# products.
+ELABORATE_MATRIX_ROWS = 100000
+
+
+# Number of most-common display terms to keep in the precomputed summary of each
+# single-term search in the 'termstats' collection.
+TERM_STATS_TOP_TERMS = 1000
+
+
+# Precompute the ranked autocomplete completions of every prefix of a term token
+# up to this many characters long, and of longer prefixes matching at least
+# TERM_PREFIX_MIN_TERMS terms, in the 'termprefixes' collection.
+TERM_PREFIX_MAX_LENGTH = 3
+TERM_PREFIX_MIN_TERMS = 1000
+
+# Number of completions to keep for each prefix (the API's maximum limit.)
+TERM_PREFIX_TOP_TERMS = 500
+
+
 # We're grouping ontology terms by name.  If a term has ID's in multiple ontologies,
 # sort/prioritize them in this order.  For when we only want one term ID, eg for
 # term tag hilighting, choose the one with the highest precedence.
@@ -93,10 +146,35 @@ def ontology_precedence(term_id):
 
 
 
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, UpdateOne, ReplaceOne, DeleteOne
 import sqlite3
 import re
+import itertools
+import functools
+import multiprocessing
+import hashlib
+import pickle
+from array import array
 import csv
+import datetime
+import json
+import os.path
+import sys
+import argparse
+
+# Sparse matrix code, which uses scipy if it's installed.
+import term_tables
+
+# Runs the stages below, with resuming and the timing report.
+import build_stages
+
+
+# The snapshot format and the autocomplete ranking are shared with the API, so
+# import them from there.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+import snapshot
+import databases
+from term_index import TermIndex
 
 
 # Import ontolib
@@ -106,243 +184,644 @@ ONT_ID_TO_OG = {x:load_ontology.load(x)[0] for x in ONT_NAME_TO_ONT_ID.values()}
 
 
 
-def new_output_db():
+# Ontology relations followed for ancestral terms and related terms.
+CLOSURE_RELATIONS = ["is_a", "part_of"]
+
+class OntologyClosure:
     """
-    Create and return a new, empty mongo database 'metaSRA', and rename the old
-    one to 'mongo_old'
+    Transitive closure of the ontology graph by CLOSURE_RELATIONS, with the
+    distance to every ancestor and descendent, so ancestral terms and related
+    terms within a radius are lookups instead of graph traversals.
+
+    Terms are numbered, and ancestors and descendents are stored CSR-style in
+    compact integer arrays: the ancestors of term number i are
+    ancestors[ancestors_indptr[i]:ancestors_indptr[i+1]], at the distances in
+    the same range of ancestor_distances.
     """
 
-    # Connection uses localhost and default port, change here if you need to
-    # connect to something else.
-    client = MongoClient()
+    def __init__(self, og):
+        self.fingerprint = OntologyClosure.ontology_fingerprint(og)
+        self.term_ids = sorted(og.id_to_term)
+        self.numbers = {term_id: n for (n, term_id) in enumerate(self.term_ids)}
+
+        parents = [set() for term_id in self.term_ids]
+        for term_id, term in og.id_to_term.items():
+            for relation in CLOSURE_RELATIONS:
+                for parent in term.relationships.get(relation, []):
+                    if parent in self.numbers:
+                        parents[self.numbers[term_id]].add(self.numbers[parent])
+
+        # Breadth-first search up from each term gives the shortest distance
+        # to each ancestor.
+        self.ancestors_indptr, self.ancestors, self.ancestor_distances = array('I', [0]), array('I'), array('B')
+        descendents = [[] for term_id in self.term_ids]
+        for term in range(len(self.term_ids)):
+            distances = {term: 0}
+            frontier = [term]
+            while frontier:
+                next_frontier = []
+                for t in frontier:
+                    for parent in parents[t]:
+                        if parent not in distances:
+                            distances[parent] = distances[t] + 1
+                            next_frontier.append(parent)
+                frontier = next_frontier
+
+            del distances[term]
+            for ancestor, distance in sorted(distances.items()):
+                self.ancestors.append(ancestor)
+                self.ancestor_distances.append(min(distance, 255))
+                descendents[ancestor].append((term, min(distance, 255)))
+            self.ancestors_indptr.append(len(self.ancestors))
+
+        self.descendents_indptr, self.descendents, self.descendent_distances = array('I', [0]), array('I'), array('B')
+        for term_descendents in descendents:
+            for descendent, distance in term_descendents:
+                self.descendents.append(descendent)
+                self.descendent_distances.append(distance)
+            self.descendents_indptr.append(len(self.descendents))
+
+
+    @staticmethod
+    def ontology_fingerprint(og):
+        """Hash of the ontology's terms and relations, to tell when the OBO files changed."""
+
+        h = hashlib.sha1()
+        for term_id in sorted(og.id_to_term):
+            h.update(term_id.encode('utf-8'))
+            for relation in CLOSURE_RELATIONS:
+                for parent in sorted(og.id_to_term[term_id].relationships.get(relation, [])):
+                    h.update(('\t' + relation + ':' + parent).encode('utf-8'))
+            h.update(b'\n')
+        return h.hexdigest()
+
+
+    def _lookup(self, term_id, radius, indptr, related, distances):
+        n = self.numbers.get(term_id)
+        if n is None:
+            return set()
+        return set(self.term_ids[related[i]] for i in range(indptr[n], indptr[n+1])
+            if radius is None or distances[i] <= radius)
+
+
+    def ancestors_within_radius(self, term_id, radius=None):
+        """Ancestors of a term at most 'radius' relations away, or all if radius is None."""
+        return self._lookup(term_id, radius, self.ancestors_indptr, self.ancestors, self.ancestor_distances)
+
+
+    def descendents_within_radius(self, term_id, radius=None):
+        """Descendents of a term at most 'radius' relations away, or all if radius is None."""
+        return self._lookup(term_id, radius, self.descendents_indptr, self.descendents, self.descendent_distances)
+
+
+
+_ontology_closure = None
+
+def ontology_closure():
+    """
+    Return the OntologyClosure for the loaded ontology, from
+    ONTOLOGY_CLOSURE_LOCATION if it's there and the ontology hasn't changed
+    since it was computed, or else compute and save it.
+    """
+
+    global _ontology_closure
+    if _ontology_closure is not None:
+        return _ontology_closure
+
+    og = ONT_ID_TO_OG["17"]
+    fingerprint = OntologyClosure.ontology_fingerprint(og)
+
+    if os.path.exists(ONTOLOGY_CLOSURE_LOCATION):
+        with open(ONTOLOGY_CLOSURE_LOCATION, 'rb') as f:
+            closure = pickle.load(f)
+        if closure.fingerprint == fingerprint:
+            print('Using ontology closure from', ONTOLOGY_CLOSURE_LOCATION)
+            _ontology_closure = closure
+            return closure
+
+    print('Computing ontology closure')
+    closure = OntologyClosure(og)
+    with open(ONTOLOGY_CLOSURE_LOCATION + '.tmp', 'wb') as f:
+        pickle.dump(closure, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(ONTOLOGY_CLOSURE_LOCATION + '.tmp', ONTOLOGY_CLOSURE_LOCATION)
+
+    _ontology_closure = closure
+    return closure
+
+
+
+
+def chunks(iterable, size):
+    """Generator splitting an iterable into lists of 'size' items."""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+
+
+def copy_active_db(outdb):
+    """
+    For an incremental build, copy every collection of the active database
+    with its indices into this build's new database, so the incremental
+    update never changes the database the API is serving.  Each collection is
+    copied by the server with an $out stage, without passing through this
+    process, which needs MongoDB 4.4 or higher to write to another database.
+
+    Build stage markers aren't copied, and neither are the database pointers,
+    which are in the active database when it's 'metaSRA' from before
+    versioned builds.
+    """
+
+    client = outdb.client
+    if tuple(client.server_info()['versionArray'][:2]) < (4, 4):
+        sys.exit('Incremental builds need MongoDB 4.4 or higher, run a full build instead')
 
-    # TODO: use database version numbers instead of _old?
-    if 'metaSRA' in client.database_names():
-        print("Renaming old database to metaSRA_old")
-        if 'metaSRA_old' in client.database_names():
-            client.drop_database('metaSRA_old')
-        client.admin.command('copydb', fromdb='metaSRA', todb='metaSRA_old')
-        client.drop_database('metaSRA')
+    name, version, snapshot_name = databases.active_database(client)
+    source = client[name]
+    print('Copying database', name)
 
-    return client['metaSRA']
+    for collection in source.list_collection_names():
+        if collection in ('buildstages', databases.POINTERS_COLLECTION) or collection.startswith('system.'):
+            continue
+        source[collection].aggregate([{'$out': {'db': outdb.name, 'coll': collection}}], allowDiskUse=True)
+        for index, info in source[collection].index_information().items():
+            if index != '_id_':
+                outdb[collection].create_index(info['key'], name=index, unique=info.get('unique', False))
 
 
 
+def activate_output_db(outdb):
+    """
+    Switch the API over to this build's database and snapshot, and drop the
+    databases and snapshots of builds before the previous one, which is kept
+    for rollback.
+    """
+
+    client = outdb.client
+    version = outdb['buildinfo'].find_one({'_id': 'version'})['version']
+    path = snapshot_location(version)
+    snapshot_name = os.path.basename(path) if path and os.path.exists(path) else None
+    print('Activating database', outdb.name, 'version', version, 'snapshot', snapshot_name)
+    databases.activate(client, outdb.name, version, snapshot_name)
+
+    for name in databases.drop_old_databases(client):
+        print('Dropped old database', name)
+
+    if SNAPSHOT_LOCATION:
+        keep = databases.snapshot_names(client)
+        directory, prefix = os.path.split(SNAPSHOT_LOCATION)
+        for name in os.listdir(directory or '.'):
+            if re.fullmatch(re.escape(prefix) + r'\.\d+', name) and name not in keep:
+                os.remove(os.path.join(directory, name))
+                print('Removed old snapshot', name)
+
+
+
+
+
+class SortedGroups:
+    """
+    Rows from a SQLite cursor sorted by study and sample accession (the first
+    two columns), grouped by (study, sample), for merge-joining several tables
+    in one pass.
+    """
+
+    def __init__(self, rows):
+        self.groups = itertools.groupby(rows, key=lambda row: row[:2])
+        self.advance()
+
+    def advance(self):
+        self.key, self.rows = next(self.groups, (None, None))
+
+    def get(self, key):
+        """
+        Return the list of rows for a (study accession, sample accession)
+        tuple.  Keys must be asked for in sorted order.
+        """
+
+        while self.key is not None and self.key < key:
+            self.advance()
+        if self.key != key:
+            return []
+
+        rows = list(self.rows)
+        self.advance()
+        return rows
+
+
 
 
-def get_samples():
-    with sqlite3.connect(SRA_SUBSET_SQLITE_LOCATION) as conn:
-        conn.row_factory = sqlite3.Row # so we can use column names instead of indices
-        return conn.execute("""
-            SELECT sample_accession, study_accession, study_title
+def add_sqlite_indices(connection):
+    """
+    Create indices so the SQLite tables can be looked up by sample accession,
+    on the SRA subset database and the attached MetaSRA database.
+    """
+
+    print('Adding SQLite indices')
+    connection.executescript("""
+        CREATE INDEX IF NOT EXISTS
+            sample_attr_ind ON sample_attribute(sample_accession);
+        CREATE INDEX IF NOT EXISTS
+            experiment_sample_ind ON experiment(sample_accession, experiment_accession);
+        CREATE INDEX IF NOT EXISTS
+            run_experiment_ind ON run(experiment_accession, run_accession);
+        CREATE INDEX IF NOT EXISTS
+            metasra.mapped_ontology_terms_ind ON mapped_ontology_terms(sample_accession);
+        CREATE INDEX IF NOT EXISTS
+            metasra.sample_type_ind on sample_type(sample_accession);
+    """)
+
+
+
+def prepare_sqlite_inputs(connection):
+    """
+    Attach the MetaSRA database to a connection to the SRA subset database,
+    add indices, and make a temporary table 'sample_study' of every sample and
+    study it has experiments in, clustered by study then sample accession.
+    All the other tables are read joined to it, so they come out in the same
+    order.
+    """
+
+    connection.execute('ATTACH DATABASE ? AS metasra', (METASRA_PIPELINE_OUTPUT_SQLITE_LOCATION,))
+    add_sqlite_indices(connection)
+
+    print('Ordering samples by study')
+    connection.executescript("""
+        CREATE TEMP TABLE sample_study (
+            study_accession TEXT,
+            sample_accession TEXT,
+            study_title TEXT,
+            PRIMARY KEY (study_accession, sample_accession)
+        ) WITHOUT ROWID;
+
+        INSERT INTO sample_study
+            SELECT DISTINCT study_accession, sample_accession, study_title
             FROM (sample JOIN experiment USING (sample_accession)) JOIN study USING (study_accession);
-        """)
+    """)
+
+
+
+
+def get_samples(connection):
+    """
+    Return a cursor over (study accession, sample accession, study title) for
+    every sample and study it has experiments in, sorted by study then sample
+    accession.
+    """
+
+    return connection.execute("""
+        SELECT study_accession, sample_accession, study_title
+        FROM sample_study
+        ORDER BY study_accession, sample_accession
+    """)
+
 
 
+def get_attributes(connection):
+    """
+    Return a cursor over (study accession, sample accession, tag, value) for
+    all raw sample attributes from the SRA subset database, sorted by study
+    then sample accession.
+    """
+
+    return connection.execute("""
+        SELECT study_accession, sample_accession, tag, value
+        FROM sample_study JOIN sample_attribute USING (sample_accession)
+        ORDER BY study_accession, sample_accession
+    """)
 
 
-def lookup_attributes_and_samplename(sampleID, SRAconnection):
+
+def attributes_and_samplename(rows):
     """
-    Look up sammplenames and raw attributes from the SRA subset database.
+    Get the samplename and the list of raw attributes from a sample's rows of
+    get_attributes().
 
     The sample name is stored as a the attribute 'source_name', and we're pulling
     it out so we can treat it separately, and so it doesn't affect the sample
     groupings when we later group them by attributes.
     """
 
-    cursor = SRAconnection.execute("""
-        SELECT tag, value
-        FROM sample_attribute
-        WHERE sample_accession = ?
-    """, (sampleID,))
-
     # Putting attributes in a list of (key,value) tuples instead of just a
     # key:value object, because Mongodb has restrictions on certain characters
     # being used in keys.
     attributes, samplename = [], None
-    for (k,v) in cursor:
+    for (studyID, sampleID, k, v) in rows:
         if k == 'source_name':
             samplename = v
         elif k.lower() not in ATTRIBUTE_GROUPING_BLACKLIST:
-            #attributes.append({'k':k, 'v':'v'})
             attributes.append((k,v))
 
-    #return sorted(attributes, key=lambda d: (d['k'], d['v'])), samplename
     return sorted(attributes), samplename
 
 
 
-def lookup_ontology_terms(sampleID, metaSRAconnection):
+def get_ontology_terms(connection):
     """
-    Returns a list of term ID's for a given sample from MetaSRA.
+    Return a cursor over (study accession, sample accession, term ID) for all
+    ontology terms mapped to samples by MetaSRA, sorted by study then sample
+    accession.
     """
 
-    terms = metaSRAconnection.execute("""
-        SELECT term_id
-        FROM mapped_ontology_terms WHERE
-        sample_accession = ? ;
-    """, (sampleID,))
-    return sorted([s['term_id'] for s in terms])
+    return connection.execute("""
+        SELECT study_accession, sample_accession, term_id
+        FROM sample_study JOIN metasra.mapped_ontology_terms USING (sample_accession)
+        ORDER BY study_accession, sample_accession
+    """)
 
 
 
+def get_sample_types(connection):
+    """
+    Return a cursor over (study accession, sample accession, sample type,
+    confidence) for all samples with a sample type from MetaSRA, sorted by
+    study then sample accession.
+    """
+
+    return connection.execute("""
+        SELECT study_accession, sample_accession, sample_type, confidence
+        FROM sample_study JOIN metasra.sample_type USING (sample_accession)
+        ORDER BY study_accession, sample_accession
+    """)
 
 
-def lookup_sample_type(sampleID, metaSRAconnection):
+
+def get_experiment_runs(connection):
+    """
+    Return a cursor over (study accession, sample accession, experiment
+    accession, run accession) for all experiments of every sample, sorted by
+    study, sample, experiment and run.  Experiments without runs have a run
+    accession of None.
     """
 
+    return connection.execute("""
+        SELECT sample_study.study_accession, sample_study.sample_accession, experiment_accession, run_accession
+        FROM (sample_study JOIN experiment USING (sample_accession))
+            LEFT JOIN run USING (experiment_accession)
+        ORDER BY sample_study.study_accession, sample_study.sample_accession, experiment_accession, run_accession
+    """)
+
+
+
+def experiments_and_runs(rows):
+    """
+    Given a sample's rows of get_experiment_runs(), for each experiment return
+    the experiment ID and the run ID's associated with the experiment.
+    """
+
+    return [
+        {
+            'id': experimentID,
+            'runs': [run for (studyID, sampleID, e, run) in experimentRows if run is not None]
+        } for (experimentID, experimentRows) in itertools.groupby(rows, key=lambda row: row[2])
+    ]
+
+
+
+
+def sample_documents(connection):
+    """
+    Generator yielding a document for every sample and study the sample is in,
+    in order of study then sample accession, built by merge-joining each SQLite
+    table read once in that order.  'connection' has to be set up with
+    prepare_sqlite_inputs().
     """
 
-    sampletypes = metaSRAconnection.execute("""
-        SELECT sample_type, confidence
-        FROM sample_type
-        where sample_accession = ?
-    """, (sampleID,))
+    attributes = SortedGroups(get_attributes(connection))
+    terms = SortedGroups(get_ontology_terms(connection))
+    sampletypes = SortedGroups(get_sample_types(connection))
+    experiments = SortedGroups(get_experiment_runs(connection))
+
+    for (studyID, sampleID, studyTitle) in get_samples(connection):
+        key = (studyID, sampleID)
+        sample_attributes, samplename = attributes_and_samplename(attributes.get(key))
+        sample_terms = sorted(termID for (st, s, termID) in terms.get(key))
+        sample_types = [{'type': shorten_sampletype(t), 'conf': conf} for (st, s, t, conf) in sampletypes.get(key)]
+
+        # A stupid thing about big document-store databases is that keys
+        # need to be kept short to save space.
+        document = {
+            'id': sampleID,
+            'study': {
+                'id': studyID,
+                'title': studyTitle
+            },
+            'attr': sample_attributes,
+            'terms': sample_terms,
+            'type': sample_types[0] if sample_types else None,
+            'experiments': experiments_and_runs(experiments.get(key))
+        }
+        if samplename:
+            document['name'] = samplename
+        yield document
+
+
 
 
-    r = [{'type': shorten_sampletype(t['sample_type']), 'conf': t['confidence']} for t in sampletypes]
-    return r[0] if len(r) else None
+def content_hash(obj):
+    """SHA-1 digest of an object's canonical JSON encoding."""
 
+    content = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
 
 
-def lookup_experiment_runs(experimentID, SRAconnection):
+
+def group_study_samples(documents):
     """
-    Return a list of run ID's for a given experiment ID.
+    Group one study's sample documents from sample_documents() by same raw
+    attributes, terms and sample type, and return the samplegroup documents.
+
+    Samples are grouped on a hash of their (study, attributes, terms, type), so
+    the (sometimes long) attribute and term lists are never compared.
     """
 
-    runIDs = SRAconnection.execute("""
-        SELECT run_accession
-        FROM run
-        WHERE experiment_accession = ?
-    """, (experimentID,))
+    samplegroups = {}
+    for document in documents:
+        key = content_hash([document['study']['id'], document['attr'], document['terms'], document['type']])
+        if key not in samplegroups:
+            samplegroups[key] = {
+                'attr': document['attr'],
+                'terms': document['terms'],
+                'samples': [],
+                'study': document['study'],
+                'type': document['type'],
+            }
+
+        sample = {'id': document['id'], 'experiments': document['experiments']}
+        if 'name' in document:
+            sample['name'] = document['name']
+        samplegroups[key]['samples'].append(sample)
+
+    for samplegroup in samplegroups.values():
+        # Precompute the number of samples, which every search sums up.
+        samplegroup['sampleCount'] = len(samplegroup['samples'])
 
-    return [r['run_accession'] for r in runIDs]
+        # Flat list of run ID's of all the samples, so run ID downloads
+        # don't have to read the whole samplegroup.
+        samplegroup['runs'] = [run for sample in samplegroup['samples']
+            for experiment in sample['experiments'] for run in experiment['runs']]
 
+    return list(samplegroups.values())
 
 
 
-def lookup_sample_experiments(sampleID, SRAconnection):
+def build_samplegroups(outdb, incremental=False):
     """
-    Given a sample ID, for each associated experiment return the experiment ID
-    and the run ID's associated with the experiment.
+    Group samples by study and raw attributes (and terms and sample type)
+    straight from the SQLite files, and put them in a new collection called
+    'samplegroups'.  Also records a content hash of each study's samples in the
+    'studyhashes' collection, for incremental builds.
+
+    Samples come out of sample_documents() in order of study, so each study's
+    samples are grouped in memory as they arrive, and finished samplegroups are
+    inserted into Mongo in batches of BULK_WRITE_BATCH_SIZE.
+
+    If 'incremental' is true, only studies with added, changed or removed
+    samples since the previous build are grouped, into a separate
+    'newsamplegroups' collection, and the set of their study ID's is returned.
+    Their new hashes go in 'newstudyhashes' (None for removed studies), and
+    incremental_update() records them in 'studyhashes' once it's finished.
     """
 
-    experimentIDs = SRAconnection.execute("""
-        SELECT experiment_accession
-        FROM experiment
-        WHERE sample_accession = ?
-    """, (sampleID,))
+    print('Grouping samples by same attributes')
 
-    return [
-        {
-            'id': e['experiment_accession'],
-            'runs': lookup_experiment_runs(e['experiment_accession'], SRAconnection)
-        } for e in experimentIDs
-    ]
+    if incremental:
+        output = 'newsamplegroups'
+        previous = {study['_id']: study['hash'] for study in outdb['studyhashes'].find()}
+        outdb['newstudyhashes'].drop()
+    else:
+        output = 'samplegroups'
+        previous = {}
+        outdb['studyhashes'].drop()
+    outdb[output].drop()
+
+    studyhashes = []
+    samplegroups = []
+    with sqlite3.connect(SRA_SUBSET_SQLITE_LOCATION) as connection:
+        prepare_sqlite_inputs(connection)
 
+        print('Looking up samples')
+        for studyID, documents in itertools.groupby(sample_documents(connection),
+                key=lambda document: document['study']['id']):
+            documents = list(documents)
+            studyhash = content_hash(documents)
+            if previous.pop(studyID, None) == studyhash:
+                continue
 
+            studyhashes.append({'_id': studyID, 'hash': studyhash})
+            samplegroups.extend(group_study_samples(documents))
+            if len(samplegroups) >= BULK_WRITE_BATCH_SIZE:
+                outdb[output].insert_many(samplegroups, ordered=False)
+                samplegroups = []
 
+        if samplegroups:
+            outdb[output].insert_many(samplegroups, ordered=False)
 
+    if not incremental:
+        for batch in chunks(studyhashes, BULK_WRITE_BATCH_SIZE):
+            outdb['studyhashes'].insert_many(batch, ordered=False)
+        return set(studyhash['_id'] for studyhash in studyhashes)
 
-def build_samples(outdb):
+    # Studies that aren't in the input files anymore are left in 'previous'.
+    studyhashes.extend({'_id': studyID, 'hash': None} for studyID in previous)
+    for batch in chunks(studyhashes, BULK_WRITE_BATCH_SIZE):
+        outdb['newstudyhashes'].insert_many(batch, ordered=False)
+
+    print('Changed studies:', len(studyhashes))
+    return set(studyhash['_id'] for studyhash in studyhashes)
+
+
+
+
+
+@functools.lru_cache(maxsize=None)
+def display_terms(dterm_ids):
     """
-    Imports the samples table into MongoDB, and looks up sample attributes
-    for each.
+    Given a sorted tuple of a samplegroup's most specific term ID's, return its
+    display terms.  Memoized, because many samplegroups have the same terms.
     """
 
-    print('Building sample table')
+    # Combine terms with the same term name
+    dterm_names = distinct_terms_from_term_ids(dterm_ids)
+    dterms = [{'name': name, 'ids': ids} for (name, ids) in dterm_names.items()]
 
-    with sqlite3.connect(SRA_SUBSET_SQLITE_LOCATION) as SRAconnection:
-     with sqlite3.connect(METASRA_PIPELINE_OUTPUT_SQLITE_LOCATION) as metaSRAconnection:
-        SRAconnection.row_factory = sqlite3.Row # so we can use column names instead of indices
-        metaSRAconnection.row_factory = sqlite3.Row
+    # Sort by term ID to visually group terms by same ontology
+    return list(sorted(dterms, key=lambda term: term['ids'][0]))
 
 
-        # Create indices for faster lookups against individual sample ID's
-        print('Adding SQLite indices')
-        SRAconnection.executescript("""
-            CREATE INDEX IF NOT EXISTS
-                sample_attr_ind ON sample_attribute(sample_accession);
-            CREATE INDEX IF NOT EXISTS
-                experiment_sample_ind ON experiment(sample_accession, experiment_accession);
-            CREATE INDEX IF NOT EXISTS
-                run_experiment_ind ON run(experiment_accession, run_accession);
-        """)
-        metaSRAconnection.executescript("""
-            CREATE INDEX IF NOT EXISTS
-                mapped_ontology_terms_ind ON mapped_ontology_terms(sample_accession);
-            CREATE INDEX IF NOT EXISTS
-                sample_type_ind on sample_type(sample_accession);
-        """)
 
+@functools.lru_cache(maxsize=None)
+def elaborate_terms(terms):
+    """
+    Given a sorted tuple of a samplegroup's term ID's, return its display terms
+    and ancestral terms.  Memoized, because many samplegroups have the same
+    set of terms.
+    """
 
-        print('Looking up samples - this takes a long time')
-        for sample in get_samples():
-            attributes, samplename = lookup_attributes_and_samplename(
-                sample['sample_accession'], SRAconnection)
+    # Terms to display
+    dterm_ids = ontology_graph.most_specific_terms(terms,
+        ONT_ID_TO_OG["17"],
+        sup_relations=["is_a", "part_of"])
 
-            # Insert a document for this sample.
-            # A stupid thing about big document-store databases is that keys
-            # need to be kept short to save space.
-            document = {
-                'id': sample['sample_accession'],
-                'study': {
-                    'id': sample['study_accession'],
-                    'title': sample['study_title']
-                },
-                'attr': attributes,
-                'terms': lookup_ontology_terms(sample['sample_accession'], metaSRAconnection),
-                'type': lookup_sample_type(sample['sample_accession'], metaSRAconnection),
-                'experiments': lookup_sample_experiments(sample['sample_accession'], SRAconnection)
-            }
-            if samplename:
-                document['name'] = samplename
-            outdb['samples'].insert_one(document)
+    # Ancestral terms
+    aterms = set(terms)
+    for term in terms:
+        aterms.update(ontology_closure().ancestors_within_radius(term))
 
+    return display_terms(tuple(sorted(dterm_ids))), sorted(aterms)
 
 
 
-def group_samples(outdb):
+def elaborate_samplegroup_chunk(samplegroups):
     """
-    Group samples by study accession and raw attributes, and put them in a new
-    collection called 'samplegroups'.
+    Elaborate terms for a list of (_id, terms) tuples, in a worker process.
+    Returns a list of (_id, dterms, aterms) tuples.
     """
 
-    print('Grouping samples by same attributes')
-    outdb['samples'].aggregate([
+    return [(_id,) + elaborate_terms(tuple(sorted(terms))) for (_id, terms) in samplegroups]
 
-        # group by study accession and raw attributes
-        {'$group': {
-            '_id': {
-                'attr': '$attr',
-                'studyid': '$study.id',
-                'terms': '$terms',
-                'type': '$type'
-            },
-            'samples': {'$addToSet': {
-                'id': '$id',
-                'name': '$name',
-                'experiments': '$experiments'
-            }},
-            'study': {'$first': '$study'}
-        }},
 
-        # re-shape the document to have 'attr' and 'study' fields instead of
-        # tucking them in '_id'.
-        {'$project': {
-            'attr': '$_id.attr',
-            'terms': '$_id.terms',
-            '_id': False, # suppress '_id' field
-            'samples': True, # include 'samples',
-            'study': True,
-            'type': '$_id.type'
-        }},
 
-        # Send to a new collection called 'samplegroups'
-        {'$out': 'samplegroups'}
-    ], allowDiskUse=True)
+@functools.lru_cache(maxsize=None)
+def ancestor_matrix():
+    """Sparse matrix of the ontology closure, see term_tables.ancestor_matrix()."""
+    return term_tables.ancestor_matrix(ontology_closure())
+
 
 
+def elaborate_terms_matrix(samplegroups):
+    """
+    Elaborate terms for a list of (_id, terms) tuples, like
+    elaborate_samplegroup_chunk(), for all of them at once with sparse
+    matrices (see term_tables.expand_terms().)
+    """
+
+    expanded = term_tables.expand_terms(ontology_closure(),
+        [terms for (_id, terms) in samplegroups], ancestor_matrix())
+    return [(_id, display_terms(tuple(dterm_ids)), aterms)
+        for ((_id, terms), (dterm_ids, aterms)) in zip(samplegroups, expanded)]
+
+
+
+def write_elaborated_terms(outdb, results):
+    """Write a list of (_id, dterms, aterms) tuples to the samplegroups collection."""
+
+    outdb['samplegroups'].bulk_write([
+        UpdateOne(
+            {'_id': _id},
+            {'$set': {
+                'dterms': dterms,
+                'aterms': aterms
+                },
+            '$unset': {'terms': 1}
+            },
+        ) for (_id, dterms, aterms) in results
+    ], ordered=False)
 
 
 
@@ -351,44 +830,45 @@ def elaborate_samplegroup_terms(outdb):
     For each sample group, 1) find the set of terms to display by removing terms that have
     children in the set, and 2) find a different set of terms to use for computing the
     search queries by including ancestors of the terms in the set.
-    """
 
-    print('Looking up most-specific terms and ancestral terms')
-    for samplegroup in outdb['samplegroups'].find().sort('_id', ASCENDING):
+    Only samplegroups that haven't been elaborated yet (still having 'terms')
+    are looked up, so incremental builds only do new samplegroups.
 
-        # Terms to display
-        dterm_ids = ontology_graph.most_specific_terms(samplegroup['terms'],
-            ONT_ID_TO_OG["17"],
-            sup_relations=["is_a", "part_of"])
+    If scipy is installed, samplegroups are elaborated ELABORATE_MATRIX_ROWS at
+    a time with sparse matrix products (see elaborate_terms_matrix().)
+    Otherwise they're split into chunks for a pool of BUILD_PROCESSES worker
+    processes.  Workers are forked, so they share the ontology already loaded in
+    ONT_ID_TO_OG and the ontology closure.  Results are written back with bulk writes.
+    """
 
-        # Combine terms with the same term name
-        dterm_names = distinct_terms_from_term_ids(dterm_ids)
-        dterms = [{'name': name, 'ids': ids} for (name, ids) in dterm_names.items()]
+    # Load the closure before forking, so the workers share it.
+    ontology_closure()
 
+    print('Looking up most-specific terms and ancestral terms')
+    samplegroups = ((samplegroup['_id'], samplegroup['terms']) for samplegroup in
+        outdb['samplegroups'].find({'terms': {'$exists': True}}, {'terms': True}).sort('_id', ASCENDING))
 
-        # Ancestral terms
-        aterms = set(samplegroup['terms'])
-        for term in samplegroup['terms']:
-            aterms.update(ONT_ID_TO_OG["17"].recursive_relationship(term, ["is_a", "part_of"]))
+    if term_tables.HAVE_SCIPY:
+        print('Using sparse matrix products (scipy)')
+        for chunk in chunks(samplegroups, ELABORATE_MATRIX_ROWS):
+            for results in chunks(elaborate_terms_matrix(chunk), BULK_WRITE_BATCH_SIZE):
+                write_elaborated_terms(outdb, results)
+        return
 
-        outdb['samplegroups'].update_one(
-            {'_id': samplegroup['_id']},
-            {'$set':{
-                # Sort by term ID to visually group terms by same ontology
-                'dterms': list(sorted(dterms, key=lambda term: term['ids'][0])),
-                'aterms': list(aterms)
-                },
-            '$unset': {'terms': 1}
-            },
-        )
+    print('scipy is not installed, using a pool of worker processes '
+        '(pip install -r requirements.txt in build-db-script for the faster path)')
+    with multiprocessing.get_context('fork').Pool(BUILD_PROCESSES) as pool:
+        for results in pool.imap_unordered(elaborate_samplegroup_chunk, chunks(samplegroups, BULK_WRITE_BATCH_SIZE)):
+            write_elaborated_terms(outdb, results)
 
 
 
 
-def add_recount_ids(outdb):
+def add_recount_ids(outdb, studyIDs=None):
     """
     Iterate through the CSV file with Recount2 study ID's, and add a
-    'study.study.recountId' field to samplegroups that have recount data.
+    'study.study.recountId' field to samplegroups that have recount data
+    (only in the set 'studyIDs' if it isn't None.)
 
     The first column of the CSV file needs to be a study ID.  (I downloaded
     this file on the front page of Recount2, the button that says "Download
@@ -399,6 +879,8 @@ def add_recount_ids(outdb):
 
     with open(RECOUNT_STUDIES_CSV_LOCATION) as f:
         for line in csv.reader(f):
+            if studyIDs is not None and line[0] not in studyIDs:
+                continue
             if outdb['samplegroups'].find_one({'study.id': line[0]}):
                 outdb['samplegroups'].update(
                     {'study.id': line[0]},
@@ -411,6 +893,56 @@ def add_recount_ids(outdb):
 
 
 
+def build_studies(outdb, studyIDs=None):
+    """
+    Create the 'studies' collection, with one document for every study: the
+    study metadata (with its recountId), its total number of samples and
+    samplegroups, the _id's of its samplegroups, and the union of their display
+    terms.  The API uses this instead of regrouping every study whose
+    samplegroups all match a search.
+
+    For an incremental build, only replace the documents for 'studyIDs'.
+    """
+
+    print('Creating studies collection')
+    pipeline = [
+        {'$group': {
+            '_id': '$study.id',
+            'study': {'$first': '$study'},
+            'sampleCount': {'$sum': '$sampleCount'},
+            'samplegroupCount': {'$sum': 1},
+            'samplegroups': {'$push': '$_id'},
+            'dterms': {'$push': '$dterms'}
+        }},
+        {'$project': {
+            'study': True,
+            'sampleCount': True,
+            'samplegroupCount': True,
+            'samplegroups': True,
+            'dterms': {'$reduce': {
+                'input': '$dterms',
+                'initialValue': [],
+                'in': {'$setUnion': ['$$value', '$$this']}
+            }}
+        }}
+    ]
+
+    if studyIDs is None:
+        outdb['samplegroups'].aggregate(pipeline + [{'$out': 'studies'}], allowDiskUse=True)
+        return
+
+    outdb['studies'].delete_many({'_id': {'$in': list(studyIDs)}})
+    studies = outdb['samplegroups'].aggregate(
+        [{'$match': {'study.id': {'$in': list(studyIDs)}}}] + pipeline, allowDiskUse=True)
+    for batch in chunks(studies, BULK_WRITE_BATCH_SIZE):
+        outdb['studies'].insert_many(batch, ordered=False)
+
+
+
+
+
+
+
 def get_distinct_termIDs(outdb):
     """
     Create a new collection 'terms' with one document for every distinct term
@@ -518,6 +1050,13 @@ def get_tokens(text):
 
 
 
+@functools.lru_cache(maxsize=None)
+def get_term_name(term_id):
+    """Look up the name of a term with ontolib, memoized."""
+    return general_ontology_tools.get_term_name(term_id)
+
+
+
 def distinct_terms_from_term_ids(term_ids):
     """
     Given an iterable of term ID's, look up names for each term and group the
@@ -528,7 +1067,7 @@ def distinct_terms_from_term_ids(term_ids):
 
     term_names = dict()
     for term_id in term_ids:
-        term_name = general_ontology_tools.get_term_name(term_id)
+        term_name = get_term_name(term_id)
         if term_name in term_names:
             term_names[term_name].append(term_id)
         else:
@@ -539,30 +1078,30 @@ def distinct_terms_from_term_ids(term_ids):
 
 
 
-def term_id_in_metasra(term_id, outdb):
+def get_metasra_term_ids(outdb):
     """
-    Given a term ID, check to see if it has any matching samples in MetaSRA.
+    Return the set of all term ID's having matching samples in MetaSRA, from
+    the samplegroups themselves, so it doesn't depend on the intermediate
+    'termIDs' collection still being there.
     """
 
-    if outdb['samplegroups'].find_one({'aterms': term_id}):
-        return True
-    else:
-        return False
+    return set(outdb['samplegroups'].distinct('aterms'))
 
 
 
 
 
 ANCESTORS, DESCENDENTS = 1, 2
-def lookup_related_terms(term_ids, direction, outdb):
+def lookup_related_terms(term_ids, direction, metasra_term_ids):
     """
     Find ancestor or decendent terms for a list of term ID's, formatted to go in
-    the DB.
+    the DB.  Only includes terms in the set 'metasra_term_ids', which have
+    matching samples.
     """
 
     # Get the function to go either up or down the ontology
-    lookup_function = (general_ontology_tools.get_ancestors_within_radius if
-        direction == ANCESTORS else general_ontology_tools.get_descendents_within_radius)
+    lookup_function = (ontology_closure().ancestors_within_radius if
+        direction == ANCESTORS else ontology_closure().descendents_within_radius)
 
     # Look up terms at radius 2
     related_term_ids = set()
@@ -570,7 +1109,7 @@ def lookup_related_terms(term_ids, direction, outdb):
         related_term_ids.update(lookup_function(term_id, 2))
 
     # Exclude terms that don't match any samples in SRA
-    filtered_term_ids = filter(lambda term: term_id_in_metasra(term, outdb), related_term_ids)
+    filtered_term_ids = related_term_ids & metasra_term_ids
     related_term_names = distinct_terms_from_term_ids(filtered_term_ids)
 
 
@@ -581,7 +1120,7 @@ def lookup_related_terms(term_ids, direction, outdb):
         for term_id in term_ids:
             related_term_ids.update(lookup_function(term_id, 1))
         # Exclude terms that don't match any samples in SRA
-        filtered_term_ids = filter(lambda term: term_id_in_metasra(term, outdb), related_term_ids)
+        filtered_term_ids = related_term_ids & metasra_term_ids
         related_term_names = distinct_terms_from_term_ids(filtered_term_ids)
 
 
@@ -600,134 +1139,474 @@ def lookup_related_terms(term_ids, direction, outdb):
 
 
 
+def term_attributes(term_ids, term_name, metasra_term_ids):
+    """
+    Return the fields of the 'terms' document for a term name and its term
+    ID's, gleaned from ontolib.
+    """
+
+    # Look up set of synonyms for all ID's for this term
+    name_and_synonyms = set()
+    for term_id in term_ids:
+        name_and_synonyms.update(general_ontology_tools.get_term_name_and_synonyms(term_id))
+
+    # Get tokens for finding autocomplete terms, from name and synonyms
+    tokens = set()
+    for text in name_and_synonyms:
+        tokens.update(get_tokens(text))
+
+    # Keep a field with term-name tokens, so we can rank the term higher if it
+    # matches the term name instead of only the synonyms.
+    name_tokens = get_tokens(term_name)
+
+    # Lookup ancestor and descendent terms to show in the autocomplete
+    ancestor_terms = lookup_related_terms(term_ids, ANCESTORS, metasra_term_ids)
+    descendent_terms = lookup_related_terms(term_ids, DESCENDENTS, metasra_term_ids)
+
+    # Synonym string for display
+    synonyms = name_and_synonyms.copy()
+    synonyms.remove(term_name)
+    synonym_string = ', '.join(sorted(synonyms))
+
+    # Heuristic for sorting autocomplete results
+    score = len(term_name)
+
+    # Put ID's in order of precedence
+    term_ids = sorted(term_ids, key=ontology_precedence)
+
+    return {
+        'ids': term_ids,
+        'syn': synonym_string,
+        'tokens': list(tokens),
+        'nametokens': list(name_tokens),
+        'ancestors': ancestor_terms,
+        'descendents': descendent_terms,
+        'score': score
+    }
+
+
+
 def lookup_term_attributes(outdb):
     """
     For each term in the 'terms' collection, populate fields gleaned from ontolib.
     """
 
+    # Look up which terms have matching samples once, instead of querying the
+    # samplegroups collection for every related term.
+    metasra_term_ids = get_metasra_term_ids(outdb)
+
     print('Looking up term info from ontolib')
     for term in outdb['terms'].find().sort('_id', ASCENDING):
-        term_ids = term['ids']
-        term_name = term['name']
+        outdb['terms'].update_one(
+            {'_id': term['_id']},
+            {'$set': term_attributes(term['ids'], term['name'], metasra_term_ids)},
+        )
 
 
-        # Look up set of synonyms for all ID's for this term
-        name_and_synonyms = set()
-        for term_id in term_ids:
-            name_and_synonyms.update(general_ontology_tools.get_term_name_and_synonyms(term_id))
 
-        # Get tokens for finding autocomplete terms, from name and synonyms
-        tokens = set()
-        for text in name_and_synonyms:
-            tokens.update(get_tokens(text))
 
-        # Keep a field with term-name tokens, so we can rank the term higher if it
-        # matches the term name instead of only the synonyms.
-        name_tokens = get_tokens(term_name)
 
-        # Lookup ancestor and descendent terms to show in the autocomplete
-        ancestor_terms = lookup_related_terms(term_ids, ANCESTORS, outdb)
-        descendent_terms = lookup_related_terms(term_ids, DESCENDENTS, outdb)
 
-        # Synonym string for display
-        synonyms = name_and_synonyms.copy()
-        synonyms.remove(term_name)
-        synonym_string = ', '.join(sorted(synonyms))
 
-        # Heuristic for sorting autocomplete results
-        score = len(term_name)
+def build_term_prefixes(outdb):
+    """
+    Create the 'termprefixes' collection, with the ranked autocomplete
+    completions of short (and common) prefixes.  The first few characters
+    typed into the autocomplete match a large part of the terms collection,
+    so the API looks these up instead of ranking all of the matching terms.
+
+    Completions are ranked by the same TermIndex the API uses, and refer to
+    terms by their first term ID.
+    """
+
+    print('Precomputing autocomplete completions for short prefixes')
+    outdb['termprefixes'].drop()
+
+    index = TermIndex(outdb['terms'].find().sort('_id', ASCENDING))
+    prefixes = index.completion_prefixes(TERM_PREFIX_MAX_LENGTH, TERM_PREFIX_MIN_TERMS)
+    for chunk in chunks(prefixes, BULK_WRITE_BATCH_SIZE):
+        outdb['termprefixes'].insert_many(
+            [index.completion(prefix, TERM_PREFIX_TOP_TERMS) for prefix in chunk],
+            ordered=False)
+
+
+
+
+
+
+
+def update_terms(outdb):
+    """
+    For an incremental build, update the 'terms' collection for the set of
+    term ID's with matching samples after the samplegroups have changed.
+
+    Only terms whose documents can change are rebuilt: terms that were added
+    or removed, and terms within radius 2 of them in the ontology, whose
+    ancestor and descendent lists only include terms with matching samples.
+    Returns True if any terms changed.
+    """
+
+    print('Updating changed terms')
+    previous_term_ids = set()
+    for term in outdb['terms'].find({}, {'ids': True}):
+        previous_term_ids.update(term['ids'])
+    metasra_term_ids = get_metasra_term_ids(outdb)
+
+    changed_term_ids = previous_term_ids ^ metasra_term_ids
+    if not changed_term_ids:
+        return False
+
+    affected_term_ids = set(changed_term_ids)
+    for term_id in changed_term_ids:
+        affected_term_ids.update(ontology_closure().ancestors_within_radius(term_id, 2))
+        affected_term_ids.update(ontology_closure().descendents_within_radius(term_id, 2))
+    affected_names = set(get_term_name(term_id) for term_id in affected_term_ids
+        if term_id in metasra_term_ids or term_id in previous_term_ids)
+
+    # Group the current term ID's of the affected term names by name.
+    names = {}
+    for term_id in metasra_term_ids:
+        term_name = get_term_name(term_id)
+        if term_name in affected_names:
+            names.setdefault(term_name, []).append(term_id)
+
+    # Replace term documents in place, keyed by name, so unchanged terms keep
+    # their _id's, and delete the names that no longer have any term ID's.
+    outdb['terms'].create_index('name')
+    updates = [ReplaceOne({'name': term_name},
+            dict(term_attributes(term_ids, term_name, metasra_term_ids), name=term_name),
+            upsert=True)
+        for (term_name, term_ids) in sorted(names.items())]
+    updates.extend(DeleteOne({'name': term_name}) for term_name in sorted(affected_names - set(names)))
+    for batch in chunks(updates, BULK_WRITE_BATCH_SIZE):
+        outdb['terms'].bulk_write(batch, ordered=False)
+
+    print('Changed terms:', len(names))
+    return True
+
+
+
+
+
+
+
+def build_term_stats(outdb, term_ids=None):
+    """
+    Create the 'termstats' collection, with a precomputed summary of the search
+    results for every single ancestral term, and for every term and sample type.
+    The API serves these searches from this collection instead of aggregating
+    the matching samplegroups.
+
+    The summaries are the same as the API computes for the search: study and
+    sample counts, study order, and the most-common display terms.  They're
+    all built in one pass over the samplegroups in order of study, fanning
+    each samplegroup out over its ancestral terms (see term_tables.TermStats,
+    which uses sparse matrices if scipy is installed.)
+
+    For an incremental build, only replace the summaries for 'term_ids'.
+    """
+
+    print('Precomputing search summaries for single terms')
+    if term_ids is None:
+        outdb['termstats'].drop()
+        match = {}
+    else:
+        outdb['termstats'].delete_many({'term': {'$in': list(term_ids)}})
+        match = {'aterms': {'$in': list(term_ids)}}
+
+    stats = term_tables.TermStats(term_ids, batch_size=ELABORATE_MATRIX_ROWS)
+    stats.add(outdb['samplegroups'].aggregate([
+        {'$match': match},
+        {'$sort': {'study.id': ASCENDING}},
+        {'$project': {
+            '_id': False,
+            'study': '$study.id',
+            'type': '$type.type',
+            'sampleCount': True,
+            'aterms': True,
+            'dterms': True
+        }}
+    ], allowDiskUse=True))
+
+    # Terms removed by an incremental build don't get a summary.
+    for batch in chunks(stats.documents(TERM_STATS_TOP_TERMS), BULK_WRITE_BATCH_SIZE):
+        outdb['termstats'].insert_many(batch, ordered=False)
+
+    outdb['termstats'].create_index([('term', ASCENDING), ('type', ASCENDING)], unique=True)
+
+
+
+
+def write_build_version(outdb):
+    """
+    Write a new version for this database build to the 'buildinfo' collection.
+    """
+
+    version = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    print('Database build version', version)
+    outdb['buildinfo'].replace_one(
+        {'_id': 'version'},
+        {'_id': 'version', 'version': version},
+        upsert=True
+    )
+
 
-        # Put ID's in order of precedence
-        term_ids.sort(key=ontology_precedence)
 
-        outdb['terms'].update_one(
-            {'_id': term['_id']},
-            {'$set':{
-                'ids': term_ids,
-                'syn': synonym_string,
-                'tokens': list(tokens),
-                'nametokens': list(name_tokens),
-                'ancestors': ancestor_terms,
-                'descendents': descendent_terms,
-                'score': score
-                },
-            },
-        )
 
 
 
 
+def snapshot_location(version):
+    """Path of the snapshot file for a build version, or None if snapshots are off."""
 
+    return SNAPSHOT_LOCATION + '.' + version if SNAPSHOT_LOCATION else None
 
 
-def build_database():
+
+def export_snapshot(outdb):
     """
-    Calls all the steps in-order to build the mongoDB database.
+    Write the samplegroups and terms collections to a memory-mapped snapshot
+    file for the API, tagged with the build version, at
+    snapshot_location(version).  It has to be written before the build is
+    activated, which records it in the database pointer.  Does nothing if
+    SNAPSHOT_LOCATION is None.
     """
 
+    if not SNAPSHOT_LOCATION:
+        return
+
+    version = outdb['buildinfo'].find_one({'_id': 'version'})['version']
+    print('Writing snapshot to', snapshot_location(version))
+
+    snapshot.write_snapshot(
+        snapshot_location(version),
+        version,
+        # Sort using the study.id index, the snapshot needs samplegroups grouped by study.
+        outdb['samplegroups'].find().sort('study.id', ASCENDING),
+        outdb['terms'].find().sort('_id', ASCENDING),
+        outdb['termprefixes'].find().sort('_id', ASCENDING)
+    )
 
-    # CONNECTION SETUP #########################################################
 
-    # Rename the existing metaSRA db to metaSRA_old, and return a blank db called metaSRA
-    outdb = new_output_db()
 
-    # If you want to only run a part of the build-db pipeline and don't want to start a
-    # new database, you can comment out new_output_db() and uncomment this line.
-    # outdb = MongoClient()['metaSRA']
 
 
 
 
-    # SAMPLE GROUPS COLLECTION  ################################################
+def incremental_update(outdb):
+    """
+    Update a copy of the active database (from copy_active_db()) for changes
+    in the input files since the last build, instead of rebuilding everything.
+    Only studies with added, changed or removed samples are regrouped, only
+    their new samplegroups elaborated, and only the terms and term summaries
+    they touch recomputed.
+
+    The API keeps serving the active database until the copy is activated,
+    like a full build, so it never sees a half-updated database.
+
+    The changed studies' hashes are only recorded in 'studyhashes' at the end,
+    so if the update is interrupted, running it again (eg with --resume) finds
+    the same changed studies instead of finding nothing to do.  The terms of
+    their old samplegroups are kept in 'changedterms' until then, since the old
+    samplegroups may be gone by the time it's run again.
+    """
+
+    # Regroup the changed studies in a separate collection.
+    studyIDs = build_samplegroups(outdb, incremental=True)
+    if not studyIDs:
+        print('No samples changed since the previous build')
+        outdb['newsamplegroups'].drop()
+        outdb['newstudyhashes'].drop()
+        return False
+    studyList = list(studyIDs)
 
-    # Copy the SQLite files with samples into Mongodb (this step takes a long time.)
-    build_samples(outdb)
+    # Ancestral terms of the old samplegroups, whose term summaries change.
+    old_term_ids = outdb['samplegroups'].distinct('aterms', {'study.id': {'$in': studyList}})
+    for batch in chunks(old_term_ids, BULK_WRITE_BATCH_SIZE):
+        outdb['changedterms'].bulk_write([ReplaceOne({'_id': termID}, {'_id': termID}, upsert=True)
+            for termID in batch], ordered=False)
+    changed_term_ids = set(outdb['changedterms'].distinct('_id'))
 
-    # Create a new 'samplegroups' collection by grouping samples via Mongodb.
-    group_samples(outdb)
+    # Swap the changed studies' samplegroups for the new ones.
+    outdb['samplegroups'].delete_many({'study.id': {'$in': studyList}})
+    for batch in chunks(outdb['newsamplegroups'].find(), BULK_WRITE_BATCH_SIZE):
+        outdb['samplegroups'].insert_many(batch, ordered=False)
+    outdb['newsamplegroups'].drop()
 
-    # Use ontolib to find 1) the most specific terms (to display) and 2) all ancestral
-    # terms for each sample group.
     elaborate_samplegroup_terms(outdb)
+    add_recount_ids(outdb, studyIDs)
+    build_studies(outdb, studyIDs)
+
+    changed_term_ids.update(outdb['samplegroups'].distinct('aterms', {'study.id': {'$in': studyList}}))
+
+    if update_terms(outdb):
+        build_term_prefixes(outdb)
+    build_term_stats(outdb, changed_term_ids)
+
+    # Last, record the changed studies' hashes for the next incremental build.
+    updates = [ReplaceOne({'_id': studyhash['_id']}, studyhash, upsert=True) if studyhash['hash'] is not None
+        else DeleteOne({'_id': studyhash['_id']}) for studyhash in outdb['newstudyhashes'].find()]
+    for batch in chunks(updates, BULK_WRITE_BATCH_SIZE):
+        outdb['studyhashes'].bulk_write(batch, ordered=False)
+    outdb['newstudyhashes'].drop()
+    outdb['changedterms'].drop()
+
+    return True
+
+
+
+
+
+
+
+def create_samplegroup_indices(outdb):
+    """Add terms index for sample queries, and study index for studies and the snapshot."""
 
-    # Add terms index for sample queries
     print('Creating ancestral terms index on samplegroups collection')
     outdb['samplegroups'].create_index([('aterms', ASCENDING), ('type.type', ASCENDING)])
     outdb['samplegroups'].create_index('study.id')
 
+
+
+def create_term_indices(outdb):
+    """Add token index for term autocomplete queries, and id index for lookup."""
+
+    print('Creating id, name and token indices on terms collection')
+    outdb['terms'].create_index('tokens')
+    outdb['terms'].create_index('ids')
+    outdb['terms'].create_index('name')
+
+
+
+def drop_intermediate_collections(outdb):
+    print('Dropping intermediate, unused collections')
+    outdb['termIDs'].drop()
+
+
+
+
+
+# Steps of a full build, in order, as (name, function, collection) tuples.
+# Each function is called with the output database, and the number of documents
+# in 'collection' afterwards is reported as the rows the stage processed.
+BUILD_STAGES = [
+
+    # SAMPLE GROUPS COLLECTION
+
+    # Create a new 'samplegroups' collection by grouping samples from the
+    # SQLite files.
+    ('samplegroups', build_samplegroups, 'samplegroups'),
+
+    # Use ontolib to find 1) the most specific terms (to display) and 2) all
+    # ancestral terms for each sample group.
+    ('elaborate_terms', elaborate_samplegroup_terms, 'samplegroups'),
+    ('samplegroup_indices', create_samplegroup_indices, None),
+
     # From a CSV with studies from Recount2, add a field to all samplegroups in
     # our database where the study is in Recount2.
-    add_recount_ids(outdb)
+    ('recount_ids', add_recount_ids, 'samplegroups'),
+
 
+    # STUDIES COLLECTION
 
+    # Precompute sample counts and display term unions for every study.
+    ('studies', build_studies, 'studies'),
 
 
-    # TERMS COLLECTION #########################################################
+    # TERMS COLLECTION
 
-    # Create a collection with all the distinct term ID's assigned to at least one sample.
-    get_distinct_termIDs(outdb)
+    # Create a collection with all the distinct term ID's assigned to at least
+    # one sample.
+    ('term_ids', get_distinct_termIDs, 'termIDs'),
 
-    # Use Ontolib to look up names for all of our term ID's, and group term ID's having the
-    # same name.
-    get_term_names(outdb)
+    # Use Ontolib to look up names for all of our term ID's, and group term
+    # ID's having the same name.
+    ('term_names', get_term_names, 'terms'),
 
     # For each term, look up synonyms, ancestors, and descendents.
-    lookup_term_attributes(outdb)
+    ('term_attributes', lookup_term_attributes, 'terms'),
+    ('term_indices', create_term_indices, None),
 
-    # Add token index for term autocomplete queries, and id index for lookup
-    print('Creating id and token indices on terms collection')
-    outdb['terms'].create_index('tokens')
-    outdb['terms'].create_index('ids')
+    # Rank autocomplete results for the first few characters typed.
+    ('term_prefixes', build_term_prefixes, 'termprefixes'),
 
 
+    # TERM STATS COLLECTION
 
+    # Precompute counts, study order and most-common display terms for
+    # searches on a single term, with and without a sample type.
+    ('term_stats', build_term_stats, 'termstats'),
 
-    print('Dropping intermediate, unused collections')
-    outdb['samples'].drop()
-    outdb['termIDs'].drop()
+    ('drop_intermediate', drop_intermediate_collections, None),
+
+    # Mark the build as finished, write the database to a snapshot file the
+    # API can memory-map, and switch the API over to both.  This has to be the
+    # last step, because the API flushes its cached search results when it
+    # sees a new version.
+    ('build_version', write_build_version, None),
+    ('snapshot', export_snapshot, None),
+    ('activate', activate_output_db, None),
+]
+
+
+# Steps of an incremental build, in a new database starting from a copy of the
+# active one.  incremental_update() returns False when nothing changed, which
+# stops the build there and drops the copy.
+INCREMENTAL_STAGES = [
+    ('copy_active', copy_active_db, 'samplegroups'),
+    ('incremental_update', incremental_update, 'samplegroups'),
+    ('build_version', write_build_version, None),
+    ('snapshot', export_snapshot, None),
+    ('activate', activate_output_db, None),
+]
+
+
+
+
+def build_database(incremental=False, stages=None, resume=False, dry_run=False, report=None):
+    """
+    Run the steps of the build (BUILD_STAGES, or INCREMENTAL_STAGES to update
+    a copy of the active database with incremental_update()) in order, and
+    print how long each took.
+
+    A build of every stage starts with a new database: empty for a full build,
+    or a copy of the active one for an incremental build.  See
+    build_stages.run_build() for the other options.
+    """
+
+    # Connection uses localhost and default port, change here if you need to
+    # connect to something else.
+    client = MongoClient()
+
+    build_stages.run_build(client, INCREMENTAL_STAGES if incremental else BUILD_STAGES,
+        incremental=incremental, stages=stages, resume=resume, dry_run=dry_run, report=report)
 
 
 
 
 if __name__ == '__main__':
-    build_database()
+    stageNames = [name for (name, function, collection) in BUILD_STAGES + INCREMENTAL_STAGES]
+
+    parser = argparse.ArgumentParser(description='Build the MetaSRA mongo database from the SQLite files.')
+    parser.add_argument('--incremental', action='store_true',
+        help='build from a copy of the active database, updated for samples changed since it was built')
+    parser.add_argument('--stages', type=lambda stages: stages.split(','),
+        help='comma-separated stages to run on the unfinished build\'s database, out of: ' + ', '.join(sorted(set(stageNames))))
+    parser.add_argument('--resume', action='store_true',
+        help='skip stages already completed, eg to pick up after a crash')
+    parser.add_argument('--dry-run', action='store_true', help='print the stages that would run')
+    parser.add_argument('--report', help='write the per-stage timing report to this JSON file')
+    parser.add_argument('--rollback', action='store_true',
+        help="switch the API back to the previous build's database, instead of building")
+    args = parser.parse_args()
+
+    if args.rollback:
+        print('Active database is now', databases.rollback(MongoClient()))
+        sys.exit()
+
+    for name in args.stages or []:
+        if name not in stageNames:
+            parser.error('unknown stage: ' + name)
+
+    build_database(incremental=args.incremental, stages=args.stages, resume=args.resume,
+        dry_run=args.dry_run, report=args.report)
@@ -0,0 +1,193 @@
+"""
+Runs the stages of a build-db.py build in order, recording when each one
+finished in the output database's 'buildstages' collection, so a crashed build
+can be resumed after its last completed stage, and reports the time, rows
+processed and peak memory of each stage.
+
+The stages themselves are in build-db.py.  This only needs pymongo and
+src/databases.py, not onto_lib, so it can be tested on its own.
+"""
+
+import datetime
+import json
+import os.path
+import resource
+import sys
+import time
+
+# databases.py is shared with the API, in ../src.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+import databases
+
+
+
+def new_output_db(client):
+    """
+    Create and return a new, empty mongo database for this build, named
+    'metaSRA_<timestamp>' and recorded as being built (see src/databases.py.)
+    The API keeps serving the active database until it's activated.
+    """
+
+    name = databases.start_build(client, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+    print('Building new database', name)
+    return client[name]
+
+
+
+def current_output_db(client, incremental=False):
+    """
+    Return the database an unfinished build is writing to, to resume it or run
+    some of its stages.  Exits if there isn't one: stages only ever write to a
+    database that isn't being served yet, never to the active one.
+    """
+
+    name = databases.building_database(client)
+    if name is None:
+        sys.exit('No unfinished build to resume or run stages on, run build-db.py%s to start one'
+            % (' --incremental' if incremental else ''))
+    print('Using database', name)
+    return client[name]
+
+
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, so it can be measured
+    for each stage.  Only supported on Linux; elsewhere the peak is since the
+    process started.
+    """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+
+def peak_rss():
+    """
+    Return (peak RSS of this process since reset_peak_rss(), largest peak RSS
+    of any worker process so far) in megabytes.
+    """
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024, children
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, children
+
+
+
+def run_stage(outdb, mode, name, function, collection):
+    """
+    Run one build stage, and record its completion marker with its wall time,
+    rows processed and peak memory in the 'buildstages' collection.  Returns
+    the stage function's result and the marker.
+    """
+
+    print('\n### Stage', name)
+    reset_peak_rss()
+    start = time.monotonic()
+    result = function(outdb)
+    seconds = time.monotonic() - start
+    rss, workerRSS = peak_rss()
+
+    rows = outdb[collection].estimated_document_count() if collection else None
+    marker = {
+        '_id': mode + ':' + name,
+        'mode': mode,
+        'stage': name,
+        'finished': datetime.datetime.utcnow(),
+        'seconds': seconds,
+        'rows': rows,
+        'rowsPerSecond': rows / seconds if rows is not None and seconds > 0 else None,
+        'peakRSS': rss,
+        'workerPeakRSS': workerRSS,
+    }
+    outdb['buildstages'].replace_one({'_id': marker['_id']}, marker, upsert=True)
+    return result, marker
+
+
+
+def print_report(markers):
+    """Print the time, rows processed and peak memory of each stage."""
+
+    print('\n%-22s %10s %12s %10s %10s %10s' % ('stage', 'seconds', 'rows', 'rows/s', 'peak MB', 'workers MB'))
+    for marker in markers:
+        print('%-22s %10.1f %12s %10s %10.0f %10.0f' % (
+            marker['stage'],
+            marker['seconds'],
+            '' if marker['rows'] is None else marker['rows'],
+            '' if marker['rowsPerSecond'] is None else '%.0f' % marker['rowsPerSecond'],
+            marker['peakRSS'],
+            marker['workerPeakRSS'],
+        ))
+    print('%-22s %10.1f' % ('total', sum(marker['seconds'] for marker in markers)))
+
+
+
+
+def run_build(client, pipeline, incremental=False, stages=None, resume=False, dry_run=False, report=None):
+    """
+    Run the stages of a build in order.  'pipeline' is a list of (name,
+    function, collection) tuples: each function is called with the output
+    database, and the number of documents in 'collection' afterwards is
+    reported as the rows the stage processed.  A stage returning False stops
+    the build there.
+
+    A build of every stage starts with a new database.  Otherwise the
+    database of the unfinished build is used (see current_output_db()):
+    + 'stages' is a list of stage names to run, instead of all of them.
+    + With 'resume', stages that already finished in this mode (since the last
+      run that wasn't resumed) are skipped, to pick up after a crash.
+    + With 'dry_run', just print which stages would run.
+    + 'report' is a path to also write the stage timings to as JSON.
+    """
+
+    mode = 'incremental' if incremental else 'full'
+    if stages is not None:
+        pipeline = [stage for stage in pipeline if stage[0] in stages]
+    new_database = stages is None and not resume
+
+    outdb = None if new_database else current_output_db(client, incremental)
+    completed = set()
+    if resume:
+        completed = set(marker['stage'] for marker in outdb['buildstages'].find({'mode': mode}))
+
+    if dry_run:
+        if new_database:
+            print('Would start a new database, leaving the active one as it is')
+        for name, function, collection in pipeline:
+            print(('skip ' if name in completed else 'run  ') + name)
+        return
+
+    if new_database:
+        # The API keeps serving the active database until the 'activate' stage.
+        outdb = new_output_db(client)
+    elif not resume:
+        outdb['buildstages'].delete_many({'mode': mode})
+
+    markers = []
+    for name, function, collection in pipeline:
+        if name in completed:
+            print('Skipping completed stage', name)
+            continue
+        result, marker = run_stage(outdb, mode, name, function, collection)
+        markers.append(marker)
+        if result is False:
+            print('Nothing to do, stopping after stage', name)
+            if new_database:
+                print('Dropping database', outdb.name)
+                databases.cancel_build(client, outdb.name)
+            break
+
+    print_report(markers)
+    if report:
+        with open(report, 'w') as f:
+            json.dump(markers, f, indent=2, default=str)
@@ -0,0 +1,273 @@
+"""
+Sparse matrix computations over samplegroups and ontology terms for
+build-db.py.
+
+These only need an ontology closure (OntologyClosure in build-db.py, or
+anything with its 'term_ids', 'numbers', 'ancestors' and 'ancestors_indptr'
+attributes), not onto_lib, so they can be tested on their own.
+
+numpy and scipy are optional (pip install -r requirements.txt in this
+directory).  Without them, HAVE_SCIPY is False and build-db.py uses its slower
+pure-python code instead.
+"""
+
+import itertools
+
+try:
+    import numpy
+    import scipy.sparse
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+
+
+def ancestor_matrix(closure):
+    """
+    Sparse matrix (terms x terms) of an ontology closure, numbered like
+    closure.term_ids, with a 1 where the column term is an ancestor of the row
+    term.  Terms aren't their own ancestors.
+    """
+
+    return scipy.sparse.csr_matrix((
+        numpy.ones(len(closure.ancestors), dtype=numpy.int32),
+        numpy.asarray(closure.ancestors, dtype=numpy.int64),
+        numpy.asarray(closure.ancestors_indptr, dtype=numpy.int64),
+    ), shape=(len(closure.term_ids), len(closure.term_ids)))
+
+
+
+def expand_terms(closure, term_lists, ancestors=None):
+    """
+    Given a list of term ID lists (one for each samplegroup), return a list of
+    (most specific term ID's, ancestral term ID's) tuples of sorted lists, for
+    all of them at once with sparse matrices:
+    + terms: samplegroups x terms, a 1 for each of a samplegroup's terms
+    + terms * ancestors: nonzero for the ancestors of any of a samplegroup's
+      terms
+    Ancestral terms are then the nonzeros of terms + terms * ancestors, and
+    the most specific terms are the samplegroup's terms that aren't an
+    ancestor of another one of its terms.
+
+    'ancestors' is ancestor_matrix(closure), if it's already been built.
+    Term ID's that aren't in the ontology are kept as they are, in both.
+    """
+
+    if ancestors is None:
+        ancestors = ancestor_matrix(closure)
+
+    indices, indptr, unknown = [], [0], []
+    for terms in term_lists:
+        numbers = set(closure.numbers.get(term) for term in terms)
+        numbers.discard(None)
+        indices.extend(sorted(numbers))
+        indptr.append(len(indices))
+        unknown.append([term for term in terms if term not in closure.numbers])
+
+    terms = scipy.sparse.csr_matrix((numpy.ones(len(indices), dtype=numpy.int32), indices, indptr),
+        shape=(len(term_lists), len(closure.term_ids)))
+    term_ancestors = terms @ ancestors
+
+    ancestral = (terms + term_ancestors).tocsr()
+    ancestral.sort_indices()
+    specific = (terms - terms.multiply(term_ancestors > 0)).tocsr()
+    specific.eliminate_zeros()
+    specific.sort_indices()
+
+    results = []
+    for row in range(len(term_lists)):
+        aterms = [closure.term_ids[i] for i in ancestral.indices[ancestral.indptr[row]:ancestral.indptr[row+1]]]
+        dterm_ids = [closure.term_ids[i] for i in specific.indices[specific.indptr[row]:specific.indptr[row+1]]]
+        results.append((sorted(dterm_ids + unknown[row]), sorted(aterms + unknown[row])))
+    return results
+
+
+
+class TermStats:
+    """
+    Summaries of the search results for every single term, and every term and
+    sample type, for the 'termstats' collection (see build_term_stats() in
+    build-db.py), accumulated in one pass over the samplegroups.
+
+    Samplegroups are added in order of study, as dicts with the study ID as
+    'study', the sample type (or None) as 'type', and 'sampleCount', 'aterms'
+    and 'dterms'.  Each samplegroup is fanned out over its ancestral terms,
+    and within each study the matching samplegroups' sample counts and display
+    terms are combined the same way the API does for a search.
+
+    With scipy, a batch of studies of about 'batch_size' samplegroups is done
+    at a time with sparse matrices (see add_batch_matrices()), instead of one
+    study at a time with sets.
+    """
+
+    def __init__(self, term_ids=None, batch_size=100000, use_scipy=HAVE_SCIPY):
+        # Only summarize these terms, if not None.
+        self.term_ids = set(term_ids) if term_ids is not None else None
+        self.batch_size = batch_size
+        self.use_scipy = use_scipy
+
+        self.dterms = []            # display term number -> display term
+        self.dterm_numbers = {}     # (name, ids) -> display term number
+        self.summaries = {}         # (term ID, sample type or None) -> summary
+
+
+    def dterm_number(self, dterm):
+        key = (dterm['name'], tuple(dterm['ids']))
+        if key not in self.dterm_numbers:
+            self.dterm_numbers[key] = len(self.dterms)
+            self.dterms.append(dterm)
+        return self.dterm_numbers[key]
+
+
+    def terms(self, samplegroup):
+        if self.term_ids is None:
+            return samplegroup['aterms']
+        return [term for term in samplegroup['aterms'] if term in self.term_ids]
+
+
+    def summary(self, term, sampletype):
+        key = (term, sampletype)
+        if key not in self.summaries:
+            self.summaries[key] = {'studies': [], 'samplegroupCount': 0, 'histogram': {}}
+        return self.summaries[key]
+
+
+    def add(self, samplegroups):
+        """Add an iterable of samplegroups, sorted by study."""
+
+        batch = []
+        for studyID, studygroups in itertools.groupby(samplegroups, key=lambda samplegroup: samplegroup['study']):
+            batch.extend(studygroups)
+            if len(batch) >= self.batch_size:
+                self.add_batch(batch)
+                batch = []
+        if batch:
+            self.add_batch(batch)
+
+
+    def add_batch(self, samplegroups):
+        """Add a list of samplegroups having all of the samplegroups of their studies."""
+
+        if self.use_scipy:
+            self.add_batch_matrices(samplegroups)
+            return
+
+        for studyID, studygroups in itertools.groupby(samplegroups, key=lambda samplegroup: samplegroup['study']):
+
+            # Matching sample count, samplegroup count and union of display
+            # terms of the study for each (term, sample type) search.
+            study = {}
+            for samplegroup in studygroups:
+                dterms = [self.dterm_number(dterm) for dterm in samplegroup['dterms']]
+                sampletypes = [None, samplegroup['type']] if samplegroup.get('type') else [None]
+                for term in self.terms(samplegroup):
+                    for sampletype in sampletypes:
+                        entry = study.setdefault((term, sampletype), [0, 0, set()])
+                        entry[0] += samplegroup['sampleCount']
+                        entry[1] += 1
+                        entry[2].update(dterms)
+
+            for (term, sampletype), (sampleCount, samplegroupCount, dterms) in study.items():
+                summary = self.summary(term, sampletype)
+                summary['studies'].append([studyID, sampleCount])
+                summary['samplegroupCount'] += samplegroupCount
+                histogram = summary['histogram']
+                for dterm in dterms:
+                    histogram[dterm] = histogram.get(dterm, 0) + sampleCount
+
+
+    def add_batch_matrices(self, samplegroups):
+        """
+        add_batch() with sparse matrices.  For each sample type (and for all
+        sample types), with the rows of the samplegroups of that type:
+        + terms: samplegroups x terms, and dterms: samplegroups x display terms
+        + pairs: (study, term) pairs x samplegroups, a 1 where the samplegroup
+          is in the study and has the term
+        + pairs * counts: the matching sample count of each pair, and
+          pairs * dterms: nonzero for the union of display terms of each pair
+        + histogram: terms x display terms, from summing the sample counts of
+          the pairs with each display term, for each term
+        """
+
+        studyIDs, studies, term_ids, term_numbers = [], [], [], {}
+        terms_indices, terms_indptr, dterms_indices, dterms_indptr = [], [0], [], [0]
+        for samplegroup in samplegroups:
+            if not studyIDs or studyIDs[-1] != samplegroup['study']:
+                studyIDs.append(samplegroup['study'])
+            studies.append(len(studyIDs) - 1)
+            for term in self.terms(samplegroup):
+                if term not in term_numbers:
+                    term_numbers[term] = len(term_ids)
+                    term_ids.append(term)
+                terms_indices.append(term_numbers[term])
+            terms_indptr.append(len(terms_indices))
+            dterms_indices.extend(set(self.dterm_number(dterm) for dterm in samplegroup['dterms']))
+            dterms_indptr.append(len(dterms_indices))
+
+        if not term_ids:
+            return
+
+        rows, nterms = len(samplegroups), len(term_ids)
+        studies = numpy.array(studies, dtype=numpy.int64)
+        counts = numpy.array([samplegroup['sampleCount'] for samplegroup in samplegroups], dtype=numpy.int64)
+        terms = scipy.sparse.csr_matrix((numpy.ones(len(terms_indices), dtype=numpy.int64), terms_indices, terms_indptr),
+            shape=(rows, nterms))
+        dterms = scipy.sparse.csr_matrix((numpy.ones(len(dterms_indices), dtype=numpy.int64), dterms_indices, dterms_indptr),
+            shape=(rows, len(self.dterms)))
+
+        types = [samplegroup.get('type') or None for samplegroup in samplegroups]
+        for sampletype in [None] + sorted(set(t for t in types if t is not None)):
+            if sampletype is None:
+                typeterms = terms.tocoo()
+            else:
+                mask = numpy.array([t == sampletype for t in types], dtype=numpy.int64)
+                typeterms = (scipy.sparse.diags(mask, dtype=numpy.int64) @ terms).tocoo()
+                typeterms.eliminate_zeros()
+            if typeterms.nnz == 0:
+                continue
+
+            pairs, pair_rows = numpy.unique(studies[typeterms.row] * nterms + typeterms.col, return_inverse=True)
+            pair_terms, pair_studies = pairs % nterms, pairs // nterms
+            pair_matrix = scipy.sparse.csr_matrix(
+                (numpy.ones(len(pair_rows), dtype=numpy.int64), (pair_rows, typeterms.row)),
+                shape=(len(pairs), rows))
+
+            pair_counts = pair_matrix @ counts
+            pair_samplegroups = numpy.bincount(pair_rows, minlength=len(pairs))
+            pair_dterms = (pair_matrix @ dterms).tocsr()
+            pair_dterms.data[:] = 1
+            histogram = (scipy.sparse.csr_matrix(
+                    (numpy.ones(len(pairs), dtype=numpy.int64), (pair_terms, numpy.arange(len(pairs)))),
+                    shape=(nterms, len(pairs)))
+                @ (scipy.sparse.diags(pair_counts, dtype=numpy.int64) @ pair_dterms)).tocoo()
+
+            for term, study, sampleCount, samplegroupCount in zip(pair_terms, pair_studies, pair_counts, pair_samplegroups):
+                summary = self.summary(term_ids[term], sampletype)
+                summary['studies'].append([studyIDs[study], int(sampleCount)])
+                summary['samplegroupCount'] += int(samplegroupCount)
+
+            for term, dterm, sampleCount in zip(histogram.row, histogram.col, histogram.data):
+                summary_histogram = self.summary(term_ids[term], sampletype)['histogram']
+                summary_histogram[int(dterm)] = summary_histogram.get(int(dterm), 0) + int(sampleCount)
+
+
+    def documents(self, top_terms):
+        """
+        Generator yielding the 'termstats' documents, sorted by term and then
+        sample type, with the 'top_terms' most-common display terms.
+        """
+
+        for (term, sampletype) in sorted(self.summaries, key=lambda key: (key[0], key[1] is not None, key[1] or '')):
+            summary = self.summaries[(term, sampletype)]
+            histogram = sorted(summary['histogram'].items(), key=lambda item: (
+                -item[1], self.dterms[item[0]]['name'], self.dterms[item[0]]['ids']))
+            yield {
+                'term': term,
+                'type': sampletype,
+                'studyCount': len(summary['studies']),
+                'sampleCount': sum(sampleCount for (studyID, sampleCount) in summary['studies']),
+                'samplegroupCount': summary['samplegroupCount'],
+                'studies': sorted(summary['studies'], key=lambda study: (-study[1], study[0])),
+                'terms': [{'dterm': self.dterms[dterm], 'sampleCount': sampleCount}
+                    for (dterm, sampleCount) in histogram[:top_terms]],
+            }
@@ -0,0 +1,111 @@
+"""
+Tests for build_stages.py, on mongomock.  Run with pytest from this directory
+(pip install pytest mongomock.)
+"""
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+import build_stages
+import databases
+
+
+
+class Stages:
+    """A pipeline of stages that record their calls, and can be made to fail."""
+
+    def __init__(self, names, fail=None, result=None):
+        self.calls = []
+        self.fail = fail
+        self.result = result
+        self.pipeline = [(name, self.stage(name), 'rows') for name in names]
+
+    def stage(self, name):
+        def function(outdb):
+            self.calls.append((outdb.name, name))
+            if name == self.fail:
+                raise RuntimeError('stage failed')
+            outdb['rows'].insert_one({'stage': name})
+            return self.result if name == 'last' else None
+        return function
+
+
+
+@pytest.fixture
+def client():
+    return mongomock.MongoClient()
+
+
+
+def test_build_and_report(client, tmp_path, capsys):
+    stages = Stages(['first', 'second', 'last'])
+    build_stages.run_build(client, stages.pipeline, report=str(tmp_path / 'report.json'))
+
+    name = databases.building_database(client)
+    assert name.startswith(databases.DATABASE_PREFIX)
+    assert stages.calls == [(name, 'first'), (name, 'second'), (name, 'last')]
+
+    markers = {marker['stage']: marker for marker in client[name]['buildstages'].find()}
+    assert set(markers) == {'first', 'second', 'last'}
+    assert markers['second']['rows'] == 2 and markers['second']['mode'] == 'full'
+    assert 'last' in (tmp_path / 'report.json').read_text()
+    assert 'total' in capsys.readouterr().out
+
+
+
+def test_resume_after_crash(client):
+    stages = Stages(['first', 'second', 'last'], fail='second')
+    with pytest.raises(RuntimeError):
+        build_stages.run_build(client, stages.pipeline)
+    name = databases.building_database(client)
+
+    # Resuming skips the completed stage, in the same database.
+    stages.fail = None
+    stages.calls = []
+    build_stages.run_build(client, stages.pipeline, resume=True)
+    assert stages.calls == [(name, 'second'), (name, 'last')]
+
+    # Running some stages again starts their markers over.
+    stages.calls = []
+    build_stages.run_build(client, stages.pipeline, stages=['last'])
+    assert stages.calls == [(name, 'last')]
+    assert [marker['stage'] for marker in client[name]['buildstages'].find()] == ['last']
+
+    # Incremental markers are separate from a full build's.
+    stages.calls = []
+    build_stages.run_build(client, stages.pipeline, incremental=True, resume=True)
+    assert stages.calls == [(name, 'first'), (name, 'second'), (name, 'last')]
+
+
+
+def test_nothing_to_do(client):
+    stages = Stages(['first', 'last', 'after'], result=False)
+    build_stages.run_build(client, stages.pipeline, incremental=True)
+
+    # The new database is dropped, and the stages after the one returning False aren't run.
+    assert [stage for (name, stage) in stages.calls] == ['first', 'last']
+    assert databases.building_database(client) is None
+    assert not any(name.startswith(databases.DATABASE_PREFIX) for name in client.list_database_names())
+
+
+
+def test_dry_run(client, capsys):
+    stages = Stages(['first', 'second'])
+    build_stages.run_build(client, stages.pipeline, dry_run=True)
+    assert stages.calls == []
+    assert databases.building_database(client) is None
+    assert 'run  first\nrun  second' in capsys.readouterr().out
+
+
+
+def test_stages_need_an_unfinished_build(client):
+    # Without one, stages would write to the database the API is serving.
+    client['metaSRA_1']['rows'].insert_one({'stage': 'active'})
+    databases.activate(client, 'metaSRA_1', '1')
+    stages = Stages(['first', 'last'])
+    for options in ({'resume': True}, {'stages': ['last']}, {'stages': ['last'], 'incremental': True}):
+        with pytest.raises(SystemExit):
+            build_stages.run_build(client, stages.pipeline, **options)
+    assert stages.calls == []
+    assert client['metaSRA_1']['rows'].count_documents({}) == 1
@@ -0,0 +1,151 @@
+"""
+Tests for term_tables.py, against brute-force results on random ontologies.
+Run with pytest from this directory.  The sparse matrix tests are skipped
+without numpy and scipy.
+"""
+
+import random
+from array import array
+
+import pytest
+
+import term_tables
+
+requires_scipy = pytest.mark.skipif(not term_tables.HAVE_SCIPY, reason='numpy and scipy are not installed')
+
+
+
+class Closure:
+    """Minimal stand-in for OntologyClosure in build-db.py, from a dict of term ID -> parent term ID's."""
+
+    def __init__(self, parents):
+        self.term_ids = sorted(parents)
+        self.numbers = {term_id: n for (n, term_id) in enumerate(self.term_ids)}
+        self.ancestors_indptr, self.ancestors = array('I', [0]), array('I')
+        for term_id in self.term_ids:
+            for ancestor in sorted(brute_force_ancestors(parents, term_id)):
+                self.ancestors.append(self.numbers[ancestor])
+            self.ancestors_indptr.append(len(self.ancestors))
+
+
+
+def brute_force_ancestors(parents, term_id):
+    ancestors, stack = set(), list(parents[term_id])
+    while stack:
+        term = stack.pop()
+        if term not in ancestors:
+            ancestors.add(term)
+            stack.extend(parents[term])
+    return ancestors
+
+
+
+def random_dag(rng, n, max_parents=3):
+    """Random ontology where each term's parents are earlier terms, so there are no cycles."""
+
+    term_ids = ['T:%04d' % i for i in range(n)]
+    return {term_id: set(rng.sample(term_ids[:i], min(i, rng.randint(0, max_parents))))
+        for (i, term_id) in enumerate(term_ids)}
+
+
+
+@requires_scipy
+def test_expand_terms_matches_brute_force():
+    rng = random.Random(0)
+    parents = random_dag(rng, 300)
+    closure = Closure(parents)
+    term_ids = sorted(parents)
+
+    term_lists = [rng.sample(term_ids, rng.randint(0, 8)) for i in range(2000)]
+    # Term ID's that aren't in the ontology are kept as they are.
+    term_lists.append(['T:0001', 'X:unknown'])
+
+    for terms, (specific, ancestral) in zip(term_lists, term_tables.expand_terms(closure, term_lists)):
+        known = [term for term in terms if term in parents]
+        ancestors = set()
+        for term in known:
+            ancestors |= brute_force_ancestors(parents, term)
+
+        assert ancestral == sorted(set(terms) | ancestors)
+        assert specific == sorted(set(terms) - ancestors)
+
+
+
+@requires_scipy
+def test_ancestor_matrix():
+    parents = {'A': set(), 'B': {'A'}, 'C': {'B'}}
+    matrix = term_tables.ancestor_matrix(Closure(parents)).toarray()
+    assert matrix.tolist() == [[0, 0, 0], [1, 0, 0], [1, 1, 0]]
+
+
+
+def random_samplegroups(rng, nstudies=60):
+    """Random samplegroups sorted by study, like build_term_stats() reads them."""
+
+    dterms = [{'name': 'term %d' % i, 'ids': ['D:%d' % i]} for i in range(40)]
+    samplegroups = []
+    for study in range(nstudies):
+        for i in range(rng.randint(1, 6)):
+            samplegroups.append({
+                'study': 'SRP%03d' % study,
+                'type': rng.choice([None, 'tissue', 'cell line', 'primary cell']),
+                'sampleCount': rng.randint(1, 20),
+                'aterms': sorted(rng.sample(['A:%d' % t for t in range(25)], rng.randint(0, 6))),
+                'dterms': rng.sample(dterms, rng.randint(0, 4)),
+            })
+    return samplegroups
+
+
+
+def brute_force_summary(samplegroups, term, sampletype, top_terms):
+    """The summary of a search on one term, with the API's definition of the study order and histogram."""
+
+    studies = {}
+    samplegroupCount = 0
+    for samplegroup in samplegroups:
+        if term not in samplegroup['aterms'] or sampletype not in (None, samplegroup['type']):
+            continue
+        study = studies.setdefault(samplegroup['study'], {'sampleCount': 0, 'dterms': {}})
+        study['sampleCount'] += samplegroup['sampleCount']
+        samplegroupCount += 1
+        for dterm in samplegroup['dterms']:
+            study['dterms'][(dterm['name'], tuple(dterm['ids']))] = dterm
+
+    histogram = {}
+    for study in studies.values():
+        for key, dterm in study['dterms'].items():
+            histogram.setdefault(key, {'dterm': dterm, 'sampleCount': 0})['sampleCount'] += study['sampleCount']
+
+    return {
+        'term': term,
+        'type': sampletype,
+        'studyCount': len(studies),
+        'sampleCount': sum(study['sampleCount'] for study in studies.values()),
+        'samplegroupCount': samplegroupCount,
+        'studies': sorted(([studyID, study['sampleCount']] for (studyID, study) in studies.items()),
+            key=lambda study: (-study[1], study[0])),
+        'terms': sorted(histogram.values(), key=lambda term: (-term['sampleCount'], term['dterm']['name']))[:top_terms],
+    }
+
+
+
+@pytest.mark.parametrize('use_scipy', [False, pytest.param(True, marks=requires_scipy)])
+@pytest.mark.parametrize('term_ids', [None, ['A:3', 'A:7', 'A:99']])
+def test_term_stats_matches_brute_force(use_scipy, term_ids):
+    rng = random.Random(1)
+    samplegroups = random_samplegroups(rng)
+
+    stats = term_tables.TermStats(term_ids, batch_size=50, use_scipy=use_scipy)
+    stats.add(iter(samplegroups))
+    documents = list(stats.documents(10))
+
+    expected = []
+    for term in sorted(set(t for samplegroup in samplegroups for t in samplegroup['aterms'])):
+        if term_ids is not None and term not in term_ids:
+            continue
+        sampletypes = sorted(set(samplegroup['type'] for samplegroup in samplegroups
+            if term in samplegroup['aterms'] and samplegroup['type']))
+        for sampletype in [None] + sampletypes:
+            expected.append(brute_force_summary(samplegroups, term, sampletype, 10))
+
+    assert documents == expected
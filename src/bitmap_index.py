@@ -0,0 +1,201 @@
+"""
+In-memory bitmap index for answering MetaSRA searches without MongoDB.
+
+Every search on the samples resource is set algebra over the samplegroups
+collection: samplegroups having all of the 'and' terms in 'aterms', none of the
+'not' terms, and optionally a given sample type and study.  This index keeps a
+bitmap of samplegroup positions for every ancestral term and sample type, and
+samplegroups are numbered so each study is a contiguous range of positions.  A
+search is then a handful of bitwise AND/ANDNOT operations, and the matching
+samplegroup documents can be fetched by _id.
+
+Bitmaps are python ints, which support fast bitwise operations on arbitrarily
+many bits.  Rare terms are stored as sorted arrays of positions instead (like
+the array containers in roaring bitmaps), and turned into bitmaps when used in
+a search.  A term is stored as whichever is smaller, so the whole index takes
+at most 4 bytes per (samplegroup, ancestral term) pair.
+"""
+
+from array import array
+
+
+
+def positions_to_bitmap(positions, size):
+    """Return an int bitmap with the given bit positions set."""
+
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+
+def bitmap_positions(bitmap):
+    """Generator yielding the positions of set bits in a bitmap, in order."""
+
+    nbytes = (bitmap.bit_length() + 63) // 64 * 8
+    words = memoryview(bitmap.to_bytes(nbytes, 'little')).cast('Q')
+
+    for i, word in enumerate(words):
+        base = i * 64
+        while word:
+            lowest = word & -word
+            yield base + lowest.bit_length() - 1
+            word ^= lowest
+
+
+
+
+class SampleGroupIndex:
+    """
+    Bitmap index over samplegroups.
+
+    Construct it from an iterable of dicts with the keys '_id', 'study' (the
+    study ID), 'type' (the sample type, or None), 'aterms' and 'sampleCount',
+    sorted by study.  Samplegroups are numbered in this order, so the
+    samplegroups of each study have a contiguous range of positions.  (Or use
+    from_arrays() if the posting lists are already built.)
+    """
+
+    def __init__(self, samplegroups):
+
+        self.ids = []                   # position -> samplegroup _id
+        self.sampleCounts = array('I')  # position -> number of samples
+        self.studyIDs = []              # study number -> study ID
+        self.studyNumbers = array('I')  # position -> study number
+        self.studyRanges = {}           # study ID -> (first position, last position + 1)
+
+        postings, typePostings = {}, {}
+        for position, samplegroup in enumerate(samplegroups):
+            self.ids.append(samplegroup['_id'])
+            self.sampleCounts.append(samplegroup['sampleCount'])
+
+            studyID = samplegroup['study']
+            if not self.studyIDs or self.studyIDs[-1] != studyID:
+                if studyID in self.studyRanges:
+                    raise ValueError('Samplegroups must be sorted by study')
+                self.studyIDs.append(studyID)
+                self.studyRanges[studyID] = (position, position)
+            self.studyNumbers.append(len(self.studyIDs) - 1)
+            self.studyRanges[studyID] = (self.studyRanges[studyID][0], position + 1)
+
+            for term in samplegroup['aterms']:
+                postings.setdefault(term, array('I')).append(position)
+            if samplegroup.get('type'):
+                typePostings.setdefault(samplegroup['type'], array('I')).append(position)
+
+        self.size = len(self.ids)
+        self.terms = {term: self._compact(positions) for (term, positions) in postings.items()}
+        self.types = {sampletype: self._compact(positions) for (sampletype, positions) in typePostings.items()}
+
+
+    @classmethod
+    def from_arrays(cls, ids, sampleCounts, studyIDs, studyNumbers, termPostings, typePostings):
+        """
+        Construct the index from per-samplegroup arrays and posting lists of
+        samplegroup positions, for example from a memory-mapped snapshot.
+        The arrays are used as they are, without copying.
+        """
+
+        index = cls.__new__(cls)
+        index.ids = ids
+        index.sampleCounts = sampleCounts
+        index.studyIDs = studyIDs
+        index.studyNumbers = studyNumbers
+        index.size = len(sampleCounts)
+
+        index.studyRanges = {}
+        for position, study in enumerate(studyNumbers):
+            start = index.studyRanges.get(studyIDs[study], (position,))[0]
+            index.studyRanges[studyIDs[study]] = (start, position + 1)
+
+        index.terms = {term: index._compact(positions) for (term, positions) in termPostings.items()}
+        index.types = {sampletype: index._compact(positions) for (sampletype, positions) in typePostings.items()}
+        return index
+
+
+    def _compact(self, positions):
+        """Store a posting list as a bitmap or a sorted array, whichever is smaller."""
+
+        if len(positions) * 32 < self.size:
+            return positions
+        return positions_to_bitmap(positions, self.size)
+
+
+    def _bitmap(self, postings):
+        return postings if isinstance(postings, int) else positions_to_bitmap(postings, self.size)
+
+
+    def _cardinality(self, postings):
+        return bin(postings).count('1') if isinstance(postings, int) else len(postings)
+
+
+    def match(self, and_terms, not_terms=(), sampletype=None, studyID=None):
+        """
+        Return a bitmap of the samplegroups having all of 'and_terms' and none
+        of 'not_terms' in their ancestral terms, and the given sample type and
+        study if they aren't None.
+        """
+
+        if studyID is not None:
+            if studyID not in self.studyRanges:
+                return 0
+            start, end = self.studyRanges[studyID]
+            result = ((1 << (end - start)) - 1) << start
+        else:
+            result = (1 << self.size) - 1
+
+        filters = []
+        for term in and_terms:
+            if term not in self.terms:
+                return 0
+            filters.append(self.terms[term])
+        if sampletype is not None:
+            if sampletype not in self.types:
+                return 0
+            filters.append(self.types[sampletype])
+
+        # Intersect the smallest sets first, so we can stop early if the
+        # result is empty.
+        for postings in sorted(filters, key=self._cardinality):
+            result &= self._bitmap(postings)
+            if not result:
+                return 0
+
+        for term in not_terms:
+            if term in self.terms:
+                result &= ~self._bitmap(self.terms[term])
+
+        return result
+
+
+    def restrict_to_studies(self, bitmap, studyIDs):
+        """Return the part of a bitmap in the given studies."""
+
+        mask = 0
+        for studyID in studyIDs:
+            if studyID in self.studyRanges:
+                start, end = self.studyRanges[studyID]
+                mask |= ((1 << (end - start)) - 1) << start
+        return bitmap & mask
+
+
+    def ids_for(self, bitmap):
+        """Return the samplegroup _id's for a bitmap."""
+
+        return [self.ids[position] for position in bitmap_positions(bitmap)]
+
+
+    def study_order(self, bitmap):
+        """
+        Return a list of (study ID, sample count) tuples for the studies in a
+        bitmap, with the most samples first.
+        """
+
+        counts = {}
+        for position in bitmap_positions(bitmap):
+            study = self.studyNumbers[position]
+            counts[study] = counts.get(study, 0) + self.sampleCounts[position]
+
+        return sorted(((self.studyIDs[study], count) for (study, count) in counts.items()),
+            key=lambda study: (-study[1], study[0]))
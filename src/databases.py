@@ -0,0 +1,164 @@
+"""
+Versioned MongoDB databases, and the pointer to the one the API serves.
+
+Each build by build-db.py writes a new database named 'metaSRA_<version>'.
+An incremental build starts it from a copy of the active one.  When the build
+is finished, it switches the API over by updating a small pointer document in
+the 'databasepointers' collection of the 'metaSRA' database, which the API
+re-reads periodically.  So switching to a new
+build is one write, rolling back to the previous build is another, and the API
+never reads a database that's still being built.
+
+Pointer documents:
++ 'active': {database, version, snapshot, previous: {database, version,
+  snapshot}}, the database the API serves, and the one it replaced.
+  'snapshot' is the file name of the build's snapshot (see snapshot.py), or
+  None if it doesn't have one, so switching builds switches both together.
++ 'building': {database}, the database a build is writing to, if it hasn't
+  finished.
+
+Databases from before versioned builds have their collections in 'metaSRA'
+itself and no pointer, which is served as is.
+"""
+
+import re
+
+
+CONTROL_DATABASE = 'metaSRA'
+POINTERS_COLLECTION = 'databasepointers'
+DATABASE_PREFIX = 'metaSRA_'
+
+
+
+def pointers(client):
+    return client[CONTROL_DATABASE][POINTERS_COLLECTION]
+
+
+
+def active_database(client):
+    """
+    Return (database name, build version, snapshot file name) of the build the
+    API serves.  The version and snapshot are None if there is no pointer, in
+    which case the name is 'metaSRA' and its version is in its 'buildinfo'
+    collection.
+    """
+
+    pointer = pointers(client).find_one({'_id': 'active'})
+    if pointer is None:
+        return CONTROL_DATABASE, None, None
+    return pointer['database'], pointer['version'], pointer.get('snapshot')
+
+
+
+def building_database(client):
+    """Return the name of the database an unfinished build is writing to, or None."""
+
+    pointer = pointers(client).find_one({'_id': 'building'})
+    return pointer['database'] if pointer else None
+
+
+
+def start_build(client, version):
+    """Return the name of a new database for a build, and record it as being built."""
+
+    name = DATABASE_PREFIX + version
+    pointers(client).replace_one({'_id': 'building'}, {'_id': 'building', 'database': name}, upsert=True)
+    return name
+
+
+
+def cancel_build(client, name):
+    """Drop the database of a build that won't be activated, and its 'building' pointer."""
+
+    pointers(client).delete_one({'_id': 'building', 'database': name})
+    client.drop_database(name)
+
+
+
+def activate(client, name, version, snapshot=None):
+    """
+    Point the API at database 'name' with build 'version' and the snapshot
+    file named 'snapshot', keeping the build it replaces as the previous one
+    for rollback().  Activating the active database again just updates its
+    version and snapshot.
+    """
+
+    pointer = pointers(client).find_one({'_id': 'active'})
+    if pointer is None:
+        previous = ({'database': CONTROL_DATABASE, 'version': None, 'snapshot': None}
+            if name != CONTROL_DATABASE else None)
+    elif pointer['database'] == name:
+        previous = pointer.get('previous')
+    else:
+        previous = {'database': pointer['database'], 'version': pointer['version'],
+            'snapshot': pointer.get('snapshot')}
+
+    pointers(client).replace_one({'_id': 'active'},
+        {'_id': 'active', 'database': name, 'version': version, 'snapshot': snapshot, 'previous': previous},
+        upsert=True)
+    pointers(client).delete_one({'_id': 'building', 'database': name})
+
+
+
+def rollback(client):
+    """
+    Point the API back at the previous database and its snapshot, and return
+    the database's name.  Raises ValueError if there isn't one.
+    """
+
+    pointer = pointers(client).find_one({'_id': 'active'})
+    if pointer is None or not pointer.get('previous'):
+        raise ValueError('No previous database to roll back to')
+
+    previous = pointer['previous']
+    version = previous['version']
+    if version is None:
+        info = client[previous['database']]['buildinfo'].find_one({'_id': 'version'})
+        version = info['version'] if info else ''
+
+    pointers(client).replace_one({'_id': 'active'}, {
+        '_id': 'active',
+        'database': previous['database'],
+        'version': version,
+        'snapshot': previous.get('snapshot'),
+        'previous': {'database': pointer['database'], 'version': pointer['version'],
+            'snapshot': pointer.get('snapshot')}
+    })
+    return previous['database']
+
+
+
+def snapshot_names(client):
+    """Return the set of snapshot file names of the active and previous builds."""
+
+    names = set()
+    pointer = pointers(client).find_one({'_id': 'active'})
+    if pointer is not None:
+        names.add(pointer.get('snapshot'))
+        if pointer.get('previous'):
+            names.add(pointer['previous'].get('snapshot'))
+    names.discard(None)
+    return names
+
+
+
+def drop_old_databases(client):
+    """
+    Drop versioned databases other than the active one, the previous one and
+    one being built.  Returns the names of the dropped databases.
+    """
+
+    keep = set()
+    pointer = pointers(client).find_one({'_id': 'active'})
+    if pointer is not None:
+        keep.add(pointer['database'])
+        if pointer.get('previous'):
+            keep.add(pointer['previous']['database'])
+    keep.add(building_database(client))
+
+    dropped = []
+    for name in client.list_database_names():
+        if re.fullmatch(re.escape(DATABASE_PREFIX) + r'\d+', name) and name not in keep:
+            client.drop_database(name)
+            dropped.append(name)
+    return dropped
@@ -18,19 +18,40 @@ debug_frontend_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
 
 
 
-from bson import json_util
 from flask import Flask, request, Response
 import re
 from collections import OrderedDict # this is only to specify the sort order for mongodb query
 import csv
 from io import StringIO
+import functools
+import itertools
+import json
+import threading
+import time
+import signal
+import pickle
+import base64
+import tempfile
+
+# Make modules next to this file importable when running under uWSGI.
+import sys
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from query_cache import QueryCache, LRUCache
+from slot_locks import FileSemaphore, LocalSemaphore
+from bitmap_index import SampleGroupIndex
+from snapshot import Snapshot
+from term_index import TermIndex, depluralize
+import response_encoding
+import databases
 
 app = Flask(__name__)
 
 # Establish database connection
 from pymongo import MongoClient, ASCENDING, DESCENDING
-from pymongo.errors import OperationFailure
-db = MongoClient()['metaSRA']
+from pymongo.errors import OperationFailure, ExecutionTimeout
+# Don't connect until the first query, so that under uWSGI each worker
+# connects after it's forked: pymongo clients aren't fork-safe.
+client = MongoClient(connect=False)
 DEBUG = app.config.get('DEBUG')
 
 
@@ -39,18 +60,182 @@ urlstem = '/api/v01'
 
 
 
-def samples():
+# Cache for search results, see query_cache.py.  Set METASRA_CACHE_PATH to a
+# SQLite file to share the cache between uWSGI worker processes.
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('METASRA_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+QUERY_CACHE_TTL = int(os.environ.get('METASRA_CACHE_TTL', 24 * 60 * 60))
+query_cache = QueryCache(QUERY_CACHE_MAX_BYTES, QUERY_CACHE_TTL,
+    shared_path=os.environ.get('METASRA_CACHE_PATH'))
+
+# How often (in seconds) to check whether the database has been rebuilt.
+BUILD_VERSION_CHECK_INTERVAL = 30
+_active_db = {'current': None, 'checked': None}
+
+def active_db():
+    """
+    Return (database, build version, snapshot file name or None) of the active
+    database build, re-reading the pointer to it (see databases.py) every
+    BUILD_VERSION_CHECK_INTERVAL seconds, or after a SIGHUP.
     """
-    Get parameters from the request, and lookup matching samples in the database.
 
-    Return a python dict that looks like the JSON object to return.  (Functions
-    below handle the request/response, and converting to CSV.)
+    now = time.monotonic()
+    if _active_db['checked'] is None or now - _active_db['checked'] > BUILD_VERSION_CHECK_INTERVAL:
+        name, version, snapshot = databases.active_database(client)
+        if version is None:
+            info = client[name]['buildinfo'].find_one({'_id': 'version'})
+            version = info['version'] if info else ''
+        # Replace them all at once, so they always go together.
+        _active_db['current'] = (client[name], version, snapshot)
+        _active_db['checked'] = now
 
-    This function itself is not mapped to a URL, but it's called by functions
-    which are mapped to URL's.
+    return _active_db['current']
+
+
+def reread_active_db(signum, frame):
+    _active_db['checked'] = None
+
+try:
+    signal.signal(signal.SIGHUP, reread_active_db)
+except (ValueError, AttributeError):
+    # Not imported in the main thread, or not on Unix.
+    pass
+
+
+class ActiveDatabase:
+    """Gets collections from the active database build, as db['collection']."""
+
+    def __getitem__(self, name):
+        return active_db()[0][name]
+
+db = ActiveDatabase()
+
+
+def build_version():
+    """
+    Return the version of the database build, as written by build-db.py to the
+    'buildinfo' collection and the database pointer.  Cached results are only
+    valid for one version.
+
+    Only a build without a snapshot in its pointer, served from a snapshot
+    anyway, takes its version from the snapshot file.
+    """
+
+    database, version, snapshot = active_db()
+    if SNAPSHOT_PATH and snapshot is None:
+        return current_snapshot().version
+    return version
+
+
+
+def cached_query(function):
     """
+    Decorator for functions taking a search query from samples_query(),
+    caching their results in query_cache by the canonical search parameters.
+    """
+
+    @functools.wraps(function)
+    def wrapper(query):
+        return query_cache.get_or_compute(build_version(),
+            function.__name__ + ':' + query['key'],
+            lambda: function(query))
+
+    return wrapper
+
+
+
+# Optional memory-mapped snapshot of the database written by build-db.py, see
+# snapshot.py.  If METASRA_SNAPSHOT is set, the samples, runs and terms
+# resources are served from a snapshot instead of from MongoDB: the file named
+# in the active database pointer, in the same directory as METASRA_SNAPSHOT, or
+# METASRA_SNAPSHOT itself for builds without one.
+SNAPSHOT_PATH = os.environ.get('METASRA_SNAPSHOT')
+_snapshot = {'snapshot': None, 'file': None, 'path': None, 'checked': None}
+_snapshot_lock = threading.Lock()
+
+def snapshot_path():
+    """Return the path of the active build's snapshot file."""
+
+    snapshot = active_db()[2]
+    if snapshot is None:
+        return SNAPSHOT_PATH
+    return os.path.join(os.path.dirname(SNAPSHOT_PATH), snapshot)
+
+
+def current_snapshot():
+    """
+    Return the open Snapshot of the active build, reopening it if the build
+    has been switched, or if the file has been replaced since we last
+    checked.
+    """
+
+    path = snapshot_path()
+    now = time.monotonic()
+    if (path != _snapshot['path'] or _snapshot['checked'] is None
+            or now - _snapshot['checked'] > BUILD_VERSION_CHECK_INTERVAL):
+        with _snapshot_lock:
+            stat = os.stat(path)
+            if (path, stat.st_ino, stat.st_mtime) != _snapshot['file']:
+                _snapshot['snapshot'] = Snapshot(path)
+                _snapshot['file'] = (path, stat.st_ino, stat.st_mtime)
+            _snapshot['path'] = path
+            _snapshot['checked'] = now
+
+    return _snapshot['snapshot']
+
+
+
+# Optional in-memory bitmap index for matching searches, see bitmap_index.py.
+# Enable it by setting METASRA_BITMAP_INDEX=1.  Each worker loads it on its
+# first search (not at import, which under uWSGI runs in the master process
+# before it forks the workers), and reloads it when the database is rebuilt.
+USE_BITMAP_INDEX = os.environ.get('METASRA_BITMAP_INDEX') == '1'
+_sample_index = {'index': None, 'version': None}
+_sample_index_lock = threading.Lock()
+
+def sample_index():
+    """
+    Return the SampleGroupIndex for the current database build, or None if
+    the bitmap index isn't enabled.  It's always used with a snapshot.
+    """
+
+    if SNAPSHOT_PATH:
+        return current_snapshot().sample_index()
+
+    if not USE_BITMAP_INDEX:
+        return None
+
+    version = build_version()
+    if _sample_index['version'] != version:
+        with _sample_index_lock:
+            if _sample_index['version'] != version:
+                samplegroups = db['samplegroups'].aggregate([
+                    {'$sort': {'study.id': ASCENDING}},
+                    {'$project': {
+                        'study': '$study.id',
+                        'type': '$type.type',
+                        'aterms': True,
+                        'sampleCount': True
+                    }}
+                ], allowDiskUse=True)
+                _sample_index['index'] = SampleGroupIndex(samplegroups)
+                _sample_index['version'] = version
+
+    return _sample_index['index']
 
 
+
+def samples_query():
+    """
+    Get search parameters from the request, and build the MongoDB match query
+    for them.
+
+    Returns a python dict with the keys 'matchquery', 'skip', 'limit' and 'after', and
+    'key' which is the same for all requests for the same search no matter how
+    the parameters are ordered or paged.  The normalized search parameters are
+    also included as 'and_terms', 'not_terms', 'sampletype' and 'studyID'.  If
+    the search isn't allowed, returns a dict with an 'error' key instead.
+    """
+
     and_terms = [t.strip().upper() for t in request.args.get('and', '').split(',') if not t=='']
     not_terms = [t.strip().upper() for t in request.args.get('not', '').split(',') if not t=='']
 
@@ -77,6 +262,13 @@ def samples():
     except ValueError:
         limit = -1
 
+    # Continuation token from the 'next' field of the previous page, instead of skip.
+    after = None
+    if request.args.get('after'):
+        after = decode_page_token(request.args['after'])
+        if after is None:
+            return {'error': 'Invalid "after" argument, please use the "next" value from the previous page.'}
+
 
     # Match parameter to run against MongoDB
     matchquery = {'aterms': {'$nin': not_terms}}
@@ -86,94 +278,593 @@ def samples():
         matchquery['study.id'] = studyID.upper()
 
     if sampletype:
-        matchquery['type.type'] = re.sub(r'%20|\+', ' ', sampletype) # we want spaces instead of some other URL encodings
+        sampletype = re.sub(r'%20|\+', ' ', sampletype) # we want spaces instead of some other URL encodings
+        matchquery['type.type'] = sampletype
+
+    and_terms, not_terms = sorted(set(and_terms)), sorted(set(not_terms))
+    sampletype = sampletype or None
+    studyID = studyID.upper() if studyID else None
+    key = json.dumps([and_terms, not_terms, sampletype, studyID])
+
+    return {'matchquery': matchquery, 'key': key, 'skip': skip, 'limit': limit, 'after': after,
+        'and_terms': and_terms, 'not_terms': not_terms, 'sampletype': sampletype, 'studyID': studyID}
+
+
+
+def encode_page_token(study):
+    """
+    Encode the (study ID, sample count) tuple of the last study on a page as
+    an opaque continuation token, for getting the next page with 'after'.
+    """
+
+    return base64.urlsafe_b64encode(json.dumps([study[1], study[0]]).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    """Return the (study ID, sample count) tuple from a continuation token, or None if it's invalid."""
 
     try:
-      result = db['samplegroups'].aggregate([
+        sampleCount, studyID = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(sampleCount, int) or not isinstance(studyID, str):
+        return None
+    return (studyID, sampleCount)
+
+
+
+def page_bounds(query, studies):
+    """
+    Return the (start, end) positions of the requested page in the study order.
+
+    With a continuation token, the page starts right after the study in the
+    token.  The order is sorted by (-sampleCount, study ID), so that position
+    is found by bisection, and each page costs the same no matter how deep it
+    is.  Otherwise the page starts at 'skip'.
+    """
+
+    start = query['skip']
+    if query['after'] is not None:
+        studyID, sampleCount = query['after']
+        key = (-sampleCount, studyID)
+        start, end = 0, len(studies)
+        while start < end:
+            middle = (start + end) // 2
+            if (-studies[middle][1], studies[middle][0]) <= key:
+                start = middle + 1
+            else:
+                end = middle
+
+    start = max(start, 0)
+    end = start + query['limit'] if query['limit'] > 0 else len(studies)
+    return start, min(end, len(studies))
+
+
+
+
+# Number of studies whose sample groups are fetched from MongoDB at a time when
+# streaming a download.  This bounds the memory used by a download, no matter
+# how many samples match the search.
+STREAM_STUDY_BATCH_SIZE = 100
+
+# Streamed responses are sent in chunks of roughly this many characters.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def term_stats(query):
+    """
+    For a search on a single term, with an optional sample type, return the
+    precomputed summary of the search results from the 'termstats' collection
+    built by build-db.py.
+
+    Returns None for other searches, which have to be aggregated live.
+    """
+
+    if SNAPSHOT_PATH or len(query['and_terms']) != 1 or query['not_terms'] or query['studyID']:
+        return None
+
+    return db['termstats'].find_one({'term': query['and_terms'][0], 'type': query['sampletype']})
+
+
+
+def matching_bitmap(index, query, studyIDs=None):
+    """
+    Match the search with a SampleGroupIndex, and return the bitmap of
+    matching samplegroups, only in the given studies if 'studyIDs' isn't None.
+    """
+
+    bitmap = index.match(query['and_terms'], query['not_terms'], query['sampletype'], query['studyID'])
+    if studyIDs is not None:
+        bitmap = index.restrict_to_studies(bitmap, studyIDs)
+    return bitmap
+
+
+def matching_ids(index, query, studyIDs=None):
+    """
+    Return the _id's of samplegroups matching the search (or positions, for a
+    snapshot), only in the given studies if 'studyIDs' isn't None.
+    """
+
+    return index.ids_for(matching_bitmap(index, query, studyIDs))
+
 
-        # Use the index to find samples matching the terms-query.
-        # This has to be the first aggregation stage to utilize the index.
-        # TODO: add full-text matching here for the raw attribute text?
-        {'$match': matchquery},
 
-        {'$project': {'_id': False, 'aterms': False}},
+# Most samplegroup _id's to put in one MongoDB query.  A broad search matches
+# hundreds of thousands of samplegroups, and a list of all their _id's can be
+# bigger than MongoDB's 16MB limit on a query document, so above this the
+# search's own match query is used instead.
+SAMPLE_INDEX_MAX_IDS = int(os.environ.get('METASRA_SAMPLE_INDEX_MAX_IDS', 100000))
 
+
+def samplegroup_match(query, studyIDs=None):
+    """
+    Return the MongoDB match query for samplegroups matching the search, and
+    in the given studies if 'studyIDs' isn't None.
+
+    If the bitmap index is enabled, the search is matched in memory instead,
+    and this returns a query for the _id's of the matching samplegroups, as
+    long as there are at most SAMPLE_INDEX_MAX_IDS of them.
+    """
+
+    index = sample_index()
+    if index is not None:
+        bitmap = matching_bitmap(index, query, studyIDs)
+        if bin(bitmap).count('1') <= SAMPLE_INDEX_MAX_IDS:
+            return {'_id': {'$in': index.ids_for(bitmap)}}
+
+    matchquery = dict(query['matchquery'])
+    if studyIDs is not None:
+        matchquery['study.id'] = {'$in': list(studyIDs)}
+    return matchquery
+
+
+
+@cached_query
+def study_order(query):
+    """
+    Return a list of (study ID, sample count) tuples for all studies with
+    sample groups matching the query, sorted the same way as the studies
+    returned by samples(): most matching samples first.
+
+    This only keeps one small document per study on the server, so it's cheap
+    even for searches matching most of the database.  The study and sample
+    counts for a search are also computed from this list.
+
+    There's no index that gives this order for an arbitrary search, so unless
+    it comes from 'termstats' or the bitmap index, the first page of a search
+    still groups every matching samplegroup in MongoDB.  The list is cached,
+    so later pages (with 'skip' or 'after') only bisect it.
+    """
+
+    stats = term_stats(query)
+    if stats is not None:
+        return [tuple(study) for study in stats['studies']]
+
+    index = sample_index()
+    if index is not None:
+        return index.study_order(index.match(
+            query['and_terms'], query['not_terms'], query['sampletype'], query['studyID']))
+
+    cursor = db['samplegroups'].aggregate([
+        {'$match': query['matchquery']},
         {'$group': {
-            '_id' : '$study.id',
-            'study': {'$first': '$study'},
-            'sampleGroups': {'$push': '$$ROOT'},
-            'sampleCount': {'$sum': {'$size': '$samples'}},
-            'dterms': {'$push': '$dterms'}
+            '_id': '$study.id',
+            'sampleCount': {'$sum': '$sampleCount'}
         }},
+        {'$sort': OrderedDict([
+            ('sampleCount', -1),
+            ('_id', 1)
+        ])}
+    ], allowDiskUse=True, **time_limit(query))
+
+    return [(study['_id'], study['sampleCount']) for study in cursor]
+
+
+
+@cached_query
+def term_histogram(query):
+    """
+    Calculate the most-common display terms for the search.  Each term is
+    counted once for every sample in each matching study the term appears in.
+
+    Returns a list of {'dterm': ..., 'sampleCount': ...} objects, sorted by
+    sample count.  (For single-term searches served from the 'termstats'
+    collection, only the most-common terms are included.)
+    """
 
-        # Drop '_id',
+    stats = term_stats(query)
+    if stats is not None:
+        return stats['terms']
+
+    if SNAPSHOT_PATH:
+        snapshot = current_snapshot()
+        return snapshot.term_histogram(matching_ids(snapshot.sample_index(), query))
+
+    # Matching samples and samplegroups in each study, and whether that's all
+    # of the study's samplegroups.  Studies missing from the 'studies'
+    # collection count as partly matching, rather than being left out.
+    studies = list(db['samplegroups'].aggregate([
+        {'$match': samplegroup_match(query)},
+        {'$group': {
+            '_id': '$study.id',
+            'sampleCount': {'$sum': '$sampleCount'},
+            'samplegroupCount': {'$sum': 1}
+        }},
+        {'$lookup': {
+            'from': 'studies',
+            'localField': '_id',
+            'foreignField': '_id',
+            'as': 'studyinfo'
+        }},
+        {'$unwind': {'path': '$studyinfo', 'preserveNullAndEmptyArrays': True}},
         {'$project': {
-            '_id': False,
-            'study': True,
-            'sampleGroups': True,
             'sampleCount': True,
-            'dterms': {'$reduce': {
-                'input': '$dterms',
-                'initialValue': [],
-                'in': {'$setUnion': ['$$value', '$$this']}
-            }},
-        }},
-
-        {'$facet':{
-            'studyCount': [{'$count': 'studyCount'}],
-            'sampleCount': [{'$group': {
-                                '_id': None,
-                                'sampleCount': {'$sum': '$sampleCount'}
-                                }}],
-            'studies':
-                [
-                    {'$sort': {'sampleCount': -1}},
-                    {'$skip': skip}
-                ]
-                + ([{'$limit': limit}] if limit > 0 else []),
-
-            # Calculate most-common display terms
-            'terms': [
-                # Narrow down to these two fields so we don't eat unneccesary
-                # memory when we unwind
-                {'$project': {
-                    'dterms': True,
-                    'sampleCount': True
-                }},
-
-                # Group terms, count sample occurrences
-                {'$unwind': '$dterms'},
-                {'$group': {
-                    '_id': '$dterms',
-                    'sampleCount': {'$sum': '$sampleCount'}
-                }},
-
-                # Rearrange document shape and sort
-                {'$project': {
-                    '_id': False,
-                    'dterm': '$_id',
-                    'sampleCount': True,
-                }},
-                {'$sort': OrderedDict([
-                    ('sampleCount', -1),
-                    ('dterm.name', 1)
-                ])}
-
-            ]
+            'complete': {'$eq': ['$samplegroupCount', '$studyinfo.samplegroupCount']}
         }}
+    ], allowDiskUse=True, **time_limit(query)))
+
+    counts = {}
+    def count(dterm, sampleCount):
+        key = (dterm['name'], tuple(dterm['ids']))
+        if key in counts:
+            counts[key]['sampleCount'] += sampleCount
+        else:
+            counts[key] = {'dterm': dterm, 'sampleCount': sampleCount}
+
+    # For studies whose samplegroups all match, the union of display terms is
+    # precomputed in the 'studies' collection built by build-db.py, and all of
+    # the study's samples match.
+    complete = [study['_id'] for study in studies if study['complete']]
+    if complete:
+        for term in db['studies'].aggregate([
+            {'$match': {'_id': {'$in': complete}}},
+            {'$project': {'sampleCount': True, 'dterms': True}},
+            {'$unwind': '$dterms'},
+            {'$group': {
+                '_id': '$dterms',
+                'sampleCount': {'$sum': '$sampleCount'}
+            }}
+        ], allowDiskUse=True, **time_limit(query)):
+            count(term['_id'], term['sampleCount'])
+
+    # Only partly-matching studies need the display terms of their matching
+    # samplegroups, as distinct (study, term) pairs.
+    partial = {study['_id']: study['sampleCount'] for study in studies if not study['complete']}
+    if partial:
+        for pair in db['samplegroups'].aggregate([
+            {'$match': samplegroup_match(query, partial)},
+            {'$project': {'study.id': True, 'dterms': True}},
+            {'$unwind': '$dterms'},
+            {'$group': {'_id': {'study': '$study.id', 'dterm': '$dterms'}}}
+        ], allowDiskUse=True, **time_limit(query)):
+            count(pair['_id']['dterm'], partial[pair['_id']['study']])
+
+    return sorted(counts.values(), key=lambda term: (-term['sampleCount'], term['dterm']['name']))
+
+
+
+# Fields of samplegroups returned by the API.
+SAMPLEGROUP_PROJECTION = {'_id': False, 'aterms': False, 'sampleCount': False, 'runs': False}
+
+# Lean projections for requests that only need some of the fields.
+RUN_IDS_PROJECTION = {'_id': False, 'study.id': True, 'runs': True}
+SAMPLE_IDS_PROJECTION = {'_id': False, 'study.id': True, 'samples.id': True}
+
+
+def snapshot_samplegroup(snapshot, position, projection):
+    """Get a samplegroup from the snapshot, only reading run ID's if those are all we need."""
+
+    if projection is RUN_IDS_PROJECTION:
+        return {'study': {'id': snapshot.samplegroup_study(position)}, 'runs': snapshot.samplegroup_runs(position)}
+    return snapshot.samplegroup(position)
+
+
+
+def study_samplegroups(query, studyIDs, projection=SAMPLEGROUP_PROJECTION):
+    """
+    Generator yielding a (study, sampleGroups) tuple for each of the given
+    study ID's (in the given order) having sample groups matching the query.
+    The sample groups only have the fields in 'projection'.
+    """
+
+    if SNAPSHOT_PATH:
+        snapshot = current_snapshot()
+        cursor = (snapshot_samplegroup(snapshot, position, projection)
+            for position in matching_ids(snapshot.sample_index(), query, studyIDs))
+    else:
+        cursor = db['samplegroups'].find(samplegroup_match(query, studyIDs), projection,
+            max_time_ms=query.get('maxTimeMS'))
+
+    samplegroups = {}
+    for samplegroup in cursor:
+        samplegroups.setdefault(samplegroup['study']['id'], []).append(samplegroup)
+
+    for studyID in studyIDs:
+        sampleGroups = samplegroups.get(studyID)
+        if sampleGroups:
+            yield sampleGroups[0]['study'], sampleGroups
+
+
+
+def stream_studies(query, projection=SAMPLEGROUP_PROJECTION):
+    """
+    Generator yielding a (study, sampleGroups) tuple for each study matching
+    the query, in the same order as samples(), with the fields of the sample
+    groups in 'projection'.
+
+    Instead of grouping everything on the server, this gets the order of the
+    studies first, and then iterates a cursor over the matching sample groups
+    for a batch of studies at a time.
+    """
+
+    studies = study_order(query)
+    start, end = page_bounds(query, studies)
+    studies = studies[start:end]
+
+    for i in range(0, len(studies), STREAM_STUDY_BATCH_SIZE):
+        batch = [studyID for (studyID, sampleCount) in studies[i:i+STREAM_STUDY_BATCH_SIZE]]
+        yield from study_samplegroups(query, batch, projection)
+
+
+
+def download_studies(query, projection=SAMPLEGROUP_PROJECTION):
+    """
+    Start streaming the studies for a download, before its response starts.
+
+    The study order and the first batch of sample groups are read here, with
+    the search's time limit, so a search that takes too long gets an error
+    response instead of a file that's cut off partway.  Once the response has
+    started there's no way to tell the client something went wrong, so the
+    rest of the batches are read without a time limit.
+
+    Returns a (studies, error) tuple: an iterable of (study, sampleGroups)
+    tuples like stream_studies(), which releases the search's slot when it's
+    finished, fails or is closed, or an error response after releasing the
+    slot.  Any other error here releases the slot and is raised.
+    """
+
+    studies = stream_studies(query, projection)
+    try:
+        first = list(itertools.islice(studies, 1))
+    except ExecutionTimeout:
+        release_search(query)
+        return None, jsonresponse({'error': 'Your search took too long.  Please try a more-specific search.'}, 503)
+    except OperationFailure:
+        release_search(query)
+        return None, jsonresponse({'error': 'Your search matches too many samples and the server exceeded its memory limit.  Please try a more-specific search.'}, 503)
+    except BaseException:
+        release_search(query)
+        raise
+
+    query.pop('maxTimeMS', None)
+    return releasing(query, itertools.chain(first, studies)), None
+
+
+
+def releasing(query, iterable):
+    """
+    Generator yielding from an iterable, and releasing the search's slot
+    when it's exhausted, raises (eg if the connection to MongoDB is lost), or
+    is closed because the client went away.
+    """
+
+    try:
+        yield from iterable
+    finally:
+        release_search(query)
+
+
+
+def study_documents(query, studyIDs):
+    """
+    Return the list of study objects for one page of search results.  Each
+    has the study, its matching sample groups, the number of matching samples,
+    and the union of display terms of the sample groups.
+    """
+
+    studies = []
+    for study, sampleGroups in study_samplegroups(query, studyIDs):
+
+        # Union of display terms, keeping the first occurrence of each term
+        dterms, seen = [], set()
+        for sampleGroup in sampleGroups:
+            for dterm in sampleGroup['dterms']:
+                key = (dterm['name'], tuple(dterm['ids']))
+                if key not in seen:
+                    seen.add(key)
+                    dterms.append(dterm)
+
+        studies.append({
+            'study': study,
+            'sampleGroups': sampleGroups,
+            'sampleCount': sum(len(sampleGroup['samples']) for sampleGroup in sampleGroups),
+            'dterms': dterms,
+        })
+
+    return studies
+
+
+
+# Admission control for searches, see admit_search().  Searches estimated to
+# read more than SEARCH_LARGE_SAMPLEGROUPS samplegroups (see search_cost()), and
+# all downloads, are 'large': only a few of them run at once, so they can't hold
+# up everyone else's searches.  Summaries reading more than
+# SEARCH_MAX_SAMPLEGROUPS are rejected right away; they can be paged with
+# 'limit' or streamed as a download instead.
+#
+# The slots are lock files in METASRA_SEARCH_SLOTS_DIR (see slot_locks.py), so
+# the concurrency limits are for all of the uWSGI workers (or ASGI processes and
+# threads) on the machine together.  If it's set to an empty string, each worker
+# process has its own slots instead, which only limits anything with threads.
+SEARCH_LARGE_SAMPLEGROUPS = int(os.environ.get('METASRA_SEARCH_LARGE_SAMPLEGROUPS', 10000))
+SEARCH_MAX_SAMPLEGROUPS = int(os.environ.get('METASRA_SEARCH_MAX_SAMPLEGROUPS', 200000))
+SEARCH_CLASSES = {
+    'small': {'concurrency': int(os.environ.get('METASRA_SMALL_SEARCHES', 16)), 'maxTimeMS': 10 * 1000},
+    'large': {'concurrency': int(os.environ.get('METASRA_LARGE_SEARCHES', 2)), 'maxTimeMS': 60 * 1000},
+}
+SEARCH_SLOTS_DIR = os.environ.get('METASRA_SEARCH_SLOTS_DIR', os.path.join(tempfile.gettempdir(), 'metasra-search-slots'))
+if SEARCH_SLOTS_DIR:
+    search_slots = {name: FileSemaphore(SEARCH_SLOTS_DIR, name, c['concurrency']) for (name, c) in SEARCH_CLASSES.items()}
+else:
+    search_slots = {name: LocalSemaphore(c['concurrency']) for (name, c) in SEARCH_CLASSES.items()}
+
+# Seconds to wait for a free slot before telling the user the server is busy.
+SEARCH_QUEUE_TIMEOUT = 10
+
+
+def estimate_samplegroups(query):
+    """
+    Estimate the number of samplegroups matching a search before running it,
+    or return None if there's no way to tell.
+
+    This is the smallest number of samplegroups having any one of the 'and'
+    terms (with the sample type), from the precomputed counts in the
+    'termstats' collection, which is exact for a single term, or the number
+    of samplegroups in the study from the 'studies' collection.
+    """
+
+    estimates = []
+    if query['and_terms']:
+        counts = {stats['term']: stats['samplegroupCount'] for stats in db['termstats'].find(
+            {'term': {'$in': query['and_terms']}, 'type': query['sampletype']},
+            {'_id': False, 'term': True, 'samplegroupCount': True})}
+
+        # No counts at all for an older build without 'termstats'.
+        if counts:
+            estimates.append(min(counts.get(term, 0) for term in query['and_terms']))
+
+    if query['studyID']:
+        study = db['studies'].find_one({'_id': query['studyID']}, {'samplegroupCount': True})
+        if study is not None:
+            estimates.append(study['samplegroupCount'])
+
+    return min(estimates) if estimates else None
+
+
+def search_cost(query, summary=True):
+    """
+    Estimate how many samplegroups a request reads from MongoDB, or return
+    None if there's no way to tell.
+
+    When the study order is precomputed (in 'termstats' or the bitmap index),
+    only the page of studies is read, and the page's sample count bounds its
+    number of samplegroups, so the cost depends on 'limit'.  Counts don't read
+    any.  Otherwise the whole search is aggregated, so it costs every matching
+    samplegroup no matter how big the page is.
+    """
+
+    if sample_index() is not None or term_stats(query) is not None:
+        if not summary:
+            return 0
+        studies = study_order(query)
+        start, end = page_bounds(query, studies)
+        return sum(sampleCount for (studyID, sampleCount) in studies[start:end])
+
+    return estimate_samplegroups(query)
+
+
+def admit_search(query, summary=True, download=False):
+    """
+    Decide whether to run a search, by estimating how expensive it is.  Only
+    requests for the full summary of a search (with the term histogram and a
+    page of studies) are rejected for being too large, not downloads or
+    counts.  Downloads are always large, since they read every matching
+    samplegroup, and so is a summary without a 'limit' when we can't tell how
+    big it is.
+
+    Returns an error message if the search is rejected.  Otherwise waits for a
+    slot for the search's class, sets query['maxTimeMS'] to its time limit in
+    MongoDB and returns None, and the caller must call release_search(query)
+    when it's done.
+    """
+
+    cost = None if download else search_cost(query, summary)
+    if cost is not None and cost > SEARCH_MAX_SAMPLEGROUPS and summary:
+        return ('Your search matches about %d sample groups, which is too many to summarize at once.  '
+            'Please try a more-specific search, get fewer studies at a time with the "limit" parameter, '
+            'or download the results as a CSV file.' % cost)
+
+    if download or (cost is None and summary and query['limit'] <= 0):
+        searchclass = 'large'
+    else:
+        searchclass = 'large' if (cost or 0) > SEARCH_LARGE_SAMPLEGROUPS else 'small'
+
+    slot = search_slots[searchclass].acquire(timeout=SEARCH_QUEUE_TIMEOUT)
+    if slot is None:
+        return 'The server is busy with other searches.  Please try again in a minute.'
+
+    query['slot'] = (searchclass, slot)
+    query['maxTimeMS'] = SEARCH_CLASSES[searchclass]['maxTimeMS']
+    return None
+
+
+def release_search(query):
+    """Release the search's slot, if it still holds one, so this can be called more than once."""
+
+    if 'slot' in query:
+        searchclass, slot = query.pop('slot')
+        search_slots[searchclass].release(slot)
+
+
+def time_limit(query):
+    """Keyword arguments for MongoDB aggregations, with the search's time limit."""
+    return {'maxTimeMS': query['maxTimeMS']} if query.get('maxTimeMS') else {}
+
+
+
+def samples():
+    """
+    Get parameters from the request, and lookup matching samples in the database.
+
+    Return a python dict that looks like the JSON object to return.  (Functions
+    below handle the request/response.)
+
+    The counts, the term histogram and the page of studies are computed by
+    separate queries, so no single result document has to hold everything
+    matching the search, and paging only fetches sample groups for the page.
+    The study order and term histogram are cached for each search.
+
+    This function itself is not mapped to a URL, but it's called by functions
+    which are mapped to URL's.
+    """
+
+    query = samples_query()
+    if 'error' in query:
+        return query
+    limit = query['limit']
 
-      ]).next()
+    error = admit_search(query)
+    if error:
+        return {'error': error}
+
+    try:
+        studies = study_order(query)
+        terms = term_histogram(query)
+
+        start, end = page_bounds(query, studies)
+        page = study_documents(query, [studyID for (studyID, sampleCount) in studies[start:end]])
+    except ExecutionTimeout:
+        return {'error': 'Your search took too long.  Please try a more-specific search.'}
     except OperationFailure:
         return {'error': 'Your search matches too many samples and the server exceeded its memory limit.  Please try a more-specific search.'}
+    finally:
+        release_search(query)
 
-    # Rearrange document shape
-    result['studyCount'] = result['studyCount'][0]['studyCount'] if result['studyCount'] else 0
-    result['sampleCount'] = result['sampleCount'][0]['sampleCount'] if result['sampleCount'] else 0
+    result = {
+        'studyCount': len(studies),
+        'sampleCount': sum(sampleCount for (studyID, sampleCount) in studies),
+        'studies': page,
+        'terms': terms,
+    }
 
     # Include these so the API user is not confused by implicit limit if they didn't provide one
     if limit > 0:
         result['limit'] = limit
-    result['skip'] = skip
+    result['skip'] = start
+
+    # Continuation token for the next page
+    if end < len(studies):
+        result['next'] = encode_page_token(studies[end - 1])
 
     return result
 
@@ -184,32 +875,55 @@ def samples():
 @app.route(urlstem + '/samples')
 @app.route(urlstem + '/samples.json')
 def samplesJSON():
-    """Handle JSON request/response"""
-    return jsonresponse(samples())
-
-
-@app.route(urlstem + '/samples.csv')
-def samplesCSV():
-    """Convert data to CSV and return response"""
+    """
+    Handle JSON request/response.  The studies are encoded one at a time
+    while the response is sent.
+    """
 
     result = samples()
-    if 'error' in result:
+    if 'studies' not in result:
         return jsonresponse(result)
 
+    return Response(response_encoding.stream_json(result, 'studies', STREAM_CHUNK_SIZE),
+        mimetype='application/json')
+
+
+def stream_csv(rows):
+    """
+    Generator encoding an iterable of rows as CSV text, in chunks of roughly
+    STREAM_CHUNK_SIZE characters, to use as the body of a streamed response.
+    """
+
     csvfile = StringIO()
     writer = csv.writer(csvfile)
 
+    for row in rows:
+        writer.writerow(row)
+        if csvfile.tell() >= STREAM_CHUNK_SIZE:
+            yield csvfile.getvalue()
+            csvfile.seek(0)
+            csvfile.truncate()
+
+    yield csvfile.getvalue()
+
+
+
+def sample_rows(studies):
+    """
+    Rows for the samples CSV file, with one row for each sample.  'studies' is
+    an iterable of (study, sampleGroups) tuples as yielded by stream_studies().
+    """
+
     # Header
-    writer.writerow(['study_id', 'study_title', 'sample_id', 'sample_name', 'sample_type',
-        'sample_type_confidence', 'mapped_ontology_ids', 'mapped_ontology_terms', 'raw_SRA_metadata',])
+    yield ['study_id', 'study_title', 'sample_id', 'sample_name', 'sample_type',
+        'sample_type_confidence', 'mapped_ontology_ids', 'mapped_ontology_terms', 'raw_SRA_metadata',]
 
-    # Write a row for each sample
-    for study in result['studies']:
-        for sampleGroup in study['sampleGroups']:
+    for study, sampleGroups in studies:
+        for sampleGroup in sampleGroups:
             for sample in sampleGroup['samples']:
-                writer.writerow([
-                    study['study']['id'],
-                    study['study']['title'],
+                yield [
+                    study['id'],
+                    study['title'],
                     sample['id'],
                     sample.get('name', ''),
                     sampleGroup['type']['type'],
@@ -217,47 +931,156 @@ def samplesCSV():
                     ', '.join([', '.join(term['ids']) for term in sampleGroup['dterms']]),
                     ', '.join([term['name'] for term in sampleGroup['dterms']]),
                     '; '.join([': '.join(attr) for attr in sampleGroup['attr']]),
-                ])
-
-    return Response(csvfile.getvalue(), mimetype='text/csv',
-        headers={"Content-disposition": "attachment; filename=metaSRA-samples.csv"})
+                ]
 
 
 
-@app.route(urlstem + '/runs.csv')
-def experimentCSV():
+def run_rows(studies):
     """
-    CSV file of search results with one run per line.
+    Rows for the runs CSV file, with one row for each run.  'studies' is
+    an iterable of (study, sampleGroups) tuples as yielded by stream_studies().
     """
 
-    result = samples()
-    if 'error' in result:
-        return jsonresponse(result)
-
-    csvfile = StringIO()
-    writer = csv.writer(csvfile)
-
     # Header
-    writer.writerow(['sra_study_id', 'study_title', 'sra_sample_id', 'sample_name', 'sra_experiment_id', 'sra_run_id'])
+    yield ['sra_study_id', 'study_title', 'sra_sample_id', 'sample_name', 'sra_experiment_id', 'sra_run_id']
 
-    # Write one row for each run
-    for study in result['studies']:
-        for sampleGroup in study['sampleGroups']:
+    for study, sampleGroups in studies:
+        for sampleGroup in sampleGroups:
             for sample in sampleGroup['samples']:
                 for experiment in sample['experiments']:
                     for run in experiment['runs']:
-                        writer.writerow([
-                            study['study']['id'],
-                            study['study']['title'],
+                        yield [
+                            study['id'],
+                            study['title'],
                             sample['id'],
                             sample.get('name', ''),
                             experiment['id'],
                             run
-                        ])
+                        ]
+
+
+
+@app.route(urlstem + '/samples.csv')
+def samplesCSV():
+    """
+    CSV file of search results with one sample per line.  The file is streamed
+    to the client while matching sample groups are read from the database.
+    """
+
+    query = samples_query()
+    if 'error' in query:
+        return jsonresponse(query)
+
+    error = admit_search(query, summary=False, download=True)
+    if error:
+        return jsonresponse({'error': error})
+
+    studies, error = download_studies(query)
+    if error:
+        return error
+
+    response = Response(stream_csv(sample_rows(studies)), mimetype='text/csv',
+        headers={"Content-disposition": "attachment; filename=metaSRA-samples.csv"})
+
+    # Hold the search's slot until the download is finished, or until the
+    # response is closed, in case it's closed before the body is started.
+    response.call_on_close(lambda: release_search(query))
+    return response
+
+
 
-    return Response(csvfile.getvalue(), mimetype='text/csv',
+@app.route(urlstem + '/runs.csv')
+def experimentCSV():
+    """
+    CSV file of search results with one run per line.  The file is streamed
+    to the client while matching sample groups are read from the database.
+    """
+
+    query = samples_query()
+    if 'error' in query:
+        return jsonresponse(query)
+
+    error = admit_search(query, summary=False, download=True)
+    if error:
+        return jsonresponse({'error': error})
+
+    studies, error = download_studies(query)
+    if error:
+        return error
+
+    response = Response(stream_csv(run_rows(studies)), mimetype='text/csv',
         headers={"Content-disposition": "attachment; filename=metaSRA-runs.csv"})
 
+    # Hold the search's slot until the download is finished, or until the
+    # response is closed, in case it's closed before the body is started.
+    response.call_on_close(lambda: release_search(query))
+    return response
+
+
+
+
+def stream_lines(lines):
+    """
+    Generator joining lines of text into chunks of roughly STREAM_CHUNK_SIZE
+    characters, to use as the body of a streamed response.
+    """
+
+    chunk, size = [], 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line) + 1
+        if size >= STREAM_CHUNK_SIZE:
+            yield '\n'.join(chunk) + '\n'
+            chunk, size = [], 0
+
+    yield '\n'.join(chunk)
+
+
+
+def run_ids(studies):
+    """Run ID's of an iterable of (study, sampleGroups) tuples with the RUN_IDS_PROJECTION fields."""
+
+    for study, sampleGroups in studies:
+        for sampleGroup in sampleGroups:
+            yield from sampleGroup['runs']
+
+
+
+def sample_ids(studies):
+    """Sample ID's of an iterable of (study, sampleGroups) tuples with the SAMPLE_IDS_PROJECTION fields."""
+
+    for study, sampleGroups in studies:
+        for sampleGroup in sampleGroups:
+            for sample in sampleGroup['samples']:
+                yield sample['id']
+
+
+
+def stream_ids(ids, projection, filename):
+    """
+    Streamed response with line-delimited ID's of the search results, only
+    reading the fields in 'projection' of the matching sample groups.
+    """
+
+    query = samples_query()
+    if 'error' in query:
+        return jsonresponse(query)
+
+    error = admit_search(query, summary=False, download=True)
+    if error:
+        return jsonresponse({'error': error})
+
+    studies, error = download_studies(query, projection)
+    if error:
+        return error
+
+    response = Response(stream_lines(ids(studies)), mimetype='text',
+        headers={"Content-disposition": "attachment; filename=" + filename})
+
+    # Hold the search's slot until the download is finished, or until the
+    # response is closed, in case it's closed before the body is started.
+    response.call_on_close(lambda: release_search(query))
+    return response
 
 
 
@@ -267,21 +1090,48 @@ def runIDs():
     API resource returning a list of line-delimited run ID's.
     """
 
-    result = samples()
-    if 'error' in result:
-        return jsonresponse(result)
+    return stream_ids(run_ids, RUN_IDS_PROJECTION, 'metaSRA-runs.ids.txt')
 
-    ids = []
 
-    for study in result['studies']:
-        for sampleGroup in study['sampleGroups']:
-            for sample in sampleGroup['samples']:
-                for experiment in sample['experiments']:
-                    for run in experiment['runs']:
-                        ids.append(run)
 
-    return Response('\n'.join(ids), mimetype='text',
-        headers={"Content-disposition": "attachment; filename=metaSRA-runs.ids.txt"})
+@app.route(urlstem + '/samples.ids.txt')
+def sampleIDs():
+    """
+    API resource returning a list of line-delimited sample ID's.
+    """
+
+    return stream_ids(sample_ids, SAMPLE_IDS_PROJECTION, 'metaSRA-samples.ids.txt')
+
+
+
+@app.route(urlstem + '/samples.counts.json')
+def sampleCounts():
+    """
+    API resource returning only the numbers of studies and samples matching a
+    search, without the term histogram or any sample groups.
+    """
+
+    query = samples_query()
+    if 'error' in query:
+        return jsonresponse(query)
+
+    error = admit_search(query, summary=False)
+    if error:
+        return jsonresponse({'error': error})
+
+    try:
+        studies = study_order(query)
+    except ExecutionTimeout:
+        return jsonresponse({'error': 'Your search took too long.  Please try a more-specific search.'})
+    except OperationFailure:
+        return jsonresponse({'error': 'Your search matches too many samples and the server exceeded its memory limit.  Please try a more-specific search.'})
+    finally:
+        release_search(query)
+
+    return jsonresponse({
+        'studyCount': len(studies),
+        'sampleCount': sum(sampleCount for (studyID, sampleCount) in studies),
+    })
 
 
 
@@ -314,7 +1164,144 @@ def get_tokens(text):
 
 
 
-def lookupterms(q_remove_trailing_s=False):
+# In-memory autocomplete index of the terms collection, see term_index.py.  It's
+# used unless METASRA_TERM_INDEX=0 (and always used with a snapshot.)  Like the
+# bitmap index, each worker loads it on first use.
+USE_TERM_INDEX = os.environ.get('METASRA_TERM_INDEX', '1') == '1'
+_term_index = {'index': None, 'version': None}
+_term_index_lock = threading.Lock()
+
+def term_index():
+    """
+    Return the TermIndex for the current database build, or None if the
+    term index isn't enabled.
+    """
+
+    if not (USE_TERM_INDEX or SNAPSHOT_PATH):
+        return None
+
+    version = build_version()
+    if _term_index['version'] != version:
+        with _term_index_lock:
+            if _term_index['version'] != version:
+                terms = current_snapshot().terms() if SNAPSHOT_PATH else db['terms'].find()
+                index = TermIndex(terms)
+                index.load_completions(current_snapshot().term_prefixes() if SNAPSHOT_PATH
+                    else db['termprefixes'].find())
+                _term_index['index'] = index
+                _term_index['version'] = version
+
+    return _term_index['index']
+
+
+
+# Without the term index, keep term documents looked up by ID in a cache in
+# each worker, bounded by size in bytes.  It's filled as terms are looked up,
+# and flushed when the database build changes, since term documents only
+# change then.
+TERM_CACHE_MAX_BYTES = int(os.environ.get('METASRA_TERM_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+term_cache = LRUCache(TERM_CACHE_MAX_BYTES, QUERY_CACHE_TTL)
+_term_cache_version = {'version': None}
+
+# Maximum number of term ID's in one batch lookup.
+MAX_BATCH_TERM_IDS = 10000
+
+TERM_PROJECTION = {'_id': False, 'nametokens': False, 'tokens': False}
+
+
+def cached_terms(termIDs):
+    """
+    Return a dict of term ID -> term document (with its score) for the given
+    term ID's, from the term cache or else from Mongo.
+    """
+
+    version = build_version()
+    if _term_cache_version['version'] != version:
+        term_cache.clear()
+        _term_cache_version['version'] = version
+
+    terms, missing = {}, []
+    for termID in set(termIDs):
+        value = term_cache.get(termID)
+        if value is None:
+            missing.append(termID)
+        else:
+            terms[termID] = pickle.loads(value)
+
+    if missing:
+        for term in db['terms'].find({'ids': {'$in': missing}}, TERM_PROJECTION):
+            value = pickle.dumps(term, pickle.HIGHEST_PROTOCOL)
+            for termID in term['ids']:
+                term_cache.set(termID, value)
+                terms[termID] = term
+
+        # Remember ID's without a term too, so they aren't looked up again.
+        for termID in missing:
+            if termID not in terms:
+                term_cache.set(termID, pickle.dumps(None))
+                terms[termID] = None
+
+    return {termID: term for (termID, term) in terms.items() if term is not None}
+
+
+def without_score(term):
+    return {k: v for (k, v) in term.items() if k != 'score'}
+
+
+def lookup_term_ids(termIDs, limit):
+    """
+    Return up to 'limit' distinct term documents having any of the given term
+    ID's, sorted by score, from the term index or else the term cache.
+    """
+
+    index = term_index()
+    if index is not None:
+        return index.search(None, termIDs, limit)
+
+    terms = {}
+    for term in cached_terms(termIDs).values():
+        terms[term['ids'][0]] = term
+
+    best = sorted(terms.values(), key=lambda term: (term.get('score', 0), term['name']))[:limit]
+    return [without_score(term) for term in best]
+
+
+
+
+def prefix_match_count(field, querytokens):
+    """
+    MongoDB aggregation expression counting how many of the query tokens are
+    at the start of a token in the given array field.
+    """
+
+    # Iterate over user-provided tokens, counting how many of them are
+    # contained in the term's tokens.
+    return {'$sum': [
+        {'$cond': {
+            'if': { '$size':{
+                # Filter the list of term tokens to those matching the user-provided token
+                '$filter': {
+                    'input': field,
+                    'as': 'termtoken',
+                    'cond': {'$ne': [-1,
+
+                        # Mongodb 3.4 doesn't support regular expressions in the project
+                        # stage of the aggregation pipeline, so we have to use the synonym_string
+                        # indexOf method.  The last 2 arguments restrict it to checking the beginning
+                        # of the string only.
+                        {'$indexOfBytes': ['$$termtoken', querytoken, 0, len(querytoken)]}
+                    ]}
+                }
+            }},
+            'then': 1,
+            'else': 0
+        }}
+        for querytoken in querytokens
+    ]}
+
+
+
+def lookupterms():
     """
     Looks up ontology terms, returning python object shaped like the JSON to return.
     Returns records from the 'terms' collection, which represent distinct term names
@@ -323,9 +1310,9 @@ def lookupterms(q_remove_trailing_s=False):
     Can take 2 parameters, 'q' for text-searching (meant for the autocomplete
     function,) and 'id' which is a comma-separated list of ontology ID's.
 
-    If the q_remove_trailing_s flag is true, remove the trailing s/S from all tokens
-    in the search string (to depluralize, since users often type plurals but the
-    ontology terms are mostly singular.)
+    Query tokens also match with trailing s/S characters removed, so a search on
+    "neurons" will match "neuron" too.  Terms matching all of the tokens as
+    typed are ranked before terms only matching the depluralized tokens.
 
     This function itself is not mapped to a URL, but it is called by functions
     which are mapped to URL's.
@@ -341,7 +1328,7 @@ def lookupterms(q_remove_trailing_s=False):
         try:
             limit = int(limit)
         except:
-            return {'error': 'Limit argument must be an integer.', terms:[]}
+            return {'error': 'Limit argument must be an integer.', 'terms':[]}
 
 
     if not limit or limit > 500:
@@ -351,65 +1338,71 @@ def lookupterms(q_remove_trailing_s=False):
     if not (q or id):
         return {'error' : 'Please enter some query terms', 'terms':[]}
 
+    tokens = get_tokens(q) if q else None
+    ids = id.split(',') if id else None
+
+    index = term_index()
+    if index is not None:
+        return {'terms': index.search(tokens, ids, limit)}
+
+    if not q:
+        return {'terms': lookup_term_ids(ids, limit)}
+
+    # Look up precomputed completions for searches on a short prefix (see
+    # build_term_prefixes() in build-db.py), unless they might have been cut
+    # off before the limit.  If any of the completed terms are missing (the
+    # completions are from a different build of the terms), rank them live.
+    if tokens is not None and len(tokens) == 1 and not ids:
+        completion = db['termprefixes'].find_one({'_id': next(iter(tokens))})
+        if completion and (completion['complete'] or limit <= len(completion['ids'])):
+            termIDs = completion['ids'][:limit]
+            terms = cached_terms(termIDs)
+            if all(termID in terms for termID in termIDs):
+                return {'terms': [dict(without_score(terms[termID]), namematch=namematch)
+                    for (termID, namematch) in zip(termIDs, completion['namematch'])]}
+
     # Building components to query against the terms collection in Mongo
     query = {}
-    sortpipeline = [{'$sort': {'score': ASCENDING}}]
+    sortpipeline = [{'$sort': OrderedDict([('score', ASCENDING), ('name', ASCENDING)])}]
 
 
 
     if q:
+        stripped_tokens = [depluralize(token) for token in tokens]
 
         # Restrict terms to those having tokens prefixed by all of the
-        # user-entered tokens.  Mongodb can use indexes for regex prefix queries.
-        tokens = get_tokens(q)
+        # depluralized user-entered tokens (which are prefixes of the tokens
+        # as typed.)  Mongodb can use indexes for regex prefix queries.
+        query['$and'] = [{'tokens': {'$regex': '^'+token}} for token in stripped_tokens]
 
-        # Remove s or S from the end of all tokens if passed the q_remove_trailing_s flag.
-        if q_remove_trailing_s:
-            tokens = [token.rstrip('sS') for token in tokens]
-
-        query['$and'] = [{'tokens': {'$regex': '^'+token}} for token in tokens]
-
-        # This whole thing is to show first the terms that have the user's query
-        # in the name of the term instead of just the synonyms.
+        # This whole thing is to show first the terms that match the user's
+        # query as typed, and then the terms that have the user's query in the
+        # name of the term instead of just the synonyms.
         sortpipeline = [
 
+            # Does the term match all of the user's tokens as typed?
+            {'$addFields': {
+                'exactmatch': {'$eq': [prefix_match_count('$tokens', tokens), len(tokens)]}
+            }},
+
             # This pipeline stage adds a 'namematch' field counting the
             # occurrences of the user's entered tokens in the term name
             {'$addFields': {
-                'namematch' : {
-
-                    # Iterate over user-provided tokens, counting how many of them are
-                    # contained in the term's name tokens.
-                    '$sum' : [
-                        {'$cond': {
-                            'if': { '$size':{
-                                # Filter the list of term-name tokens to those matching the user-provided token
-                                '$filter': {
-                                    'input': '$nametokens',
-                                    'as': 'nametoken',
-                                    'cond': {'$ne': [-1,
-
-                                        # Mongodb 3.4 doesn't support regular expressions in the project
-                                        # stage of the aggregation pipeline, so we have to use the synonym_string
-                                        # indexOf method.  The last 2 arguments restrict it to checking the beginning
-                                        # of the string only.
-                                        {'$indexOfBytes': ['$$nametoken', querytoken, 0, len(querytoken)]}
-                                    ]}
-                                }
-                            }},
-                            'then': 1,
-                            'else': 0
-                        }}
-                        for querytoken in tokens
-                    ]
-                }
+                'namematch': {'$cond': {
+                    'if': '$exactmatch',
+                    'then': prefix_match_count('$nametokens', tokens),
+                    'else': prefix_match_count('$nametokens', stripped_tokens)
+                }}
             }},
 
-            # Sort first by the number of times the user's tokens occur in the
-            # term name, then by score (term name length)
+            # Sort first by exact matches, then the number of times the user's
+            # tokens occur in the term name, then by score (term name length),
+            # then by name like the term index
             {'$sort': OrderedDict([
+                ('exactmatch', DESCENDING),
                 ('namematch', DESCENDING),
-                ('score', ASCENDING)
+                ('score', ASCENDING),
+                ('name', ASCENDING)
             ])},
         ]
 
@@ -417,7 +1410,7 @@ def lookupterms(q_remove_trailing_s=False):
 
     # Filter by user-provided ID's
     if id:
-        query['ids'] = {'$in': id.split(',')}
+        query['ids'] = {'$in': ids}
 
 
 
@@ -442,6 +1435,7 @@ def lookupterms(q_remove_trailing_s=False):
                 'nametokens': False,
                 'score': False,
                 'tokens': False,
+                'exactmatch': False,
             }}
         ]
     )
@@ -456,28 +1450,72 @@ def terms_json():
     """
     API resouce for terms.  Looks up terms and returns a JSON response.
 
-    This funciton is essentially a wrapper around lookupterms().  If lookupterms()
-    returns no results, it tries calling lookupterms() again with a flag to remove
-    trailing s/S characters from query tokens.  This is so a search on "neurons"
-    will match "neuron" also.
+    This funciton is essentially a wrapper around lookupterms().
     """
 
-    terms = lookupterms()
+    return jsonresponse(lookupterms())
 
-    # If there are no terms, try searching again with trailing s/S characters
-    # removed from the tokens of the search string.
-    if 'error' not in terms and not len(terms.get('terms')):
-        terms = lookupterms(q_remove_trailing_s=True)
 
-    return jsonresponse(terms)
 
+@app.route(urlstem + '/terms', methods=['POST'])
+def terms_batch_json():
+    """
+    API resource for looking up many terms by ID at once, eg all of the display
+    terms on a page of search results.  Takes a JSON object with a list of
+    term ID's as 'ids' (or the comma-separated 'id' parameter like the GET
+    version) and returns the distinct terms having any of them.
+    """
+
+    body = request.get_json(silent=True) or {}
+    ids = body.get('ids')
+    if ids is None:
+        id = request.values.get('id')
+        ids = id.split(',') if id else []
 
+    if not isinstance(ids, list) or not all(isinstance(termID, str) for termID in ids):
+        return jsonresponse({'error': 'ids must be a list of term ID strings.', 'terms': []})
+    if not ids:
+        return jsonresponse({'error': 'Please enter some term ID\'s', 'terms': []})
+    if len(ids) > MAX_BATCH_TERM_IDS:
+        return jsonresponse({'error': 'Too many term ID\'s, the maximum is %d.' % MAX_BATCH_TERM_IDS, 'terms': []})
 
+    return jsonresponse({'terms': lookup_term_ids(ids, len(ids))})
 
 
-def jsonresponse(obj):
+
+
+
+def jsonresponse(obj, status=200):
     """Useing this instead of Flask's JSONify because of MongoDB BSON encoding"""
-    return Response(json_util.dumps(obj), mimetype='application/json')
+    return Response(response_encoding.dumps(obj), status=status, mimetype='application/json')
+
+
+
+# Compress responses of these types, if they're streamed or at least
+# COMPRESS_MIN_BYTES long and the client accepts a compressed encoding.
+COMPRESS_MIMETYPES = set(['application/json', 'text/csv', 'text'])
+COMPRESS_MIN_BYTES = 1024
+
+@app.after_request
+def compress_response(response):
+    """Compress the response with the best content encoding the client accepts."""
+
+    if (response.status_code != 200 or response.mimetype not in COMPRESS_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and (response.content_length or 0) < COMPRESS_MIN_BYTES:
+        return response
+
+    encoding = response_encoding.negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    response.response = response_encoding.compress(response.iter_encoded(), encoding)
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    return response
 
 
 
@@ -0,0 +1,183 @@
+"""
+ASGI serving mode for the MetaSRA API.
+
+Under uWSGI, every request holds a worker process until it's done, so a few
+slow searches on broad terms can use up all the workers while autocomplete
+requests wait behind them.  This module serves the same Flask app from
+metasra_api.py on an asyncio event loop, with separate thread pools for
+searches and for term lookups, so a slow search only ever holds a search
+thread.  Routes and responses are exactly the same as the Flask app's.
+
+To run it (uvicorn isn't in requirements.txt, since uWSGI deployments don't
+need it):
+$ pip install uvicorn
+$ cd src
+$ uvicorn metasra_asgi:app --workers 4 --port 5000
+
+The thread pools are sized by the environment variables
+METASRA_ASGI_SEARCH_THREADS and METASRA_ASGI_TERMS_THREADS.  Whether this
+is faster than uWSGI on a real database hasn't been measured yet; see
+benchmarks/load.py to measure throughput and latency under mixed traffic.
+"""
+
+import asyncio
+import io
+import os
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import metasra_api
+
+
+# Searches and downloads block on MongoDB (or scan the snapshot) for up to a
+# few seconds, so only this many run at once in each process.  Term lookups
+# get their own pool, so they never wait behind searches.
+SEARCH_THREADS = int(os.environ.get('METASRA_ASGI_SEARCH_THREADS', 4))
+TERMS_THREADS = int(os.environ.get('METASRA_ASGI_TERMS_THREADS', 8))
+
+executors = {
+    'search': ThreadPoolExecutor(SEARCH_THREADS, thread_name_prefix='search'),
+    'terms': ThreadPoolExecutor(TERMS_THREADS, thread_name_prefix='terms'),
+}
+
+
+
+def request_class(path):
+    """Return the name of the thread pool to handle a request path in."""
+
+    if path.startswith(metasra_api.urlstem + '/terms'):
+        return 'terms'
+    return 'search'
+
+
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ for the Flask app from an ASGI HTTP scope."""
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        elif 'HTTP_' + name in environ:
+            environ['HTTP_' + name] += ',' + value
+        else:
+            environ['HTTP_' + name] = value
+
+    return environ
+
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+
+async def lifespan(receive, send):
+    """Acknowledge the server's startup and shutdown events."""
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for executor in executors.values():
+                executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+
+async def send_error(send):
+    """Send a 500 response, for when the Flask app fails before starting its own."""
+
+    await send({'type': 'http.response.start', 'status': 500,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application.  Runs the Flask app in the thread pool for the request's
+    class, and streams the response back chunk by chunk, so downloads are
+    still streamed without holding the event loop.
+    """
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    loop = asyncio.get_running_loop()
+    executor = executors[request_class(scope['path'])]
+    environ = wsgi_environ(scope, await read_body(receive))
+
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+            for (name, value) in headers]
+
+    def run():
+        # Get the first chunk here too, since a streaming response doesn't do
+        # any of the work until it's iterated.  If that fails, close the
+        # response here, since nothing else will: closing it is what releases
+        # a download's search slot (see samplesCSV() in metasra_api.py.)
+        iterable = metasra_api.app.wsgi_app(environ, start_response)
+        try:
+            iterator = iter(iterable)
+            return iterable, iterator, next(iterator, None)
+        except BaseException:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            raise
+
+    try:
+        iterable, iterator, chunk = await loop.run_in_executor(executor, run)
+    except Exception:
+        traceback.print_exc()
+        return await send_error(send)
+
+    if 'status' not in response:
+        # The app returned without starting the response.
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(executor, iterable.close)
+        return await send_error(send)
+
+    try:
+        await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(iterable, 'close'):
+            await loop.run_in_executor(executor, iterable.close)
@@ -0,0 +1,228 @@
+"""
+Cache for search results in the MetaSRA API.
+
+Users page through the same search repeatedly, and then download it as CSV
+files, so the API caches the expensive parts of a search (the study order and
+the term histogram) keyed by the canonical search parameters.
+
+There are two levels:
++ An in-process LRU cache, bounded by the total size in bytes of the cached
+        values, with a time-to-live for each entry.
++ An optional SQLite file shared by all the uWSGI worker processes on the
+        machine, so a search computed by one worker can be served by another.
+
+Every entry is tagged with the version of the database build it was computed
+from.  When the API sees a new build version, everything cached for older
+versions is thrown away.
+
+Values are stored pickled, so their size is known exactly and they can be
+shared through SQLite.
+"""
+
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by the total number of bytes in its
+    values.  Values are bytes objects.  Entries older than 'ttl' seconds are
+    treated as missing.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict() # key -> (expiration time, value)
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """Return the value for 'key', or None if it isn't cached."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.time():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+
+    def set(self, key, value):
+        """Cache 'value', evicting the least-recently used entries if we're over the size limit."""
+
+        # Don't let one huge value flush the whole cache.
+        if len(value) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.size += len(value)
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+    def _remove(self, key):
+        expires, value = self.entries.pop(key)
+        self.size -= len(value)
+
+
+
+
+class SQLiteCache:
+    """
+    Cache stored in a SQLite file, so it can be shared between processes.
+    Bounded by the total number of bytes in its values, evicting the
+    least-recently used entries first, and with a time-to-live for each entry.
+    """
+
+    # Check the total size of the cache after this many inserts.
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.inserts = 0
+        self.local = threading.local()
+
+
+    def connection(self):
+        """
+        Return a connection for this thread and process.  Connections can't
+        be shared between threads, or used after uWSGI forks the worker.
+        """
+
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    version TEXT,
+                    expires REAL,
+                    accessed REAL,
+                    value BLOB
+                )
+            """)
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return self.local.conn
+
+
+    def get(self, key, version):
+        conn = self.connection()
+        row = conn.execute('SELECT value FROM cache WHERE key = ? AND version = ? AND expires > ?',
+            (key, version, time.time())).fetchone()
+        if row is None:
+            return None
+
+        conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), key))
+        return bytes(row[0])
+
+
+    def set(self, key, version, value):
+        if len(value) > self.max_bytes:
+            return
+
+        conn = self.connection()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+            (key, version, now + self.ttl, now, value))
+
+        self.inserts += 1
+        if self.inserts % self.PRUNE_INTERVAL == 0:
+            self.prune(version)
+
+
+    def prune(self, version):
+        """
+        Delete entries that are expired or from other database builds, then
+        the least-recently used ones until we're under the size limit.
+        """
+
+        conn = self.connection()
+        conn.execute('DELETE FROM cache WHERE version != ? OR expires <= ?', (version, time.time()))
+
+        size = conn.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache').fetchone()[0]
+        if size <= self.max_bytes:
+            return
+
+        cursor = conn.execute('SELECT key, LENGTH(value) FROM cache ORDER BY accessed')
+        stale = []
+        for key, length in cursor:
+            if size <= self.max_bytes:
+                break
+            stale.append((key,))
+            size -= length
+        cursor.close()
+        conn.executemany('DELETE FROM cache WHERE key = ?', stale)
+
+
+
+
+class QueryCache:
+    """
+    Two-level cache for search results: an in-process LRUCache in front of an
+    optional shared SQLiteCache.
+    """
+
+    def __init__(self, max_bytes, ttl, shared_path=None):
+        self.local = LRUCache(max_bytes, ttl)
+        self.shared = SQLiteCache(shared_path, max_bytes, ttl) if shared_path else None
+        self.version = None
+
+
+    def get_or_compute(self, version, key, compute):
+        """
+        Return the cached value for 'key' computed from database build
+        'version', or call compute() to get the value and cache it.
+        """
+
+        version = str(version)
+
+        # Flush everything from the previous build.
+        if version != self.version:
+            self.local.clear()
+            if self.shared:
+                self.shared.prune(version)
+            self.version = version
+
+        value = self.local.get(key)
+        if value is None and self.shared:
+            value = self.shared.get(key, version)
+            if value is not None:
+                self.local.set(key, value)
+
+        if value is not None:
+            return pickle.loads(value)
+
+        result = compute()
+
+        value = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        self.local.set(key, value)
+        if self.shared:
+            self.shared.set(key, version, value)
+
+        return result
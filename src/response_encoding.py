@@ -0,0 +1,156 @@
+"""
+JSON serialization and compressed content encodings for API responses.
+
+Search results can be tens of megabytes of JSON.  bson.json_util.dumps walks
+the whole result in python to convert BSON types before encoding it, so
+instead this only calls json_util's converter for the values the JSON encoder
+doesn't know (eg ObjectId's), and uses orjson if it's installed.
+
+Responses are compressed with the best encoding the client accepts: zstd and
+brotli if the 'zstandard' and 'brotli' packages are installed, and gzip.
+Streamed responses are compressed and flushed chunk by chunk as they're sent.
+"""
+
+import json
+import zlib
+
+from bson import json_util
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+
+def dumps(obj):
+    """Encode an object as compact JSON text, converting BSON types like json_util does."""
+
+    if orjson is not None:
+        return orjson.dumps(obj, default=json_util.default).decode('utf-8')
+    return json.dumps(obj, default=json_util.default, separators=(',', ':'))
+
+
+
+def stream_json(obj, key, chunk_size):
+    """
+    Generator encoding a dict as JSON text in chunks of roughly 'chunk_size'
+    characters, encoding the list under 'key' one item at a time, so the whole
+    text is never in memory at once.  The list comes last in the object.
+    """
+
+    rest = dumps({k: v for (k, v) in obj.items() if k != key})
+    chunk = [rest[:-1], ',' if len(rest) > 2 else '', json.dumps(key), ':[']
+    size = len(rest)
+
+    for i, item in enumerate(obj[key]):
+        text = dumps(item)
+        chunk.append(',' + text if i else text)
+        size += len(text)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+
+    chunk.append(']}')
+    yield ''.join(chunk)
+
+
+
+
+# Each compressor's compress() flushes its output, so a client can decode all
+# of a streamed response it has received so far, rather than the compressor
+# holding back data until it has enough to fill a block.
+
+class _GzipCompressor:
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+
+class _ZstdCompressor:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+
+class _BrotliCompressor:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+
+# Supported content encodings, in order of preference.
+COMPRESSORS = [('gzip', _GzipCompressor)]
+if brotli is not None:
+    COMPRESSORS.insert(0, ('br', _BrotliCompressor))
+if zstandard is not None:
+    COMPRESSORS.insert(0, ('zstd', _ZstdCompressor))
+
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Return the name of the preferred content encoding accepted by the client,
+    given its Accept-Encoding header, or None to send the response as it is.
+    """
+
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+
+    for name, compressor in COMPRESSORS:
+        if accepted.get(name, accepted.get('*', 0)) > 0:
+            return name
+    return None
+
+
+
+def compress(chunks, encoding):
+    """
+    Generator compressing an iterable of bytes chunks with a content encoding,
+    yielding each chunk's compressed data as soon as it's compressed.
+    """
+
+    compressor = dict(COMPRESSORS)[encoding]()
+    for chunk in chunks:
+        if chunk:
+            yield compressor.compress(chunk)
+    yield compressor.finish()
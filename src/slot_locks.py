@@ -0,0 +1,80 @@
+"""
+Concurrency limits shared by all of the API's worker processes on a machine.
+
+uWSGI runs the API in several worker processes, each single-threaded by
+default, so a threading.Semaphore in each worker would never make a search
+wait for another worker's.  Instead each slot is a lock file, held with flock()
+by the process running a search in that slot.  The OS releases the lock when
+the file is closed, including when the process dies, so a crashed or killed
+worker can't leak a slot.  Separately opened files are locked independently,
+so this also limits threads within one process (eg in the ASGI mode.)
+"""
+
+import fcntl
+import os
+import threading
+import time
+
+
+
+class FileSemaphore:
+    """
+    Semaphore with 'value' slots shared between processes, as the lock files
+    '<name>.<n>.lock' in 'directory'.  acquire() returns the slot it got,
+    which has to be passed to release().
+    """
+
+    # Seconds between attempts to get a slot while waiting for one.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, directory, name, value):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, '%s.%d.lock' % (name, n)) for n in range(value)]
+
+
+    def try_acquire(self):
+        """Return a free slot (an open file descriptor holding its lock), or None if they're all taken."""
+
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+
+    def acquire(self, timeout=None):
+        """Wait up to 'timeout' seconds (or forever if None) for a slot, and return it, or None."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            slot = self.try_acquire()
+            if slot is not None or (deadline is not None and time.monotonic() >= deadline):
+                return slot
+            time.sleep(self.POLL_INTERVAL)
+
+
+    def release(self, slot):
+        # Closing the file releases its lock.
+        os.close(slot)
+
+
+
+
+class LocalSemaphore:
+    """FileSemaphore's interface for a semaphore in this process only."""
+
+    def __init__(self, value):
+        self.semaphore = threading.BoundedSemaphore(value)
+
+    def try_acquire(self):
+        return self.acquire(timeout=0)
+
+    def acquire(self, timeout=None):
+        return True if self.semaphore.acquire(timeout=timeout) else None
+
+    def release(self, slot):
+        self.semaphore.release()
@@ -0,0 +1,362 @@
+"""
+Memory-mapped binary snapshot of the MetaSRA database.
+
+The database is read-only between builds, so build-db.py also writes it to a
+single binary file which the API can serve from directly (see METASRA_SNAPSHOT
+in metasra_api.py.)  The file is memory-mapped and read without copying, so
+all uWSGI workers on a machine share the same pages through the OS page cache,
+and nothing goes over the network or through BSON decoding.
+
+FILE FORMAT:
+The file starts with a header (magic bytes, format version, number of
+sections), followed by a table of sections (name, array typecode, offset and
+length in bytes).  Each section is an array of unsigned ints ('I' for 32 bits,
+'Q' for 64 bits) or raw bytes ('B'), aligned to 8 bytes and stored in the byte
+order of the machine that built it.
+
+Variable-length data is stored CSR-style: an 'offsets' or 'indptr' array with
+one entry per row plus one, and a flat array of values, where row i is
+values[indptr[i]:indptr[i+1]].  Samplegroups are numbered in order of study ID,
+so each study is a contiguous range of samplegroups.
+
+Sections:
++ meta : JSON with the database build version and byte order.
++ string_heap, string_offsets : all distinct strings (term ID's, study ID's,
+        sample types, run ID's), referenced everywhere else by number.
++ term_ids : string number for every term number.
++ study_ids : string number for every study number.
++ sg_study, sg_type, sg_samples : study number, sample type string number
+        (NO_STRING if none) and number of samples for every samplegroup.
++ sg_doc_heap, sg_doc_offsets : JSON for every samplegroup document, as returned
+        by the API.
++ sg_aterms_indptr, sg_aterms : ancestral term numbers of every samplegroup.
++ term_sg_indptr, term_sg : samplegroup numbers for every term (the transpose
+        of sg_aterms), used as posting lists for searches.
++ sg_runs_indptr, sg_runs : run ID string numbers of every samplegroup.
++ sg_dterms_indptr, sg_dterms : display term numbers of every samplegroup.
++ dterm_heap, dterm_offsets : JSON for every distinct display term.
++ term_doc_heap, term_doc_offsets : JSON for every document in the terms
+        collection.
++ term_prefixes : JSON list of the documents in the termprefixes collection
+        (precomputed autocomplete completions.)  Older snapshots don't have it.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from bitmap_index import SampleGroupIndex
+
+
+MAGIC = b'METASRA\0'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sII')
+SECTION = struct.Struct('<16sc7xQQ')
+ALIGNMENT = 8
+
+# Marks a missing string, eg a samplegroup without a sample type.
+NO_STRING = 0xFFFFFFFF
+
+
+
+class _Heap:
+    """Variable-length byte strings, stored CSR-style."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def append(self, value):
+        self.data += value
+        self.offsets.append(len(self.data))
+        return len(self.offsets) - 2
+
+
+
+class _StringTable(_Heap):
+    """Heap of distinct strings, numbered in order of first appearance."""
+
+    def __init__(self):
+        super().__init__()
+        self.numbers = {}
+
+    def number(self, string):
+        if string not in self.numbers:
+            self.numbers[string] = self.append(string.encode('utf-8'))
+        return self.numbers[string]
+
+
+
+def _json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+
+def write_snapshot(path, version, samplegroups, terms, termprefixes=()):
+    """
+    Write a snapshot file.
+
+    'samplegroups' is an iterable of samplegroup documents sorted by study ID,
+    with 'aterms' and 'dterms'.  'terms' is an iterable of documents from the
+    terms collection, and 'termprefixes' from the termprefixes collection.
+    The file is written next to 'path' and then renamed, so the API never
+    sees a partly-written snapshot.
+    """
+
+    strings = _StringTable()
+    termNumbers = {}
+    studyNumbers = {}
+    dterms, dtermNumbers = _Heap(), {}
+
+    sections = {
+        'term_ids': array('I'),
+        'study_ids': array('I'),
+        'sg_study': array('I'),
+        'sg_type': array('I'),
+        'sg_samples': array('I'),
+        'sg_aterms_indptr': array('Q', [0]),
+        'sg_aterms': array('I'),
+        'sg_runs_indptr': array('Q', [0]),
+        'sg_runs': array('I'),
+        'sg_dterms_indptr': array('Q', [0]),
+        'sg_dterms': array('I'),
+    }
+    docs = _Heap()
+
+    for samplegroup in samplegroups:
+        samplegroup = dict(samplegroup)
+        samplegroup.pop('_id', None)
+        samplegroup.pop('sampleCount', None)
+        samplegroup.pop('runs', None)
+        aterms = samplegroup.pop('aterms')
+
+        studyID = samplegroup['study']['id']
+        if studyID not in studyNumbers:
+            studyNumbers[studyID] = len(studyNumbers)
+            sections['study_ids'].append(strings.number(studyID))
+        sections['sg_study'].append(studyNumbers[studyID])
+
+        sampletype = (samplegroup.get('type') or {}).get('type')
+        sections['sg_type'].append(NO_STRING if sampletype is None else strings.number(sampletype))
+        sections['sg_samples'].append(len(samplegroup['samples']))
+
+        for term in sorted(aterms):
+            if term not in termNumbers:
+                termNumbers[term] = len(termNumbers)
+                sections['term_ids'].append(strings.number(term))
+            sections['sg_aterms'].append(termNumbers[term])
+        sections['sg_aterms_indptr'].append(len(sections['sg_aterms']))
+
+        for sample in samplegroup['samples']:
+            for experiment in sample['experiments']:
+                for run in experiment['runs']:
+                    sections['sg_runs'].append(strings.number(run))
+        sections['sg_runs_indptr'].append(len(sections['sg_runs']))
+
+        for dterm in samplegroup['dterms']:
+            encoded = _json(dterm)
+            if encoded not in dtermNumbers:
+                dtermNumbers[encoded] = dterms.append(encoded)
+            sections['sg_dterms'].append(dtermNumbers[encoded])
+        sections['sg_dterms_indptr'].append(len(sections['sg_dterms']))
+
+        docs.append(_json(samplegroup))
+
+
+    # Transpose samplegroup -> aterms into term -> samplegroups posting lists.
+    counts = array('Q', [0]) * (len(termNumbers) + 1)
+    for term in sections['sg_aterms']:
+        counts[term + 1] += 1
+    for i in range(len(termNumbers)):
+        counts[i + 1] += counts[i]
+    sections['term_sg_indptr'] = array('Q', counts)
+    sections['term_sg'] = array('I', [0]) * len(sections['sg_aterms'])
+    indptr = sections['sg_aterms_indptr']
+    for samplegroup in range(len(sections['sg_study'])):
+        for term in sections['sg_aterms'][indptr[samplegroup]:indptr[samplegroup + 1]]:
+            sections['term_sg'][counts[term]] = samplegroup
+            counts[term] += 1
+
+    termdocs = _Heap()
+    for term in terms:
+        term = dict(term)
+        term.pop('_id', None)
+        termdocs.append(_json(term))
+
+    sections.update({
+        'meta': _json({'version': version, 'byteorder': sys.byteorder}),
+        'string_heap': strings.data,
+        'string_offsets': strings.offsets,
+        'sg_doc_heap': docs.data,
+        'sg_doc_offsets': docs.offsets,
+        'dterm_heap': dterms.data,
+        'dterm_offsets': dterms.offsets,
+        'term_doc_heap': termdocs.data,
+        'term_doc_offsets': termdocs.offsets,
+        'term_prefixes': _json(list(termprefixes)),
+    })
+
+
+    # Lay out sections after the header and section table.
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for name, data in sections.items():
+        offset += -offset % ALIGNMENT
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        nbytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        table.append((name, typecode, offset, nbytes, data))
+        offset += nbytes
+
+    temppath = path + '.tmp'
+    with open(temppath, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(table)))
+        for name, typecode, offset, nbytes, data in table:
+            f.write(SECTION.pack(name.encode('ascii'), typecode.encode('ascii'), offset, nbytes))
+        for name, typecode, offset, nbytes, data in table:
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(data)
+    os.replace(temppath, path)
+
+
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot file.  Arrays are memoryviews into the
+    memory-mapped file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+
+        magic, formatVersion, nsections = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or formatVersion != FORMAT_VERSION:
+            raise ValueError('%s is not a version %d MetaSRA snapshot' % (path, FORMAT_VERSION))
+
+        self.sections = {}
+        for i in range(nsections):
+            name, typecode, offset, nbytes = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            section = view[offset:offset+nbytes]
+            if typecode != b'B':
+                section = section.cast(typecode.decode('ascii'))
+            self.sections[name.rstrip(b'\0').decode('ascii')] = section
+
+        meta = json.loads(str(self.sections['meta'], 'utf-8'))
+        if meta['byteorder'] != sys.byteorder:
+            raise ValueError('%s was built on a machine with a different byte order' % path)
+        self.version = meta['version']
+
+        self.size = len(self.sections['sg_study'])
+        self.termNumbers = {self.string(s): n for (n, s) in enumerate(self.sections['term_ids'])}
+        self.studyIDs = [self.string(s) for s in self.sections['study_ids']]
+        self._index = None
+
+
+    def _blob(self, heap, offsets, i):
+        offsets = self.sections[offsets]
+        return str(self.sections[heap][offsets[i]:offsets[i+1]], 'utf-8')
+
+
+    def _row(self, name, i):
+        indptr = self.sections[name + '_indptr']
+        return self.sections[name][indptr[i]:indptr[i+1]]
+
+
+    def string(self, number):
+        return self._blob('string_heap', 'string_offsets', number)
+
+
+    def samplegroup(self, position):
+        """Return the samplegroup document at a position."""
+        return json.loads(self._blob('sg_doc_heap', 'sg_doc_offsets', position))
+
+
+    def samplegroup_study(self, position):
+        return self.studyIDs[self.sections['sg_study'][position]]
+
+
+    def samplegroup_runs(self, position):
+        """Return the list of run ID's of the samplegroup at a position."""
+        return [self.string(run) for run in self._row('sg_runs', position)]
+
+
+    def dterm(self, number):
+        return json.loads(self._blob('dterm_heap', 'dterm_offsets', number))
+
+
+    def term_postings(self, term):
+        """Return the sorted positions of samplegroups having an ancestral term."""
+
+        number = self.termNumbers.get(term)
+        if number is None:
+            return self.sections['term_sg'][0:0]
+        return self._row('term_sg', number)
+
+
+    def terms(self):
+        """Generator yielding every document in the terms collection."""
+
+        for i in range(len(self.sections['term_doc_offsets']) - 1):
+            yield json.loads(self._blob('term_doc_heap', 'term_doc_offsets', i))
+
+
+    def term_prefixes(self):
+        """
+        Return the list of precomputed autocomplete completions, or an empty
+        list if the snapshot doesn't have them.
+        """
+
+        if 'term_prefixes' not in self.sections:
+            return []
+        return json.loads(str(self.sections['term_prefixes'], 'utf-8'))
+
+
+    def sample_index(self):
+        """
+        Return a SampleGroupIndex over the snapshot, using its posting lists.
+        Positions in the snapshot are used as samplegroup _id's.
+        """
+
+        if self._index is None:
+            typePostings = {}
+            for position, sampletype in enumerate(self.sections['sg_type']):
+                if sampletype != NO_STRING:
+                    typePostings.setdefault(sampletype, array('I')).append(position)
+
+            self._index = SampleGroupIndex.from_arrays(
+                ids=range(self.size),
+                sampleCounts=self.sections['sg_samples'],
+                studyIDs=self.studyIDs,
+                studyNumbers=self.sections['sg_study'],
+                termPostings={term: self._row('term_sg', n) for (term, n) in self.termNumbers.items()},
+                typePostings={self.string(t): positions for (t, positions) in typePostings.items()})
+
+        return self._index
+
+
+    def term_histogram(self, positions):
+        """
+        Calculate the most-common display terms for the samplegroups at the
+        given positions, the same way as the API does with MongoDB.
+        """
+
+        studies = {}
+        for position in positions:
+            study = studies.setdefault(self.sections['sg_study'][position], [0, set()])
+            study[0] += self.sections['sg_samples'][position]
+            study[1].update(self._row('sg_dterms', position))
+
+        counts = {}
+        for sampleCount, dterms in studies.values():
+            for dterm in dterms:
+                counts[dterm] = counts.get(dterm, 0) + sampleCount
+
+        histogram = [{'dterm': self.dterm(dterm), 'sampleCount': count} for (dterm, count) in counts.items()]
+        histogram.sort(key=lambda term: (-term['sampleCount'], term['dterm']['name']))
+        return histogram
@@ -0,0 +1,217 @@
+"""
+In-memory index of the terms collection for the /terms autocomplete.
+
+Autocomplete fires on every keystroke, so instead of running regular
+expression queries against MongoDB, each API worker keeps the terms in memory
+with a sorted list of their tokens.  All tokens starting with a prefix are a
+contiguous range of the sorted list, found by bisection, and each token has a
+posting list of the terms it belongs to.
+
+Query tokens also match with trailing s/S characters removed.  Results are
+ranked the same way as the MongoDB query in metasra_api.py: first terms
+matching the query tokens as typed, then by the number of query tokens matching
+the start of a token in the term's name ('namematch'), then by score (the
+length of the term name.)  Ties are broken by term name, so the ranking doesn't
+depend on the order of the documents in the collection.
+
+The first few characters typed match a large fraction of all terms, so
+build-db.py also precomputes the ranked completions of every short prefix
+(see completion_prefixes()), and searches on one of those prefixes are served
+by looking them up.
+"""
+
+import heapq
+from array import array
+from bisect import bisect_left
+
+
+# Sorts after any character we'll see in a token, to find the end of a prefix range.
+MAX_CHAR = '\U0010ffff'
+
+
+def depluralize(token):
+    """
+    Remove trailing s/S characters from a query token, since users often type
+    plurals but the ontology terms are mostly singular.
+    """
+    return token.rstrip('sS')
+
+
+
+class PrefixIndex:
+    """Sorted tokens with posting lists of term numbers."""
+
+    def __init__(self, postings):
+        self.tokens = sorted(postings)
+        self.postings = [array('I', sorted(postings[token])) for token in self.tokens]
+
+
+    def lookup(self, prefix):
+        """Return the set of term numbers having a token starting with 'prefix'."""
+
+        start = bisect_left(self.tokens, prefix)
+        end = bisect_left(self.tokens, prefix + MAX_CHAR, start)
+
+        terms = set()
+        for i in range(start, end):
+            terms.update(self.postings[i])
+        return terms
+
+
+    def extensions(self, prefix):
+        """Return the set of prefixes one character longer than 'prefix' that tokens start with."""
+
+        start = bisect_left(self.tokens, prefix)
+        end = bisect_left(self.tokens, prefix + MAX_CHAR, start)
+
+        length = len(prefix) + 1
+        return set(token[:length] for token in self.tokens[start:end] if len(token) >= length)
+
+
+
+
+class TermIndex:
+    """
+    Autocomplete index over documents from the terms collection (with the
+    'tokens', 'nametokens' and 'score' fields built by build-db.py.)
+    """
+
+    # Fields used for searching, which aren't returned by the API.
+    HIDDEN_FIELDS = ('_id', 'nametokens', 'score', 'tokens')
+
+    def __init__(self, terms):
+        self.docs = []      # term number -> document to return
+        self.scores = []    # term number -> score
+        self.names = []     # term number -> name, to break ties in ranking
+        self.ids = {}       # term ID -> term number
+
+        tokenPostings, nameTokenPostings = {}, {}
+        for number, term in enumerate(terms):
+            self.docs.append({k: v for (k, v) in term.items() if k not in self.HIDDEN_FIELDS})
+            self.scores.append(term.get('score', 0))
+            self.names.append(term.get('name', ''))
+            for termID in term['ids']:
+                self.ids[termID] = number
+            for token in term.get('tokens', []):
+                tokenPostings.setdefault(token, []).append(number)
+            for token in term.get('nametokens', []):
+                nameTokenPostings.setdefault(token, []).append(number)
+
+        self.tokens = PrefixIndex(tokenPostings)
+        self.nametokens = PrefixIndex(nameTokenPostings)
+
+        self.completions = {}   # prefix -> (ranked (term number, namematch) list, whether it's all the matches)
+
+
+    def search(self, tokens=None, ids=None, limit=500):
+        """
+        Return up to 'limit' term documents having a token starting with each
+        of 'tokens' (or each of them depluralized), and one of the term ID's
+        in 'ids'.  Either can be None.
+        """
+
+        # Serve one-token searches from the precomputed completions if we
+        # have them, unless they might have been cut off before 'limit'.
+        if ids is None and tokens is not None and len(tokens) == 1:
+            ranked, complete = self.completions.get(next(iter(tokens)), (None, False))
+            if ranked is not None and (complete or limit <= len(ranked)):
+                return [dict(self.docs[term], namematch=namematch) for (term, namematch) in ranked[:limit]]
+
+        if tokens is None:
+            return [self.docs[term] for (term, namematch) in self.rank(tokens, ids, limit)]
+        return [dict(self.docs[term], namematch=namematch) for (term, namematch) in self.rank(tokens, ids, limit)]
+
+
+    def rank(self, tokens=None, ids=None, limit=500):
+        """
+        Search without the precomputed completions, returning a ranked list of
+        (term number, namematch) tuples.
+        """
+
+        candidates = None
+        if ids is not None:
+            candidates = set(self.ids[termID] for termID in ids if termID in self.ids)
+
+        if tokens is None:
+            if candidates is None:
+                return []
+            best = heapq.nsmallest(limit, candidates, key=lambda term: (self.scores[term], self.names[term], term))
+            return [(term, 0) for term in best]
+
+        tokens = list(tokens)
+        stripped = [depluralize(token) for token in tokens]
+
+        # Terms matching all of the depluralized tokens, which includes the
+        # terms matching the tokens as typed.  Intersect the smallest sets first.
+        for terms in sorted((self.tokens.lookup(token) for token in set(stripped)), key=len):
+            candidates = terms if candidates is None else candidates & terms
+            if not candidates:
+                return []
+
+        exact = set(candidates)
+        for token in set(tokens) - set(stripped):
+            exact &= self.tokens.lookup(token)
+        inexact = candidates - exact
+
+        # Count query tokens in the name, as typed for exact matches and
+        # depluralized for the others.
+        namematch = {}
+        for querytokens, terms in ((tokens, exact), (stripped, inexact)):
+            for token in querytokens:
+                for term in self.nametokens.lookup(token) & terms:
+                    namematch[term] = namematch.get(term, 0) + 1
+
+        best = heapq.nsmallest(limit, candidates,
+            key=lambda term: (term not in exact, -namematch.get(term, 0), self.scores[term], self.names[term], term))
+        return [(term, namematch.get(term, 0)) for term in best]
+
+
+    def completion_prefixes(self, max_length, min_terms):
+        """
+        Return the prefixes worth precomputing completions for: every prefix
+        of a token up to 'max_length' characters, and longer prefixes of
+        tokens in at least 'min_terms' terms.
+        """
+
+        prefixes = []
+        frontier = ['']
+        while frontier:
+            for prefix in self.tokens.extensions(frontier.pop()):
+                if len(prefix) <= max_length or len(self.tokens.lookup(prefix)) >= min_terms:
+                    prefixes.append(prefix)
+                    frontier.append(prefix)
+
+        return sorted(prefixes)
+
+
+    def completion(self, prefix, limit):
+        """
+        Return the precomputed completions document for a one-token search on
+        'prefix', with up to 'limit' terms referred to by their first term ID.
+        """
+
+        ranked = self.rank([prefix], limit=limit)
+        return {
+            '_id': prefix,
+            'ids': [self.docs[term]['ids'][0] for (term, namematch) in ranked],
+            'namematch': [namematch for (term, namematch) in ranked],
+            # Whether these are all of the matching terms.
+            'complete': len(ranked) < limit,
+        }
+
+
+    def load_completions(self, completions):
+        """
+        Use precomputed completions documents (from completion()) for
+        one-token searches.  Completions referring to a term ID that isn't in
+        the index (from a different build of the terms) are skipped, so those
+        prefixes are ranked live.
+        """
+
+        self.completions = {}
+        for completion in completions:
+            if not all(termID in self.ids for termID in completion['ids']):
+                continue
+            ranked = [(self.ids[termID], namematch)
+                for (termID, namematch) in zip(completion['ids'], completion['namematch'])]
+            self.completions[completion['_id']] = (ranked, completion['complete'])
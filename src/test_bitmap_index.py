@@ -0,0 +1,128 @@
+"""
+Tests for bitmap_index.py, against brute-force searches of random
+samplegroups.  Run with pytest from this directory.
+"""
+
+import random
+
+import pytest
+
+from bitmap_index import SampleGroupIndex, bitmap_positions, positions_to_bitmap
+
+
+TERMS = ['T:%d' % i for i in range(30)]
+TYPES = [None, 'tissue', 'cell line', 'primary cell']
+
+
+
+def random_samplegroups(rng, nstudies=80):
+    """Random samplegroups sorted by study, some terms common and some rare."""
+
+    samplegroups = []
+    for study in range(nstudies):
+        for i in range(rng.randint(1, 8)):
+            samplegroups.append({
+                '_id': 'sg%d' % len(samplegroups),
+                'study': 'SRP%03d' % study,
+                'type': rng.choice(TYPES),
+                'sampleCount': rng.randint(1, 50),
+                'aterms': [term for (n, term) in enumerate(TERMS) if rng.random() < 1 / (n + 2)],
+            })
+    return samplegroups
+
+
+
+def brute_force(samplegroups, and_terms, not_terms=(), sampletype=None, studyID=None):
+    return [samplegroup for samplegroup in samplegroups
+        if all(term in samplegroup['aterms'] for term in and_terms)
+        and not any(term in samplegroup['aterms'] for term in not_terms)
+        and sampletype in (None, samplegroup['type'])
+        and studyID in (None, samplegroup['study'])]
+
+
+
+def test_bitmap_positions_round_trip():
+    rng = random.Random(0)
+    for size in (1, 63, 64, 65, 1000):
+        positions = sorted(rng.sample(range(size), rng.randint(0, size)))
+        assert list(bitmap_positions(positions_to_bitmap(positions, size))) == positions
+
+
+
+def test_match_matches_brute_force():
+    rng = random.Random(1)
+    samplegroups = random_samplegroups(rng)
+    index = SampleGroupIndex(samplegroups)
+    studyIDs = sorted(set(samplegroup['study'] for samplegroup in samplegroups))
+
+    for i in range(500):
+        and_terms = rng.sample(TERMS, rng.randint(1, 3))
+        not_terms = rng.sample(TERMS, rng.randint(0, 2))
+        sampletype = rng.choice(TYPES)
+        studyID = rng.choice([None, None, rng.choice(studyIDs)])
+
+        expected = brute_force(samplegroups, and_terms, not_terms, sampletype, studyID)
+        bitmap = index.match(and_terms, not_terms, sampletype, studyID)
+        assert index.ids_for(bitmap) == [samplegroup['_id'] for samplegroup in expected]
+
+
+
+def test_match_unknown_values():
+    index = SampleGroupIndex(random_samplegroups(random.Random(2)))
+    assert index.match(['X:unknown']) == 0
+    assert index.match(['T:0'], sampletype='unknown type') == 0
+    assert index.match(['T:0'], studyID='SRP999') == 0
+    assert index.match(['T:0'], ['X:unknown']) == index.match(['T:0'])
+
+
+
+def test_restrict_and_study_order():
+    rng = random.Random(3)
+    samplegroups = random_samplegroups(rng)
+    index = SampleGroupIndex(samplegroups)
+
+    bitmap = index.match(['T:0'])
+    some = ['SRP001', 'SRP010', 'SRP042', 'SRP999']
+    assert index.ids_for(index.restrict_to_studies(bitmap, some)) == [samplegroup['_id']
+        for samplegroup in brute_force(samplegroups, ['T:0']) if samplegroup['study'] in some]
+
+    counts = {}
+    for samplegroup in brute_force(samplegroups, ['T:0']):
+        counts[samplegroup['study']] = counts.get(samplegroup['study'], 0) + samplegroup['sampleCount']
+    assert index.study_order(bitmap) == sorted(counts.items(), key=lambda study: (-study[1], study[0]))
+
+
+
+def test_from_arrays_matches_constructor():
+    samplegroups = random_samplegroups(random.Random(4))
+    index = SampleGroupIndex(samplegroups)
+
+    studyIDs = sorted(set(samplegroup['study'] for samplegroup in samplegroups))
+    termPostings, typePostings = {}, {}
+    for position, samplegroup in enumerate(samplegroups):
+        for term in samplegroup['aterms']:
+            termPostings.setdefault(term, []).append(position)
+        if samplegroup['type']:
+            typePostings.setdefault(samplegroup['type'], []).append(position)
+    copy = SampleGroupIndex.from_arrays(
+        ids=[samplegroup['_id'] for samplegroup in samplegroups],
+        sampleCounts=[samplegroup['sampleCount'] for samplegroup in samplegroups],
+        studyIDs=studyIDs,
+        studyNumbers=[studyIDs.index(samplegroup['study']) for samplegroup in samplegroups],
+        termPostings=termPostings,
+        typePostings=typePostings)
+
+    for and_terms, sampletype in ((['T:0'], None), (['T:1', 'T:5'], 'tissue'), (['T:20'], 'cell line')):
+        assert copy.match(and_terms, sampletype=sampletype) == index.match(and_terms, sampletype=sampletype)
+    assert copy.studyRanges == index.studyRanges
+
+
+
+def test_unsorted_samplegroups():
+    samplegroups = [
+        {'_id': 1, 'study': 'SRP1', 'type': None, 'sampleCount': 1, 'aterms': []},
+        {'_id': 2, 'study': 'SRP2', 'type': None, 'sampleCount': 1, 'aterms': []},
+        {'_id': 3, 'study': 'SRP1', 'type': None, 'sampleCount': 1, 'aterms': []},
+    ]
+    with pytest.raises(ValueError):
+        SampleGroupIndex(samplegroups)
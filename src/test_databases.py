@@ -0,0 +1,149 @@
+"""
+Tests for databases.py, with a minimal in-memory stand-in for a pymongo
+MongoClient.  Run with pytest from this directory.
+"""
+
+import pytest
+
+import databases
+
+
+
+class FakeCollection:
+    """The few pymongo Collection methods databases.py uses, matching documents by equality."""
+
+    def __init__(self):
+        self.documents = []
+
+    def _find(self, query):
+        for i, document in enumerate(self.documents):
+            if all(document.get(key) == value for (key, value) in query.items()):
+                return i
+        return None
+
+    def find_one(self, query):
+        i = self._find(query)
+        return None if i is None else dict(self.documents[i])
+
+    def insert_one(self, document):
+        self.documents.append(dict(document))
+
+    def replace_one(self, query, document, upsert=False):
+        i = self._find(query)
+        if i is not None:
+            self.documents[i] = dict(document)
+        elif upsert:
+            self.documents.append(dict(document))
+
+    def delete_one(self, query):
+        i = self._find(query)
+        if i is not None:
+            del self.documents[i]
+
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+
+
+class FakeClient:
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, FakeDatabase())
+
+    def list_database_names(self):
+        return list(self.databases)
+
+    def drop_database(self, name):
+        self.databases.pop(name, None)
+
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+
+def build(client, version, snapshot=None):
+    """Simulate a build: create its database and activate it."""
+
+    name = databases.start_build(client, version)
+    assert databases.building_database(client) == name
+    client[name]['buildinfo'].insert_one({'_id': 'version', 'version': version})
+    databases.activate(client, name, version, snapshot)
+    assert databases.building_database(client) is None
+    return name
+
+
+
+def test_no_pointer(client):
+    assert databases.active_database(client) == ('metaSRA', None, None)
+    assert databases.snapshot_names(client) == set()
+    with pytest.raises(ValueError):
+        databases.rollback(client)
+
+
+
+def test_activate_and_rollback(client):
+    client['metaSRA']['buildinfo'].insert_one({'_id': 'version', 'version': '100'})
+
+    # The first versioned build replaces the unversioned 'metaSRA' database.
+    first = build(client, '200', 'metasra.snapshot.200')
+    assert first == 'metaSRA_200'
+    assert databases.active_database(client) == ('metaSRA_200', '200', 'metasra.snapshot.200')
+
+    second = build(client, '300', 'metasra.snapshot.300')
+    assert databases.active_database(client) == (second, '300', 'metasra.snapshot.300')
+    assert databases.snapshot_names(client) == {'metasra.snapshot.200', 'metasra.snapshot.300'}
+
+    # Rolling back swaps the active and previous builds, with their snapshots.
+    assert databases.rollback(client) == first
+    assert databases.active_database(client) == (first, '200', 'metasra.snapshot.200')
+    assert databases.rollback(client) == second
+    assert databases.active_database(client) == (second, '300', 'metasra.snapshot.300')
+
+    # Activating the active database again keeps its previous build.
+    databases.activate(client, second, '301', 'metasra.snapshot.301')
+    assert databases.active_database(client) == (second, '301', 'metasra.snapshot.301')
+    assert databases.rollback(client) == first
+
+
+
+def test_rollback_to_unversioned_database(client):
+    client['metaSRA']['buildinfo'].insert_one({'_id': 'version', 'version': '100'})
+    build(client, '200')
+
+    assert databases.rollback(client) == 'metaSRA'
+    assert databases.active_database(client) == ('metaSRA', '100', None)
+
+
+
+def test_cancel_build(client):
+    active = build(client, '200')
+    name = databases.start_build(client, '300')
+    client[name]['samplegroups'].insert_one({'_id': 1})
+
+    databases.cancel_build(client, name)
+    assert name not in client.list_database_names()
+    assert databases.building_database(client) is None
+    assert databases.active_database(client)[0] == active
+
+
+
+def test_drop_old_databases(client):
+    for version in ('100', '200', '300'):
+        build(client, version)
+    building = databases.start_build(client, '400')
+    client[building]
+    client['metaSRA_backup']
+    client['otherdb']
+
+    assert sorted(databases.drop_old_databases(client)) == ['metaSRA_100']
+    assert sorted(client.list_database_names()) == sorted(
+        ['metaSRA', 'metaSRA_200', 'metaSRA_300', 'metaSRA_400', 'metaSRA_backup', 'otherdb'])
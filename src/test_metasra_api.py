@@ -0,0 +1,322 @@
+"""
+Tests for the API's endpoints, on a small database in mongomock.  Run with
+pytest from this directory (pip install pytest mongomock.)
+"""
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+import metasra_api
+from slot_locks import FileSemaphore
+
+
+ROOT = 'ROOT:1'
+
+
+
+def example_samplegroups():
+    """
+    Samplegroups of 8 studies with 1 to 3 samplegroups of 1 to 3 samples
+    each.  Every samplegroup has the root term, and some have 'A:1' or 'B:1'.
+    """
+
+    samplegroups = []
+    for study in range(8):
+        studyID = 'SRP%d' % study
+        for group in range(study % 3 + 1):
+            samples = [{'id': 'SRS%d%d%d' % (study, group, i), 'experiments': [
+                {'id': 'SRX%d%d%d' % (study, group, i), 'runs': ['SRR%d%d%d' % (study, group, i)]}]}
+                for i in range(group + 1)]
+            aterms = [ROOT]
+            if (study + group) % 2 == 0:
+                aterms.append('A:1')
+            if study % 3 == 0:
+                aterms.append('B:1')
+            samplegroups.append({
+                '_id': len(samplegroups),
+                'study': {'id': studyID, 'title': 'Study %d' % study},
+                'type': {'type': 'tissue', 'conf': 0.9},
+                'attr': [['tissue', 'brain']],
+                'samples': samples,
+                'sampleCount': len(samples),
+                'runs': [sample['experiments'][0]['runs'][0] for sample in samples],
+                'aterms': sorted(aterms),
+                'dterms': [{'name': 'term %d' % group, 'ids': ['D:%d' % group]}],
+            })
+    return samplegroups
+
+
+
+def example_terms():
+    """Terms documents for the root term and the display terms, scored by name length."""
+
+    terms = [('ROOT:1', 'root'), ('A:1', 'term a'), ('B:1', 'term b')] + [('D:%d' % group, 'term %d' % group) for group in range(3)]
+    return [{'_id': termID, 'ids': [termID], 'name': name, 'synonyms': [],
+        'tokens': name.split(), 'nametokens': name.split(), 'score': len(name)}
+        for (termID, name) in terms]
+
+
+
+def studies(samplegroups):
+    """The 'studies' collection built by build-db.py."""
+
+    studies = {}
+    for samplegroup in samplegroups:
+        study = studies.setdefault(samplegroup['study']['id'], {'_id': samplegroup['study']['id'],
+            'study': samplegroup['study'], 'sampleCount': 0, 'samplegroupCount': 0, 'dterms': []})
+        study['sampleCount'] += samplegroup['sampleCount']
+        study['samplegroupCount'] += 1
+        for dterm in samplegroup['dterms']:
+            if dterm not in study['dterms']:
+                study['dterms'].append(dterm)
+    return list(studies.values())
+
+
+
+def term_stats(samplegroups, term):
+    """The 'termstats' document for a search on one term, without a sample type."""
+
+    matching = [samplegroup for samplegroup in samplegroups if term in samplegroup['aterms']]
+    counts = {}
+    for samplegroup in matching:
+        counts[samplegroup['study']['id']] = counts.get(samplegroup['study']['id'], 0) + samplegroup['sampleCount']
+    return {
+        'term': term,
+        'type': None,
+        'studyCount': len(counts),
+        'sampleCount': sum(counts.values()),
+        'samplegroupCount': len(matching),
+        'studies': sorted(([studyID, count] for (studyID, count) in counts.items()),
+            key=lambda study: (-study[1], study[0])),
+        'terms': [],
+    }
+
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Point the API at a fresh mongomock database, with empty caches and indices."""
+
+    client = mongomock.MongoClient()
+    db = client['metaSRA']
+    samplegroups = example_samplegroups()
+    db['samplegroups'].insert_many(samplegroups)
+    db['studies'].insert_many(studies(samplegroups))
+    db['termstats'].insert_many([term_stats(samplegroups, term) for term in (ROOT, 'A:1', 'B:1')])
+    db['terms'].insert_many(example_terms())
+    db['buildinfo'].insert_one({'_id': 'version', 'version': '1'})
+
+    monkeypatch.setattr(metasra_api, 'client', client)
+    monkeypatch.setattr(metasra_api, '_active_db', {'current': None, 'checked': None})
+    monkeypatch.setattr(metasra_api, '_term_index', {'index': None, 'version': None})
+    monkeypatch.setattr(metasra_api, 'query_cache', metasra_api.QueryCache(10**7, 60))
+    monkeypatch.setattr(metasra_api, 'term_cache', metasra_api.LRUCache(10**7, 60))
+    monkeypatch.setattr(metasra_api, '_term_cache_version', {'version': None})
+    return db
+
+
+
+@pytest.fixture
+def api(database):
+    return metasra_api.app.test_client()
+
+
+
+def admitted_class(querystring, **kwargs):
+    """Admit a search like the endpoints do, and return its class or error."""
+
+    with metasra_api.app.test_request_context('/?' + querystring):
+        query = metasra_api.samples_query()
+        error = metasra_api.admit_search(query, **kwargs)
+        if error:
+            return error
+        searchclass = query['slot'][0]
+        metasra_api.release_search(query)
+        return searchclass
+
+
+
+def test_admission_depends_on_the_page(api, monkeypatch):
+    monkeypatch.setattr(metasra_api, 'SEARCH_LARGE_SAMPLEGROUPS', 8)
+    monkeypatch.setattr(metasra_api, 'SEARCH_MAX_SAMPLEGROUPS', 13)
+
+    # All of a search on the root term reads every samplegroup (24 samples.)
+    result = api.get('/api/v01/samples?and=' + ROOT).get_json()
+    assert 'too many' in result['error']
+
+    # A page of it only reads the page's samplegroups: the biggest studies
+    # have 6 samples each.
+    result = api.get('/api/v01/samples?limit=2&and=' + ROOT).get_json()
+    assert len(result['studies']) == 2 and result['studyCount'] == 8
+    assert admitted_class('limit=1&and=' + ROOT) == 'small'
+    assert admitted_class('limit=2&and=' + ROOT) == 'large'
+    assert admitted_class('limit=2&skip=2&and=' + ROOT) == 'small'
+
+    # Counts and downloads aren't rejected, and downloads are always large.
+    assert admitted_class('and=' + ROOT, summary=False) == 'small'
+    assert admitted_class('and=B:1', summary=False, download=True) == 'large'
+    assert api.get('/api/v01/samples.counts.json?and=' + ROOT).get_json() == {'studyCount': 8, 'sampleCount': 24}
+
+
+
+def test_admission_estimates(database, monkeypatch):
+    monkeypatch.setattr(metasra_api, 'SEARCH_LARGE_SAMPLEGROUPS', 5)
+
+    # Aggregated searches are estimated from the smallest term count, or the study.
+    with metasra_api.app.test_request_context('/?and=A:1,B:1&study=SRP2'):
+        query = metasra_api.samples_query()
+        assert metasra_api.estimate_samplegroups(query) == 3
+    assert admitted_class('and=A:1,B:1') == 'small'
+    assert admitted_class('and=A:1&not=B:1') == 'large'
+
+    # Without termstats, a search without a limit can't be bounded.
+    database['termstats'].drop()
+    assert admitted_class('and=A:1&not=B:1&limit=2') == 'small'
+    assert admitted_class('and=A:1&not=B:1') == 'large'
+
+
+
+@pytest.fixture
+def one_slot(monkeypatch, tmp_path):
+    """One slot of each class, so a leaked slot blocks the next search."""
+
+    monkeypatch.setattr(metasra_api, 'SEARCH_QUEUE_TIMEOUT', 0)
+    monkeypatch.setattr(metasra_api, 'search_slots',
+        {name: FileSemaphore(str(tmp_path), name, 1) for name in ('small', 'large')})
+
+
+
+def slot_is_free(searchclass):
+    slot = metasra_api.search_slots[searchclass].try_acquire()
+    if slot is None:
+        return False
+    metasra_api.search_slots[searchclass].release(slot)
+    return True
+
+
+
+def test_busy_server(api, one_slot):
+    slot = metasra_api.search_slots['small'].acquire()
+    assert 'busy' in api.get('/api/v01/samples?limit=1&and=A:1').get_json()['error']
+    metasra_api.search_slots['small'].release(slot)
+
+    # Slots are released after each search.
+    for i in range(3):
+        assert 'studies' in api.get('/api/v01/samples?limit=1&and=A:1').get_json()
+
+
+
+def test_download_releases_slot_on_errors(api, one_slot, monkeypatch):
+    from pymongo.errors import AutoReconnect
+    study_samplegroups = metasra_api.study_samplegroups
+    monkeypatch.setattr(metasra_api, 'STREAM_STUDY_BATCH_SIZE', 1)
+
+    def fail_after(batches):
+        calls = []
+        def failing(query, studyIDs, projection=metasra_api.SAMPLEGROUP_PROJECTION):
+            calls.append(studyIDs)
+            if len(calls) > batches:
+                raise AutoReconnect('connection lost')
+            return study_samplegroups(query, studyIDs, projection)
+        return failing
+
+    # Before the response starts, Flask turns the error into a 500 response.
+    monkeypatch.setattr(metasra_api, 'study_samplegroups', fail_after(0))
+    assert api.get('/api/v01/runs.ids.txt?and=' + ROOT).status_code == 500
+    assert slot_is_free('large')
+
+    # Partway through the file, it's raised while the body is sent.
+    monkeypatch.setattr(metasra_api, 'study_samplegroups', fail_after(1))
+    with pytest.raises(AutoReconnect):
+        api.get('/api/v01/runs.ids.txt?and=' + ROOT).get_data()
+    assert slot_is_free('large')
+
+    monkeypatch.setattr(metasra_api, 'study_samplegroups', study_samplegroups)
+    assert api.get('/api/v01/runs.ids.txt?and=' + ROOT).get_data(as_text=True).split('\n')[:2] == ['SRR200', 'SRR210']
+
+
+
+def test_download_releases_slot_when_closed(api, one_slot, monkeypatch):
+    monkeypatch.setattr(metasra_api, 'STREAM_STUDY_BATCH_SIZE', 1)
+    monkeypatch.setattr(metasra_api, 'STREAM_CHUNK_SIZE', 10)
+
+    response = api.get('/api/v01/samples.csv?and=' + ROOT, buffered=False)
+    assert not slot_is_free('large')
+    response.close()
+    assert slot_is_free('large')
+
+
+
+@pytest.mark.parametrize('use_term_index', [True, False])
+def test_batch_term_lookup(api, database, monkeypatch, use_term_index):
+    monkeypatch.setattr(metasra_api, 'USE_TERM_INDEX', use_term_index)
+
+    result = api.post('/api/v01/terms', json={'ids': ['D:1', 'B:1', 'X:1', ROOT]}).get_json()
+    assert [term['name'] for term in result['terms']] == ['root', 'term 1', 'term b']
+    assert 'score' not in result['terms'][0] and 'tokens' not in result['terms'][0]
+    assert api.post('/api/v01/terms', data={'id': 'A:1,D:0'}).get_json()['terms'] == \
+        api.get('/api/v01/terms?id=A:1,D:0').get_json()['terms']
+
+    assert 'error' in api.post('/api/v01/terms', json={'ids': 'A:1'}).get_json()
+    assert 'error' in api.post('/api/v01/terms', json={'ids': []}).get_json()
+    monkeypatch.setattr(metasra_api, 'MAX_BATCH_TERM_IDS', 2)
+    assert 'Too many' in api.post('/api/v01/terms', json={'ids': ['A:1', 'B:1', 'D:1']}).get_json()['error']
+
+    # Terms are looked up again after the database is rebuilt.
+    database['terms'].update_one({'_id': 'A:1'}, {'$set': {'name': 'renamed'}})
+    assert api.post('/api/v01/terms', json={'ids': ['A:1']}).get_json()['terms'][0]['name'] == 'term a'
+    database['buildinfo'].update_one({'_id': 'version'}, {'$set': {'version': '2'}})
+    monkeypatch.setattr(metasra_api, '_active_db', {'current': None, 'checked': None})
+    assert api.post('/api/v01/terms', json={'ids': ['A:1']}).get_json()['terms'][0]['name'] == 'renamed'
+
+
+
+def study_ids(result):
+    return [study['study']['id'] for study in result['studies']]
+
+
+
+def test_keyset_pagination(api):
+    # Studies are ordered by sample count, then by ID.
+    everything = study_ids(api.get('/api/v01/samples?and=' + ROOT).get_json())
+    assert everything == ['SRP2', 'SRP5', 'SRP1', 'SRP4', 'SRP7', 'SRP0', 'SRP3', 'SRP6']
+
+    # Following 'next' gives the same pages as 'skip', and the last page has no 'next'.
+    pages, token = [], None
+    while True:
+        result = api.get('/api/v01/samples?limit=3&and=' + ROOT + ('&after=' + token if token else '')).get_json()
+        assert study_ids(result) == study_ids(api.get(
+            '/api/v01/samples?limit=3&skip=%d&and=%s' % (result['skip'], ROOT)).get_json())
+        pages.append(study_ids(result))
+        token = result.get('next')
+        if token is None:
+            break
+    assert pages == [everything[0:3], everything[3:6], everything[6:8]]
+
+    for token in ('nonsense', 'WyJTUlAxIiwgM10='):
+        assert 'Invalid "after"' in api.get('/api/v01/samples?and=%s&after=%s' % (ROOT, token)).get_json()['error']
+
+
+
+def test_counts_and_id_lists(api, monkeypatch):
+    samplegroups = example_samplegroups()
+    for querystring in ('and=' + ROOT, 'and=A:1', 'and=B:1&not=A:1', 'and=A:1&study=SRP2', 'and=A:1&type=cell%20line'):
+        summary = api.get('/api/v01/samples?limit=1&' + querystring).get_json()
+        counts = api.get('/api/v01/samples.counts.json?' + querystring).get_json()
+        assert counts == {'studyCount': summary['studyCount'], 'sampleCount': summary['sampleCount']}
+
+    # ID lists only fetch the ID fields of the matching samplegroups.
+    study_samplegroups = metasra_api.study_samplegroups
+    projections = []
+    def recording(query, studyIDs, projection=metasra_api.SAMPLEGROUP_PROJECTION):
+        projections.append(projection)
+        return study_samplegroups(query, studyIDs, projection)
+    monkeypatch.setattr(metasra_api, 'study_samplegroups', recording)
+
+    matching = [samplegroup for samplegroup in samplegroups if 'A:1' in samplegroup['aterms']]
+    runs = api.get('/api/v01/runs.ids.txt?and=A:1').get_data(as_text=True).split()
+    assert sorted(runs) == sorted(run for samplegroup in matching for run in samplegroup['runs'])
+    samples = api.get('/api/v01/samples.ids.txt?and=A:1').get_data(as_text=True).split()
+    assert sorted(samples) == sorted(sample['id'] for samplegroup in matching for sample in samplegroup['samples'])
+    assert projections and metasra_api.SAMPLEGROUP_PROJECTION not in projections
@@ -0,0 +1,109 @@
+"""
+Tests for query_cache.py.  Run with pytest from this directory.
+"""
+
+import query_cache
+from query_cache import LRUCache, QueryCache, SQLiteCache
+
+
+
+class Clock:
+    """Stand-in for time.time() that only moves when told to."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=10, ttl=60)
+    cache.set('a', b'1234')
+    cache.set('b', b'1234')
+    assert cache.get('a') == b'1234'
+
+    # Over the limit: 'b' is the least recently used now.
+    cache.set('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.get('c') == b'1234'
+    assert cache.size == 8
+
+
+
+def test_lru_replaces_and_skips_oversized_values():
+    cache = LRUCache(max_bytes=10, ttl=60)
+    cache.set('a', b'1234')
+    cache.set('a', b'12')
+    assert cache.size == 2
+
+    cache.set('big', b'x' * 11)
+    assert cache.get('big') is None
+    assert cache.get('a') == b'12'
+
+    cache.clear()
+    assert cache.size == 0 and cache.get('a') is None
+
+
+
+def test_lru_expires_entries(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(query_cache.time, 'time', clock)
+
+    cache = LRUCache(max_bytes=100, ttl=60)
+    cache.set('a', b'value')
+    clock.now += 59
+    assert cache.get('a') == b'value'
+    clock.now += 2
+    assert cache.get('a') is None
+    assert cache.size == 0
+
+
+
+def test_sqlite_cache_versions_and_pruning(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'), max_bytes=10, ttl=60)
+    cache.set('a', '1', b'1234')
+    assert cache.get('a', '1') == b'1234'
+    assert cache.get('a', '2') is None
+
+    cache.set('b', '1', b'1234')
+    cache.set('c', '1', b'1234')
+    cache.get('a', '1')
+    cache.prune('1')
+    assert cache.get('a', '1') is not None
+    assert sum(cache.get(key, '1') is not None for key in 'abc') == 2
+
+    # Entries from other builds are deleted.
+    cache.prune('2')
+    assert all(cache.get(key, '1') is None for key in 'abc')
+
+
+
+def test_query_cache_computes_once_per_version():
+    cache = QueryCache(max_bytes=1000, ttl=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'count': len(calls)}
+
+    assert cache.get_or_compute('v1', 'query', compute) == {'count': 1}
+    assert cache.get_or_compute('v1', 'query', compute) == {'count': 1}
+    assert len(calls) == 1
+
+    # A new build invalidates everything cached from the old one.
+    assert cache.get_or_compute('v2', 'query', compute) == {'count': 2}
+    assert cache.get_or_compute('v2', 'query', compute) == {'count': 2}
+
+
+
+def test_query_cache_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    first, second = QueryCache(1000, 60, path), QueryCache(1000, 60, path)
+
+    assert first.get_or_compute('v1', 'query', lambda: [1, 2, 3]) == [1, 2, 3]
+    assert second.get_or_compute('v1', 'query', lambda: 'not cached') == [1, 2, 3]
+    assert second.get_or_compute('v2', 'query', lambda: 'new build') == 'new build'
+    assert first.get_or_compute('v2', 'query', lambda: 'not cached') == 'new build'
@@ -0,0 +1,68 @@
+"""
+Tests for response_encoding.py.  Run with pytest from this directory.
+"""
+
+import json
+import zlib
+
+import pytest
+from bson import ObjectId
+
+import response_encoding
+
+
+
+def test_dumps():
+    objectID = ObjectId('0123456789abcdef01234567')
+    assert json.loads(response_encoding.dumps({'a': [1, 'b'], 'id': objectID})) == \
+        {'a': [1, 'b'], 'id': {'$oid': '0123456789abcdef01234567'}}
+
+
+
+def test_stream_json():
+    result = {'studyCount': 3, 'studies': [{'id': n} for n in range(3)]}
+    chunks = list(response_encoding.stream_json(result, 'studies', 20))
+    assert len(chunks) > 1
+    assert json.loads(''.join(chunks)) == result
+
+    assert json.loads(''.join(response_encoding.stream_json({'studies': []}, 'studies', 20))) == {'studies': []}
+
+
+
+def test_negotiate_encoding(monkeypatch):
+    monkeypatch.setattr(response_encoding, 'COMPRESSORS', [('gzip', None)])
+    assert response_encoding.negotiate_encoding('gzip, deflate') == 'gzip'
+    assert response_encoding.negotiate_encoding('gzip;q=0, deflate') is None
+    assert response_encoding.negotiate_encoding('*') == 'gzip'
+    assert response_encoding.negotiate_encoding('identity') is None
+    assert response_encoding.negotiate_encoding(None) is None
+
+
+
+def gzip_decompressor():
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return decompressor.decompress
+
+def zstd_decompressor():
+    zstandard = pytest.importorskip('zstandard')
+    return zstandard.ZstdDecompressor().decompressobj().decompress
+
+def brotli_decompressor():
+    brotli = pytest.importorskip('brotli')
+    return brotli.Decompressor().process
+
+
+@pytest.mark.parametrize('encoding,decompressor', [
+    ('gzip', gzip_decompressor), ('zstd', zstd_decompressor), ('br', brotli_decompressor)])
+def test_compress_flushes_each_chunk(encoding, decompressor):
+    decompress = decompressor()
+    if encoding not in dict(response_encoding.COMPRESSORS):
+        pytest.skip('%s not installed' % encoding)
+
+    # Each chunk can be decoded as soon as it's yielded.
+    chunks = [('chunk %d ' % n).encode('ascii') * 100 for n in range(5)]
+    compressed = response_encoding.compress(iter(chunks), encoding)
+    for chunk in chunks:
+        assert decompress(next(compressed)) == chunk
+
+    assert decompress(b''.join(compressed)) == b''
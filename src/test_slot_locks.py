@@ -0,0 +1,78 @@
+"""
+Tests for slot_locks.py.  Run with pytest from this directory.
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+
+from slot_locks import FileSemaphore, LocalSemaphore
+
+
+
+def test_file_semaphore_slots(tmp_path):
+    semaphore = FileSemaphore(str(tmp_path / 'slots'), 'small', 2)
+    first, second = semaphore.acquire(), semaphore.acquire()
+    assert first is not None and second is not None
+    assert semaphore.try_acquire() is None
+
+    # Another semaphore on the same files shares the slots.
+    other = FileSemaphore(str(tmp_path / 'slots'), 'small', 2)
+    assert other.try_acquire() is None
+    assert FileSemaphore(str(tmp_path / 'slots'), 'large', 1).try_acquire() is not None
+
+    semaphore.release(first)
+    third = other.try_acquire()
+    assert third is not None
+    other.release(third)
+
+
+
+def test_file_semaphore_timeout(tmp_path):
+    semaphore = FileSemaphore(str(tmp_path), 'large', 1)
+    slot = semaphore.acquire()
+
+    start = time.monotonic()
+    assert semaphore.acquire(timeout=0.2) is None
+    assert time.monotonic() - start >= 0.2
+    semaphore.release(slot)
+    assert semaphore.acquire(timeout=0.2) is not None
+
+
+
+def hold_slot(directory, ready):
+    FileSemaphore(directory, 'large', 1).acquire()
+    ready.set()
+    time.sleep(60)
+
+
+
+def test_slots_are_shared_between_processes(tmp_path):
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    worker = context.Process(target=hold_slot, args=(str(tmp_path), ready))
+    worker.start()
+    try:
+        assert ready.wait(10)
+        semaphore = FileSemaphore(str(tmp_path), 'large', 1)
+        assert semaphore.try_acquire() is None
+
+        # A worker that dies holding a slot doesn't leak it.
+        os.kill(worker.pid, signal.SIGKILL)
+        worker.join()
+        assert semaphore.acquire(timeout=5) is not None
+    finally:
+        if worker.is_alive():
+            worker.kill()
+
+
+
+def test_local_semaphore():
+    semaphore = LocalSemaphore(1)
+    slot = semaphore.acquire()
+    assert slot is not None
+    assert semaphore.try_acquire() is None
+    assert semaphore.acquire(timeout=0.01) is None
+    semaphore.release(slot)
+    assert semaphore.try_acquire() is not None
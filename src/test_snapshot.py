@@ -0,0 +1,114 @@
+"""
+Tests for snapshot.py: writing a snapshot and reading it back.  Run with
+pytest from this directory.
+"""
+
+import random
+
+import pytest
+
+from snapshot import Snapshot, write_snapshot
+
+
+
+def random_samplegroups(rng, nstudies=20):
+    """Random samplegroup documents sorted by study, shaped like the samplegroups collection."""
+
+    dterms = [{'name': 'term %d' % i, 'ids': ['D:%d' % i]} for i in range(15)]
+    samplegroups = []
+    for study in range(nstudies):
+        studyID = 'SRP%03d' % study
+        for i in range(rng.randint(1, 5)):
+            samples = [{'id': 'SRS%d' % rng.randint(0, 10**6), 'experiments': [
+                {'id': 'SRX%d' % rng.randint(0, 10**6), 'runs': ['SRR%d' % rng.randint(0, 10**6)
+                    for run in range(rng.randint(1, 3))]}]}
+                for sample in range(rng.randint(1, 4))]
+            samplegroups.append({
+                '_id': len(samplegroups),
+                'study': {'id': studyID, 'title': 'Study %d' % study},
+                'type': rng.choice([None, {'type': 'tissue', 'confidence': 0.9}, {'type': 'cell line', 'confidence': 0.7}]),
+                'attributes': [['tissue', 'brain %d' % i]],
+                'samples': samples,
+                'sampleCount': len(samples),
+                'runs': [run for sample in samples for experiment in sample['experiments'] for run in experiment['runs']],
+                'aterms': sorted(rng.sample(['A:%d' % t for t in range(10)], rng.randint(0, 4))),
+                'dterms': rng.sample(dterms, rng.randint(0, 3)),
+            })
+    return samplegroups
+
+
+
+def brute_force_histogram(samplegroups):
+    """Term histogram with the API's definition: the sample count of each study for each of its display terms."""
+
+    studies = {}
+    for samplegroup in samplegroups:
+        study = studies.setdefault(samplegroup['study']['id'], [0, {}])
+        study[0] += len(samplegroup['samples'])
+        for dterm in samplegroup['dterms']:
+            study[1][dterm['name']] = dterm
+
+    counts = {}
+    for sampleCount, dterms in studies.values():
+        for name, dterm in dterms.items():
+            counts.setdefault(name, {'dterm': dterm, 'sampleCount': 0})['sampleCount'] += sampleCount
+    return sorted(counts.values(), key=lambda term: (-term['sampleCount'], term['dterm']['name']))
+
+
+
+@pytest.fixture
+def written(tmp_path):
+    samplegroups = random_samplegroups(random.Random(0))
+    terms = [{'_id': i, 'ids': ['A:%d' % i], 'name': 'term %d' % i, 'score': 6} for i in range(10)]
+    termprefixes = [{'_id': 'te', 'ids': ['A:0', 'A:1'], 'namematch': [1, 1], 'complete': False}]
+
+    path = str(tmp_path / 'metasra.snapshot')
+    write_snapshot(path, '1712345678', samplegroups, terms, termprefixes)
+    return Snapshot(path), samplegroups, terms, termprefixes
+
+
+
+def test_round_trip(written):
+    snapshot, samplegroups, terms, termprefixes = written
+    assert snapshot.version == '1712345678'
+    assert snapshot.size == len(samplegroups)
+
+    for position, samplegroup in enumerate(samplegroups):
+        expected = {k: v for (k, v) in samplegroup.items() if k not in ('_id', 'sampleCount', 'runs', 'aterms')}
+        assert snapshot.samplegroup(position) == expected
+        assert snapshot.samplegroup_study(position) == samplegroup['study']['id']
+        assert snapshot.samplegroup_runs(position) == samplegroup['runs']
+
+    assert list(snapshot.terms()) == [{k: v for (k, v) in term.items() if k != '_id'} for term in terms]
+    assert snapshot.term_prefixes() == termprefixes
+
+
+
+def test_postings_and_index(written):
+    snapshot, samplegroups, terms, termprefixes = written
+
+    for term in ['A:%d' % t for t in range(10)] + ['X:unknown']:
+        expected = [position for (position, samplegroup) in enumerate(samplegroups) if term in samplegroup['aterms']]
+        assert list(snapshot.term_postings(term)) == expected
+
+    index = snapshot.sample_index()
+    bitmap = index.match(['A:1'], ['A:2'], sampletype='tissue')
+    assert index.ids_for(bitmap) == [position for (position, samplegroup) in enumerate(samplegroups)
+        if 'A:1' in samplegroup['aterms'] and 'A:2' not in samplegroup['aterms']
+        and (samplegroup['type'] or {}).get('type') == 'tissue']
+
+
+
+def test_term_histogram(written):
+    snapshot, samplegroups, terms, termprefixes = written
+
+    positions = [position for (position, samplegroup) in enumerate(samplegroups) if 'A:3' in samplegroup['aterms']]
+    assert snapshot.term_histogram(positions) == brute_force_histogram([samplegroups[p] for p in positions])
+
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        Snapshot(str(path))
@@ -0,0 +1,115 @@
+"""
+Tests for term_index.py.  Run with pytest from this directory.
+"""
+
+from term_index import TermIndex, depluralize
+
+
+
+def term(termID, name, synonyms=()):
+    """A terms collection document, with the search fields build-db.py adds."""
+
+    tokens = set(name.lower().split())
+    for synonym in synonyms:
+        tokens.update(synonym.lower().split())
+    return {
+        '_id': termID,
+        'ids': [termID],
+        'name': name,
+        'synonyms': list(synonyms),
+        'tokens': sorted(tokens),
+        'nametokens': sorted(set(name.lower().split())),
+        'score': len(name),
+    }
+
+
+TERMS = [
+    term('T:1', 'brain'),
+    term('T:2', 'brain stem'),
+    term('T:3', 'cerebrum', ['brain']),
+    term('T:4', 'brains'),
+    term('T:5', 'stem cell'),
+    term('T:6', 'cells of brain'),
+    term('T:7', 'bone'),
+    term('T:8', 'bond'),
+]
+
+
+
+def names(results):
+    return [result['name'] for result in results]
+
+
+
+def test_depluralize():
+    assert depluralize('cells') == 'cell'
+    assert depluralize('CELLS') == 'CELL'
+    assert depluralize('glass') == 'gla'
+    assert depluralize('brain') == 'brain'
+
+
+
+def test_prefix_ranking():
+    index = TermIndex(TERMS)
+
+    # Terms with 'brain' in the name first, then by score and name.
+    assert names(index.search(['brain'])) == ['brain', 'brains', 'brain stem', 'cells of brain', 'cerebrum']
+    assert [result['namematch'] for result in index.search(['brain'])] == [1, 1, 1, 1, 0]
+
+    # Prefixes match the start of any token.
+    assert names(index.search(['bon'])) == ['bond', 'bone']
+    assert names(index.search(['stem', 'c'])) == ['stem cell']
+    assert index.search(['nothing']) == []
+
+    # Hidden fields aren't returned.
+    assert set(index.search(['bone'])[0]) == {'ids', 'name', 'synonyms', 'namematch'}
+
+
+
+def test_depluralized_matches_rank_after_exact_matches():
+    index = TermIndex(TERMS)
+
+    # 'brains' as typed only matches 'brains'; the rest match 'brain'.
+    assert names(index.search(['brains'])) == ['brains', 'brain', 'brain stem', 'cells of brain', 'cerebrum']
+    assert names(index.search(['cells'])) == ['cells of brain', 'stem cell']
+
+
+
+def test_limit_and_ids():
+    index = TermIndex(TERMS)
+    assert names(index.search(['brain'], limit=2)) == ['brain', 'brains']
+    assert names(index.search(['brain'], ids=['T:3', 'T:6', 'X:unknown'])) == ['cells of brain', 'cerebrum']
+
+    # Without tokens, terms are ordered by score and then name.
+    assert names(index.search(ids=['T:8', 'T:7', 'T:1'])) == ['bond', 'bone', 'brain']
+    assert index.search() == []
+
+
+
+def test_completions_round_trip():
+    index = TermIndex(TERMS)
+    prefixes = index.completion_prefixes(max_length=2, min_terms=2)
+    assert 'b' in prefixes and 'br' in prefixes and 'bra' in prefixes and 'bone' not in prefixes
+    completions = [index.completion(prefix, limit=3) for prefix in prefixes]
+
+    served = TermIndex(TERMS)
+    served.load_completions(completions)
+    assert set(served.completions) == set(prefixes)
+    for prefix in prefixes:
+        for limit in (1, 3, 10):
+            assert served.search([prefix], limit=limit) == index.search([prefix], limit=limit)
+
+    # 'br' was cut off at 3 terms, so it's ranked live for a higher limit.
+    assert not served.completions['br'][1]
+    assert len(served.search(['br'], limit=10)) == 5
+
+
+
+def test_completions_with_unknown_ids_are_skipped():
+    index = TermIndex(TERMS)
+    completion = index.completion('b', limit=10)
+    completion['ids'][0] = 'X:removed'
+
+    index.load_completions([completion, index.completion('c', limit=10)])
+    assert set(index.completions) == {'c'}
+    assert names(index.search(['b'])) == names(TermIndex(TERMS).search(['b']))